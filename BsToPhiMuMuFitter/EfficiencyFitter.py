@@ -11,6 +11,7 @@ from BsToPhiMuMuFitter.varCollection import CosThetaL, CosThetaK
 from BsToPhiMuMuFitter.FitDBPlayer import FitDBPlayer
 
 import re
+from array import array
 import itertools, pdb
 
 import ROOT
@@ -30,6 +31,7 @@ class EfficiencyFitter(FitterCore):
             'pdfX': "effi_cosl",
             'pdfY': "effi_cosK",
             'updateArgs': True,
+            'linearSolve': True,  # Cross terms by linear least squares, Minuit only if the solution is not positive
         })
         del cfg['createNLLOpt']
         return cfg
@@ -86,10 +88,15 @@ class EfficiencyFitter(FitterCore):
         args = self.pdf.getParameters(self.data)
         self.ToggleConstVar(args, True)
         FitDBPlayer.UpdateToDB(self.process.dbplayer.odbfile, args)
+        if getattr(self, 'covariance', None):
+            FitDBPlayer.UpdateToDB(self.process.dbplayer.odbfile, self.covariance)
 
     def _runFitSteps(self):
         h2_accXrec = self.process.sourcemanager.get("effiHistReader.h2_accXrec")
-        effi_sigA_formula = self.pdf.formula().GetExpFormula().Data()
+        if self.pdf.InheritsFrom("RooFormulaVar"):
+            effi_sigA_formula = self.pdf.formula().GetExpFormula().Data()
+        else:
+            effi_sigA_formula = self.pdf.getExpression().Data()
         args = self.pdf.getParameters(self.data)
         args_it = args.createIterator()
         arg = args_it.Next()
@@ -111,21 +118,32 @@ class EfficiencyFitter(FitterCore):
 
         fitter = ROOT.EfficiencyFitter()
         minuit = fitter.Init(nPar, h2_accXrec, f2_effi_sigA)
-        for xIdx in range(nPar):
-            minuit.DefineParameter(xIdx, "x{0}".format(xIdx), 0., 1E-4, -1E+1, 1E+1)
-        # minuit.SetPrintLevel(-1) #Pritam
-        minuit.Command("MINI")
-        minuit.Command("MINI")
-        minuit.Command("MINOS")
-        parVal = ROOT.Double(0)
-        parErr = ROOT.Double(0)
-        for xIdx in range(nPar):
-            minuit.GetParameter(xIdx, parVal, parErr)
-            arg = args.find("x{0}".format(xIdx))
-            arg.setVal(parVal)
-            arg.setError(parErr)
-
-        print "Status: ", minuit.GetStatus()
+        if not (self.cfg['linearSolve'] and self._solveLinear(fitter, f2_effi_sigA, args, nPar)):
+            for xIdx in range(nPar):
+                minuit.DefineParameter(xIdx, "x{0}".format(xIdx), 0., 1E-4, -1E+1, 1E+1)
+            # minuit.SetPrintLevel(-1) #Pritam
+            minuit.Command("MINI")
+            minuit.Command("MINI")
+            minuit.Command("MINOS")
+            parVal = ROOT.Double(0)
+            parErr = ROOT.Double(0)
+            for xIdx in range(nPar):
+                minuit.GetParameter(xIdx, parVal, parErr)
+                arg = args.find("x{0}".format(xIdx))
+                arg.setVal(parVal)
+                arg.setError(parErr)
+                f2_effi_sigA.SetParameter(xIdx, parVal)
+            covMatrix = array('d', [0.] * (nPar * nPar))
+            minuit.mnemat(covMatrix, nPar)
+            self.covariance = {
+                "{0}.covariance".format(self.name): {
+                    'params': ["x{0}".format(xIdx) for xIdx in range(nPar)],
+                    'matrix': [[covMatrix[iPar * nPar + jPar] for jPar in range(nPar)] for iPar in range(nPar)],
+                    'covQual': minuit.fISW[1],
+                }
+            }
+
+            print "Status: ", minuit.GetStatus()
         # Check if efficiency is positive definite
         f2_max_x, f2_max_y = ROOT.Double(0), ROOT.Double(0)
         f2_min_x, f2_min_y = ROOT.Double(0), ROOT.Double(0)
@@ -157,6 +175,35 @@ class EfficiencyFitter(FitterCore):
         canvas.Print("effi_2D_comp_{0}.pdf".format(q2bins[self.process.cfg['binKey']]['label']))
         print "Eff Chi2: ", type(fitter), fitter.GetChi2()
 
+    def _solveLinear(self, fitter, f2_effi_sigA, args, nPar):
+        """Closed-form chi2 minimum of the cross terms, the model being linear in them.
+Return False if Minuit is needed, i.e. the solution is negative somewhere or out of the Minuit limits."""
+        status = fitter.SolveLinear()
+        if status != 0:
+            self.logger.logWARNING("Linear solve failed with status {0}, fall back to Minuit.".format(status))
+            return False
+        parVals = [fitter.GetLinearParameter(xIdx) for xIdx in range(nPar)]
+        if any(abs(val) > 1E+1 for val in parVals):
+            self.logger.logWARNING("Linear solution out of [-10, 10], fall back to Minuit.")
+            return False
+        if not self.isPosiDef(f2_effi_sigA):
+            self.logger.logWARNING("Positivity constraint is active, fall back to Minuit.")
+            return False
+
+        for xIdx in range(nPar):
+            arg = args.find("x{0}".format(xIdx))
+            arg.setVal(parVals[xIdx])
+            arg.setError(fitter.GetLinearCovariance(xIdx, xIdx)**0.5)
+        self.covariance = {
+            "{0}.covariance".format(self.name): {
+                'params': ["x{0}".format(xIdx) for xIdx in range(nPar)],
+                'matrix': [[fitter.GetLinearCovariance(iPar, jPar) for jPar in range(nPar)] for iPar in range(nPar)],
+                'covQual': 3,  # Exact for a quadratic chi2
+            }
+        }
+        self.logger.logINFO("Cross terms solved by linear least squares, chi2={0}".format(fitter.GetChi2()))
+        return True
+
     @staticmethod
     def isPosiDef(formula2D):
         f2_min_x, f2_min_y = ROOT.Double(0), ROOT.Double(0)
@@ -5,16 +5,16 @@ from __future__ import print_function
 
 import os
 import shutil
-import shelve
 import math
 
 import ROOT
 from v2Fitter.FlowControl.Service import Service
 from v2Fitter.Fitter.FitterCore import FitterCore
 from BsToPhiMuMuFitter.anaSetup import q2bins
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 
 class FitDBPlayer(Service):
-    "Play with the database generated with shelve"
+    "Play with the database, see FitResultStore for the file formats"
     funcPair = [
         ('setVal', 'getVal'),
         ('setError', 'getError'),
@@ -35,40 +35,23 @@ class FitDBPlayer(Service):
 
     @staticmethod
     def MergeDB(dblist, mode="Overwrite", outputName="MergedDB.db"):
-        """"""
-        if mode not in ["Overwrite", "Print", "Skip"]:
+        """Merge dblist into outputName, see script/mergeFitDB.py for many files"""
+        if mode not in FitResultStore.mergeModes:
             print("Unknown mode for DB merging process. Take default mode.")
             mode = "Overwrite"
 
         if not all([os.path.exists(f) for f in dblist]):
             return
 
-        for dbfile in dblist:
-            if not os.path.exists(outputName):
-                shutil.copy(dbfile, outputName)
-                outputdb = shelve.open(outputName, writeback=True)
-            else:
-                db = shelve.open(dbfile)
-                if mode == "Overwrite":
-                    outputdb.update(db)
-                elif mode == "Print" or mode == "Skip":
-                    for key, val in db.items():
-                        if key in outputdb and mode == "Print":
-                            print("Found duplicated key: {0} in {2}".format(key, dbfile))
-                        else:
-                            outputdb[key] = val
-                else:
-                    raise NotImplementedError
-                db.close()
-        outputdb.close()
+        FitResultStore.mergeInto(outputName, dblist, mode)
 
     @staticmethod
     def UpdateToDB(dbfile, args, aliasDict=None):
         """Update fit result to a db file"""
         if aliasDict is None:
             aliasDict = {}
-        try:
-            db = shelve.open(dbfile, writeback=True)
+        db = FitResultStore.getStore(dbfile)
+        with db.transaction():
             if isinstance(args, dict):
                 modified_args = {}
                 for key, val in args.items():
@@ -79,20 +62,45 @@ class FitDBPlayer(Service):
                 def updateToDBImp(iArg):
                     argName = iArg.GetName()
                     aliasName = aliasDict.get(argName, argName)
-                    if aliasName not in db:
-                        db[aliasName] = {}
+                    record = db.get(aliasName, {})
                     for setter, getter in FitDBPlayer.funcPair:
                         try:
-                            db[aliasName][getter] = getattr(iArg, getter)()
+                            record[getter] = getattr(iArg, getter)()
                         except AttributeError:
                             # In case of no getError for RooNLLVar and so on.
                             pass
+                    db[aliasName] = record
                 FitterCore.ArgLooper(args, updateToDBImp)
             else:
                 raise ValueError("Input arguement of type {0} is not supported".format(type(args)))
-        finally:
-            db.close()
-            print("Updated to Database `{0}`.".format(dbfile))
+        print("Updated to Database `{0}`.".format(dbfile))
+
+    @staticmethod
+    def covarianceRecord(fitterName, fitResult):
+        """Convert the covariance of a RooFitResult to a db record"""
+        if not fitResult:
+            return {}
+        floatPars = fitResult.floatParsFinal()
+        covMatrix = fitResult.covarianceMatrix()
+        nPar = floatPars.getSize()
+        return {
+            "{0}.covariance".format(fitterName): {
+                'params': [floatPars.at(iPar).GetName() for iPar in range(nPar)],
+                'matrix': [[covMatrix(iPar, jPar) for jPar in range(nPar)] for iPar in range(nPar)],
+                'covQual': fitResult.covQual(),
+            }
+        }
+
+    @staticmethod
+    def getCovarianceFromDB(dbfile, fitterName):
+        """Covariance record saved by covarianceRecord, None if absent or unreliable"""
+        if not os.path.exists(dbfile):
+            return None
+        cov = FitResultStore.getStore(dbfile).get("{0}.covariance".format(fitterName), None)
+        if cov is None or cov.get('covQual', 0) < 2:
+            # Approximate or not positive-definite, starting steps from it do more harm than good.
+            return None
+        return cov
 
     @staticmethod
     def initFromDB(dbfile, args, aliasDict=None):
@@ -103,27 +111,25 @@ class FitDBPlayer(Service):
         if aliasDict is None:
             aliasDict = {}
 
-        try:
-            db = shelve.open(dbfile)
-            def initFromDBImp(iArg):
-                argName = iArg.GetName()
-                aliasName = aliasDict.get(argName, argName)
-                if aliasName in db:
-                    for setter, getter in FitDBPlayer.funcPair:
-                        if setter in ["setMax", "setMin"]:
-                            continue
-                        getattr(iArg, setter)(
-                            *{
-                                'getErrorHi': (db[aliasName]['getErrorLo'], db[aliasName]['getErrorHi']),
-                                'getErrorLo': (db[aliasName]['getErrorLo'], db[aliasName]['getErrorHi']),
-                            }.get(getter, (db[aliasName][getter],))
-                        )
-                else:
-                    print("WARNING\t: Unable to initialize {0}, record {1} not found in {2}.".format(argName, aliasName, dbfile))
-            FitterCore.ArgLooper(args, initFromDBImp)
-            print("Initialized parameters from `{0}`.".format(dbfile))
-        finally:
-            db.close()
+        db = FitResultStore.getStore(dbfile)
+        def initFromDBImp(iArg):
+            argName = iArg.GetName()
+            aliasName = aliasDict.get(argName, argName)
+            if aliasName in db:
+                record = db[aliasName]
+                for setter, getter in FitDBPlayer.funcPair:
+                    if setter in ["setMax", "setMin"]:
+                        continue
+                    getattr(iArg, setter)(
+                        *{
+                            'getErrorHi': (record['getErrorLo'], record['getErrorHi']),
+                            'getErrorLo': (record['getErrorLo'], record['getErrorHi']),
+                        }.get(getter, (record[getter],))
+                    )
+            else:
+                print("WARNING\t: Unable to initialize {0}, record {1} not found in {2}.".format(argName, aliasName, dbfile))
+        FitterCore.ArgLooper(args, initFromDBImp)
+        print("Initialized parameters from `{0}`.".format(dbfile))
 
     @staticmethod
     def fluctuateFromDB(dbfile, args, aliasDict=None):
@@ -133,24 +139,21 @@ class FitDBPlayer(Service):
         if aliasDict is None:
             aliasDict = {}
 
-        try:
-            db = shelve.open(dbfile)
-            gaus = ROOT.TF1("gaus", "exp(-0.5*x**2)", -3, 3)
-            def flucturateFromDBImp(iArg):
-                argName = iArg.GetName()
-                aliasName = aliasDict.get(argName, argName)
-                if aliasName in db:
-                    significance = gaus.GetRandom()
-                    arg = db[aliasName]
-                    if significance > 0:
-                        iArg.setVal(min(arg['getMax'], arg['getVal'] + significance * (arg['getErrorHi'] if math.fabs(arg['getErrorHi']) > 1e-5 else arg['getError'])))
-                    else:
-                        iArg.setVal(max(arg['getMin'], arg['getVal'] + significance * (arg['getErrorLo'] if math.fabs(arg['getErrorLo']) > 1e-5 else arg['getError'])))
+        db = FitResultStore.getStore(dbfile)
+        gaus = ROOT.TF1("gaus", "exp(-0.5*x**2)", -3, 3)
+        def flucturateFromDBImp(iArg):
+            argName = iArg.GetName()
+            aliasName = aliasDict.get(argName, argName)
+            if aliasName in db:
+                significance = gaus.GetRandom()
+                arg = db[aliasName]
+                if significance > 0:
+                    iArg.setVal(min(arg['getMax'], arg['getVal'] + significance * (arg['getErrorHi'] if math.fabs(arg['getErrorHi']) > 1e-5 else arg['getError'])))
                 else:
-                    print("ERROR\t: Unable to fluctuate {0}, record not found in {1}.".format(aliasName, dbfile))
-            FitterCore.ArgLooper(args, flucturateFromDBImp)
-        finally:
-            db.close()
+                    iArg.setVal(max(arg['getMin'], arg['getVal'] + significance * (arg['getErrorLo'] if math.fabs(arg['getErrorLo']) > 1e-5 else arg['getError'])))
+            else:
+                print("ERROR\t: Unable to fluctuate {0}, record not found in {1}.".format(aliasName, dbfile))
+        FitterCore.ArgLooper(args, flucturateFromDBImp)
 
     def saveSMPrediction(self):
         """ Save SM prediction to DB file. """
@@ -189,6 +192,8 @@ class FitDBPlayer(Service):
     def resetDB(self, forceReset=False):
         baseDBFile = "{0}/{1}_{2}.db".format(self.absInputDir, os.path.splitext(self.outputfilename)[0], q2bins[self.process.cfg['binKey']]['label'])
         self.odbfile = "{0}".format(os.path.basename(baseDBFile))
+        # The file may be replaced, drop the opened store
+        FitResultStore.closeStore(self.odbfile)
         if os.path.exists(baseDBFile):
             if not os.path.exists(self.odbfile) or forceReset:
                 shutil.copy(baseDBFile, self.odbfile)
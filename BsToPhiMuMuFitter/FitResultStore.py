@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+# vim: set sts=4 sw=4 fdm=indent fdl=1 fdn=3 et:
+
+# Description     : Fit result stores with a shelve-like API, opened once per process
+
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import time
+import fcntl
+import socket
+import shelve
+import sqlite3
+import whichdb
+import cPickle as pickle
+from contextlib import contextmanager
+
+# Format of newly created files, existing files are sniffed.
+defaultBackend = "sqlite"
+
+# Attached to every record written by this process
+_provenance = {
+    'jobId': None,  # Falls back to $V2FITTER_JOBID, set by AbsBatchTaskWrapper
+    'host': socket.gethostname(),
+    'source': " ".join(sys.argv),
+}
+
+def setProvenance(**kwargs):
+    """e.g. setProvenance(jobId=...) once the job is known"""
+    _provenance.update(kwargs)
+
+def currentProvenance():
+    provenance = dict(_provenance)
+    if provenance['jobId'] is None:
+        provenance['jobId'] = os.environ.get('V2FITTER_JOBID')
+    provenance.update({
+        'pid': os.getpid(),
+        'timestamp': time.time(),
+    })
+    return provenance
+
+class _Pickled(object):
+    """Non-numeric value, unpickled on first access"""
+    __slots__ = ('blob',)
+    def __init__(self, blob):
+        self.blob = blob
+
+def _materialize(value):
+    if isinstance(value, _Pickled):
+        return pickle.loads(value.blob)
+    elif isinstance(value, dict):
+        return dict((field, _materialize(val)) for field, val in value.items())
+    return copy.deepcopy(value)
+
+class AbsFitResultStore(object):
+    """Dict-like store of records {name: {field: value}}, read through an in-memory cache.
+    Records are returned as copies, modify and assign them back as with shelve."""
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._records = {}
+        self._inTransaction = False
+        self._shared = False
+
+    # Backend specific
+    def _refresh(self):
+        """Reload the cache if the file was modified by somebody else"""
+        raise NotImplementedError
+
+    def _write(self, name, record):
+        raise NotImplementedError
+
+    def _delete(self, name):
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """Batch writes, all of them or none are applied"""
+        raise NotImplementedError
+
+    def close(self):
+        """Shared stores from getStore stay open, use closeStore"""
+        if not self._shared:
+            self._close()
+
+    def _close(self):
+        pass
+
+    def sync(self):
+        pass
+
+    # Shelve-like API
+    def __getitem__(self, name):
+        self._refresh()
+        return _materialize(self._records[name])
+
+    def __setitem__(self, name, record):
+        self.put(name, record)
+
+    def put(self, name, record, provenance=None):
+        """Write a record, with the provenance of this process by default"""
+        if self.readonly:
+            raise IOError("{0} is opened read-only".format(self.path))
+        self._write(name, record, provenance)
+        self._records[name] = copy.deepcopy(record)
+
+    def __delitem__(self, name):
+        if self.readonly:
+            raise IOError("{0} is opened read-only".format(self.path))
+        self._refresh()
+        if name not in self._records:
+            raise KeyError(name)
+        self._delete(name)
+        del self._records[name]
+
+    def __contains__(self, name):
+        self._refresh()
+        return name in self._records
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self._refresh()
+        return len(self._records)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        self._refresh()
+        return list(self._records.keys())
+
+    def items(self):
+        self._refresh()
+        return [(name, _materialize(record)) for name, record in self._records.items()]
+
+    def get(self, name, default=None):
+        self._refresh()
+        if name in self._records:
+            return _materialize(self._records[name])
+        return default
+
+    def update(self, records):
+        with self.transaction():
+            for name, record in records.items():
+                self[name] = record
+
+    def getField(self, name, field, default=None):
+        """Single field of a record, without copying the record"""
+        self._refresh()
+        record = self._records.get(name)
+        if not isinstance(record, dict) or field not in record:
+            return default
+        return _materialize(record[field])
+
+    def getProvenance(self, name):
+        """Job, host, pid, timestamp and source of the last write of a record, None if unknown"""
+        raise NotImplementedError
+
+    def setField(self, name, field, value):
+        with self.transaction():
+            record = self.get(name, {})
+            record[field] = value
+            self[name] = record
+
+class SQLiteFitResultStore(AbsFitResultStore):
+    """One row per (record, field). Numbers are stored as they are, such that
+    other tools query e.g. `SELECT num FROM params WHERE name='nSig' AND field='getVal'`.
+    Other values are pickled."""
+    schema = """CREATE TABLE IF NOT EXISTS params (
+    name  TEXT NOT NULL,
+    field TEXT NOT NULL,
+    kind  TEXT NOT NULL,
+    num   REAL,
+    blob  BLOB,
+    PRIMARY KEY (name, field))"""
+    provenanceSchema = """CREATE TABLE IF NOT EXISTS provenance (
+    name      TEXT PRIMARY KEY,
+    jobId     TEXT,
+    host      TEXT,
+    pid       INTEGER,
+    timestamp REAL,
+    source    TEXT)"""
+    provenanceFields = ('jobId', 'host', 'pid', 'timestamp', 'source')
+    recordField = ""  # Marker row, such that empty records and non-dict records exist
+
+    def __init__(self, path, readonly=False):
+        super(SQLiteFitResultStore, self).__init__(path, readonly)
+        # Autocommit mode, transactions are explicit
+        self.conn = sqlite3.connect(path, timeout=300, isolation_level=None)
+        self.conn.text_factory = str
+        if not readonly:
+            self.conn.execute(self.schema)
+            self.conn.execute(self.provenanceSchema)
+        self._dataVersion = None
+        self._refresh()
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bool):
+            return 'b', int(value), None
+        elif isinstance(value, (int, long)) and -2**63 <= value < 2**63:
+            return 'i', value, None
+        elif isinstance(value, float):
+            return 'f', value, None
+        return 'p', None, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _decode(kind, num, blob):
+        if kind == 'b':
+            return bool(num)
+        elif kind == 'i':
+            return int(num)
+        elif kind == 'f':
+            return num
+        return _Pickled(str(blob))
+
+    def _refresh(self):
+        if self._inTransaction:
+            return
+        dataVersion = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if dataVersion == self._dataVersion:
+            return
+        self._load()
+        self._dataVersion = dataVersion
+
+    def _load(self):
+        records = {}
+        try:
+            rows = self.conn.execute("SELECT name, field, kind, num, blob FROM params").fetchall()
+        except sqlite3.OperationalError:
+            # Read-only access to a file never written
+            rows = []
+        for name, field, kind, num, blob in rows:
+            if field == self.recordField:
+                if kind == 'r':
+                    records.setdefault(name, {})
+                else:
+                    records[name] = self._decode(kind, num, blob)
+            else:
+                records.setdefault(name, {})[field] = self._decode(kind, num, blob)
+        self._records = records
+
+    def _rows(self, name, record):
+        if not isinstance(record, dict):
+            return [(name, self.recordField) + self._encode(record)]
+        rows = [(name, self.recordField, 'r', None, None)]
+        for field, value in record.items():
+            rows.append((name, str(field)) + self._encode(value))
+        return rows
+
+    def _write(self, name, record, provenance=None):
+        if provenance is None:
+            provenance = currentProvenance()
+        with self.transaction():
+            self.conn.execute("DELETE FROM params WHERE name=?", (name,))
+            self.conn.executemany("INSERT INTO params VALUES (?, ?, ?, ?, ?)", self._rows(name, record))
+            self.conn.execute("INSERT OR REPLACE INTO provenance VALUES (?, ?, ?, ?, ?, ?)",
+                              (name,) + tuple(provenance.get(field) for field in self.provenanceFields))
+
+    def _delete(self, name):
+        with self.transaction():
+            self.conn.execute("DELETE FROM params WHERE name=?", (name,))
+            self.conn.execute("DELETE FROM provenance WHERE name=?", (name,))
+
+    def getProvenance(self, name):
+        try:
+            row = self.conn.execute("SELECT jobId, host, pid, timestamp, source FROM provenance WHERE name=?", (name,)).fetchone()
+        except sqlite3.OperationalError:
+            # Written before provenance was recorded
+            return None
+        return dict(zip(self.provenanceFields, row)) if row else None
+
+    @contextmanager
+    def transaction(self):
+        if self._inTransaction:
+            # Nested, the outermost one commits
+            yield self
+            return
+        self._refresh()
+        self.conn.execute("BEGIN IMMEDIATE")
+        # Modifications between the last read and the lock
+        self._load()
+        self._inTransaction = True
+        try:
+            yield self
+        except:
+            self.conn.execute("ROLLBACK")
+            self._inTransaction = False
+            self._dataVersion = None
+            self._refresh()
+            raise
+        else:
+            self.conn.execute("COMMIT")
+            self._inTransaction = False
+            self._dataVersion = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _close(self):
+        self.conn.close()
+
+class ShelveFitResultStore(AbsFitResultStore):
+    """Legacy shelve files. Writers are serialized with flock on <path>.lock,
+    which is not reliable across hosts on network file systems, use SQLite there."""
+    provenanceKey = "__provenance__"
+
+    def __init__(self, path, readonly=False):
+        super(ShelveFitResultStore, self).__init__(path, readonly)
+        self._mtime = None
+        self._pending = None
+        self._provenance = {}
+        self._refresh()
+
+    @contextmanager
+    def _lock(self):
+        with open(self.path + ".lock", 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _mtimeOfFiles(self):
+        # Some dbm modules add suffixes to path
+        return max([os.path.getmtime(f) for f in [self.path] + [self.path + sfx for sfx in (".db", ".dat", ".dir", ".pag")] if os.path.exists(f)] + [None])
+
+    def _refresh(self):
+        if self._inTransaction:
+            return
+        mtime = self._mtimeOfFiles()
+        if mtime is None:
+            return
+        if mtime == self._mtime:
+            return
+        self._load()
+        self._mtime = mtime
+
+    def _load(self):
+        if self._mtimeOfFiles() is None:
+            return
+        db = shelve.open(self.path, 'r')
+        try:
+            self._records = dict(db.items())
+        finally:
+            db.close()
+        self._provenance = self._records.pop(self.provenanceKey, {})
+
+    def _flush(self, writes, deletes):
+        db = shelve.open(self.path)
+        try:
+            for name in deletes:
+                if name in db:
+                    del db[name]
+                self._provenance.pop(name, None)
+            db.update(writes)
+            if writes or deletes:
+                db[self.provenanceKey] = self._provenance
+        finally:
+            db.close()
+        self._mtime = self._mtimeOfFiles()
+
+    def _write(self, name, record, provenance=None):
+        if provenance is None:
+            provenance = currentProvenance()
+        with self.transaction():
+            self._pending[0][name] = copy.deepcopy(record)
+            self._pending[1].discard(name)
+            self._provenance[name] = provenance
+
+    def _delete(self, name):
+        with self.transaction():
+            self._pending[0].pop(name, None)
+            self._pending[1].add(name)
+
+    def getProvenance(self, name):
+        self._refresh()
+        return copy.deepcopy(self._provenance.get(name))
+
+    @contextmanager
+    def transaction(self):
+        if self._inTransaction:
+            yield self
+            return
+        with self._lock():
+            # Modifications between the last read and the lock
+            self._mtime = None
+            self._refresh()
+            self._inTransaction = True
+            self._pending = ({}, set())
+            try:
+                yield self
+            except:
+                self._inTransaction = False
+                self._mtime = None
+                self._refresh()
+                raise
+            else:
+                self._inTransaction = False
+                self._flush(*self._pending)
+            finally:
+                self._pending = None
+
+def sniffBackend(path):
+    """Backend of an existing file, defaultBackend for a new one"""
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            if f.read(16) == "SQLite format 3\x00":
+                return "sqlite"
+    # Some dbm modules add suffixes to path
+    if whichdb.whichdb(path):
+        return "shelve"
+    return defaultBackend
+
+backends = {
+    'sqlite': SQLiteFitResultStore,
+    'shelve': ShelveFitResultStore,
+}
+
+def openStore(path, readonly=False, backend=None):
+    """Open a store, not registered. Close it yourself."""
+    # Some dbm modules add suffixes to path
+    if readonly and not os.path.exists(path) and not whichdb.whichdb(path):
+        raise IOError("No fit result store at {0} to be opened read-only".format(path))
+    return backends[backend if backend else sniffBackend(path)](path, readonly)
+
+# Stores opened in this process, sqlite connections must not cross fork.
+_registry = {}
+
+def getStore(path, readonly=False):
+    """Store of path shared within the current process"""
+    key = (os.getpid(), os.path.abspath(path))
+    store = _registry.get(key)
+    if store is None or (store.readonly and not readonly):
+        if store is not None:
+            store._close()
+        store = openStore(path, readonly)
+        store._shared = True
+        _registry[key] = store
+    return store
+
+def closeStore(path):
+    """Drop path from the registry, e.g. before the file is replaced"""
+    store = _registry.pop((os.getpid(), os.path.abspath(path)), None)
+    if store is not None:
+        store._close()
+
+mergeModes = ["Overwrite", "Skip", "Print", "Newest"]
+
+def _isNewer(provenance, provenanceRef):
+    """Record with provenance replaces the one with provenanceRef in mode Newest"""
+    if not provenanceRef or provenanceRef.get('timestamp') is None:
+        return True
+    if not provenance or provenance.get('timestamp') is None:
+        return False
+    return provenance['timestamp'] >= provenanceRef['timestamp']
+
+def _mergeSQLite(output, inputPath, mode):
+    """Merge without decoding records, both files are SQLite"""
+    conn = output.conn
+    conn.execute("ATTACH DATABASE ? AS src", (inputPath,))
+    try:
+        tables = set(row[0] for row in conn.execute("SELECT name FROM src.sqlite_master WHERE type='table'"))
+        if 'params' not in tables:
+            # Empty file, nothing written yet
+            return 0
+        hasProvenance = 'provenance' in tables
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if mode == "Overwrite":
+                selection = "SELECT DISTINCT name FROM src.params"
+            elif mode in ["Skip", "Print"]:
+                selection = "SELECT DISTINCT name FROM src.params WHERE name NOT IN (SELECT name FROM main.params)"
+                if mode == "Print":
+                    for (name,) in conn.execute("SELECT DISTINCT name FROM src.params WHERE name IN (SELECT name FROM main.params)"):
+                        print("Found duplicated key: {0} in {1}".format(name, inputPath))
+            elif mode == "Newest":
+                selection = """SELECT DISTINCT s.name FROM src.params AS s
+                    LEFT JOIN main.provenance AS mp ON mp.name = s.name
+                    {0}
+                    WHERE s.name NOT IN (SELECT name FROM main.params) OR mp.timestamp IS NULL OR {1}""".format(
+                    "LEFT JOIN src.provenance AS sp ON sp.name = s.name" if hasProvenance else "",
+                    "(sp.timestamp IS NOT NULL AND sp.timestamp >= mp.timestamp)" if hasProvenance else "0")
+            else:
+                raise ValueError("Unknown merge mode {0}".format(mode))
+            conn.execute("CREATE TEMP TABLE mergeNames AS " + selection)
+            nMerged = conn.execute("SELECT count(*) FROM mergeNames").fetchone()[0]
+            conn.execute("DELETE FROM main.params WHERE name IN (SELECT name FROM mergeNames)")
+            conn.execute("DELETE FROM main.provenance WHERE name IN (SELECT name FROM mergeNames)")
+            conn.execute("INSERT INTO main.params SELECT * FROM src.params WHERE name IN (SELECT name FROM mergeNames)")
+            if hasProvenance:
+                conn.execute("INSERT INTO main.provenance SELECT * FROM src.provenance WHERE name IN (SELECT name FROM mergeNames)")
+            conn.execute("DROP TABLE mergeNames")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+    finally:
+        conn.execute("DETACH DATABASE src")
+    output._dataVersion = None
+    return nMerged
+
+def _mergeGeneric(output, inputPath, mode):
+    inputStore = openStore(inputPath, readonly=True)
+    nMerged = 0
+    try:
+        with output.transaction():
+            for name in inputStore.keys():
+                if name in output:
+                    if mode == "Print":
+                        print("Found duplicated key: {0} in {1}".format(name, inputPath))
+                    if mode in ["Skip", "Print"]:
+                        continue
+                    if mode == "Newest" and not _isNewer(inputStore.getProvenance(name), output.getProvenance(name)):
+                        continue
+                output.put(name, inputStore[name], inputStore.getProvenance(name) or {})
+                nMerged += 1
+    finally:
+        inputStore.close()
+    return nMerged
+
+def mergeInto(outputPath, inputPaths, mode="Overwrite"):
+    """Merge records of inputPaths into outputPath, in order of inputPaths.
+    Overwrite: the last record wins. Skip: the first record wins. Print: Skip and report duplicates.
+    Newest: the record written last according to provenance wins.
+    Return the number of records written."""
+    if mode not in mergeModes:
+        raise ValueError("Unknown merge mode {0}, choose from {1}".format(mode, mergeModes))
+    closeStore(outputPath)
+    output = openStore(outputPath)
+    nMerged = 0
+    try:
+        for inputPath in inputPaths:
+            if isinstance(output, SQLiteFitResultStore) and sniffBackend(inputPath) == "sqlite" and os.path.exists(inputPath):
+                nMerged += _mergeSQLite(output, inputPath, mode)
+            else:
+                nMerged += _mergeGeneric(output, inputPath, mode)
+    finally:
+        output.close()
+    return nMerged
+
+def getField(path, name, field, default=None):
+    """Read a single field, for table and plot makers"""
+    if not os.path.exists(path):
+        return default
+    return getStore(path, readonly=True).getField(name, field, default)
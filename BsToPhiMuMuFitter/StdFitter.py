@@ -7,6 +7,7 @@
 
 import functools
 import math
+import multiprocessing
 import ROOT
 import BsToPhiMuMuFitter.cpp
 
@@ -30,6 +31,17 @@ class StdFitter(FitterCore):
             'argAliasInDB': {},
             'saveToDB': True,
             'argAliasSaveToDB': True,
+            'optimizeConst': 0,  # 1 to cache per-event values of nodes with constant parameters, e.g. efficiency
+            'nCPU': 1,  # Number of processes sharing the events in NLL evaluation
+            'nCPUStrategy': 0,  # 0: bulk, 1: interleave, 2: simultaneous components
+            'batchMode': False,  # Vectorised evaluation, ROOT >= 6.20
+            'offsetting': False,  # Better precision on large NLL, but the saved nll is shifted by an arbitrary offset
+            'minimizer': "Minuit2",  # "Minuit" for the deprecated RooMinuit
+            'strategyLadder': [(1, 1.), (2, 1.), (2, 10.)],  # (strategy, tolerance) tried until converged, prepend (0, 1.) for a cheap first pass
+            'edmMax': 1e-3,  # Accepted edm at tolerance 1, scaled by the tolerance of each rung
+            'simplexFallback': True,
+            'warmStart': True,  # Initial step sizes from the covariance saved by the previous fit
+            'minosWorkers': 1,  # >1 to run MINOS of each parameter in a forked process
         })
         return cfg
 
@@ -38,9 +50,43 @@ class StdFitter(FitterCore):
         self.fitter = ROOT.StdFitter()
         for opt in self.cfg.get("createNLLOpt", []):
             self.fitter.addNLLOpt(opt)
+        self.fitter.SetOptimizeConst(self.cfg.get('optimizeConst', 0))
+        self.fitter.SetNumCPU(self.cfg.get('nCPU', 1), self.cfg.get('nCPUStrategy', 0))
+        self.fitter.SetBatchMode(self.cfg.get('batchMode', False))
+        self.fitter.SetOffsetting(self.cfg.get('offsetting', False))
+        self.fitter.SetMinimizerType(self.cfg.get('minimizer', "Minuit2"))
+        self.fitter.ClearLadder()
+        for strategy, tolerance in self.cfg.get('strategyLadder', []):
+            self.fitter.AddLadderStep(strategy, tolerance)
+        self.fitter.SetEdmMax(self.cfg.get('edmMax', 1e-3))
+        self.fitter.SetSimplexFallback(self.cfg.get('simplexFallback', True))
         self.fitter.Init(self.pdf, self.data)
         self._nll = self.fitter.GetNLL()
 
+    def swapData(self, data):
+        """Replace the data of the booked NLL, parameters are left untouched"""
+        if not self.fitter.SetData(data):
+            raise RuntimeError("Failed to set {0} to the NLL of {1}".format(data.GetName(), self.name))
+        self.data = data
+
+    def snapshotArgs(self):
+        """Value, errors and constness of self.args in memory"""
+        snapshot = {}
+        def snapshotImp(iArg):
+            snapshot[iArg.GetName()] = (iArg.getVal(), iArg.getError(), iArg.getErrorLo(), iArg.getErrorHi(), iArg.isConstant())
+        FitterCore.ArgLooper(self.args, snapshotImp)
+        return snapshot
+
+    def restoreArgs(self, snapshot):
+        """Inverse of snapshotArgs, replaces _preFitSteps in resident mode"""
+        def restoreImp(iArg):
+            val, err, errLo, errHi, isConst = snapshot[iArg.GetName()]
+            iArg.setVal(val)
+            iArg.setError(err)
+            iArg.setAsymError(errLo, errHi)
+            iArg.setConstant(isConst)
+        FitterCore.ArgLooper(self.args, restoreImp)
+
     def _preFitSteps_initFromDB(self):
         """Initialize from DB"""
         #if not self.name=="sigAFitter": 
@@ -48,6 +94,23 @@ class StdFitter(FitterCore):
         self.ToggleConstVar(self.args, True)
         self.ToggleConstVar(self.args, False, self.cfg.get('argPattern'))
 
+    def _preFitSteps_warmStart(self):
+        """Take step sizes from the covariance of the previous fit, if any.
+RooMinimizer cannot be seeded with a full covariance, only the diagonal is used."""
+        cov = FitDBPlayer.getCovarianceFromDB(self.process.dbplayer.odbfile, self.name)
+        if cov is None:
+            return
+        nUpdated = 0
+        for iPar, parName in enumerate(cov['params']):
+            var = self.args.find(parName)
+            if var == None or var.isConstant():
+                continue
+            sigma2 = cov['matrix'][iPar][iPar]
+            if sigma2 > 0:
+                var.setError(math.sqrt(sigma2))
+                nUpdated += 1
+        print("Warm start: step sizes of {0} parameter(s) from previous covariance.".format(nUpdated))
+
     def _preFitSteps_preFit(self):
         """ Standard prefit steps """
         unboundFl = self.args.find("unboundFl")
@@ -78,6 +141,8 @@ class StdFitter(FitterCore):
         """ Prefit steps """
         self.args = self.pdf.getParameters(self.data)
         self._preFitSteps_initFromDB()
+        if self.cfg.get('warmStart', False):
+            self._preFitSteps_warmStart()
         self._preFitSteps_vetoSmallFs()
         self._preFitSteps_preFit()
 
@@ -88,6 +153,8 @@ class StdFitter(FitterCore):
         if self.cfg['saveToDB']:
             FitDBPlayer.UpdateToDB(self.process.dbplayer.odbfile, self.args, self.cfg['argAliasInDB'] if self.cfg['argAliasSaveToDB'] else None)
             FitDBPlayer.UpdateToDB(self.process.dbplayer.odbfile, self.fitResult)
+            if getattr(self, 'covariance', None):
+                FitDBPlayer.UpdateToDB(self.process.dbplayer.odbfile, self.covariance)
 
     def _runFitSteps(self):
         self.FitMigrad()
@@ -96,6 +163,7 @@ class StdFitter(FitterCore):
             self.FitHesse()
         if self.cfg.get('FitMinos', [False, ()])[0]:
             self.FitMinos()
+        self.covariance = FitDBPlayer.covarianceRecord(self.name, self.fitter.Save())
 
     def FitMigrad(self):
         """Migrad"""
@@ -104,6 +172,8 @@ class StdFitter(FitterCore):
             "{0}.{1}".format(self.name, self.cfg['argAliasInDB'].get('migrad', 'migrad')): {
                 'status': migradResult.status(),
                 'nll': migradResult.minNll(),
+                'edm': migradResult.edm(),
+                'covQual': migradResult.covQual(),
             }
         }
         print "Migrad Result: ", self.fitResult
@@ -119,18 +189,86 @@ class StdFitter(FitterCore):
             FitterCore.ArgLooper(self.args, lambda var: par.add(var), self.cfg['FitMinos'][1])
         else:
             par = self.args
-        minosResult = self.fitter.FitMinos(par)
+        nWorkers = self.cfg.get('minosWorkers', 1)
+        if nWorkers > 1 and multiprocessing.current_process().daemon:
+            print("WARNING\t: Parallel MINOS unavailable inside a daemonic worker (e.g. BinPool), run sequentially.")
+            nWorkers = 1
+        if nWorkers > 1 and self.cfg.get('nCPU', 1) > 1:
+            print("WARNING\t: Parallel MINOS cannot share the NLL servers of nCPU>1, run sequentially.")
+            nWorkers = 1
+        if nWorkers > 1:
+            minosStatus, minosNll = self._FitMinosInPool(par, nWorkers)
+        else:
+            minosResult = self.fitter.FitMinos(par)
+            minosStatus, minosNll = minosResult.status(), minosResult.minNll()
         self.fitResult.update({
             "{0}.{1}".format(self.name, self.cfg['argAliasInDB'].get('minos', 'minos')): {
-                'status': minosResult.status(),
-                'nll': minosResult.minNll(),
+                'status': minosStatus,
+                'nll': minosNll,
             }
         })
 
+    def _FitMinosInPool(self, par, nWorkers):
+        """MINOS of each floating parameter in a forked copy of the minimizer at the minimum.
+This process stays idle at the minimum meanwhile, such that every worker is forked from the same state and the nll of the record is taken there.
+Return the status and the nll of the record, asymmetric errors are set to par."""
+        parNames = []
+        FitterCore.ArgLooper(par, lambda var: parNames.append(var.GetName()) if not var.isConstant() else None)
+        if len(parNames) < 2:
+            minosResult = self.fitter.FitMinos(par)
+            return minosResult.status(), minosResult.minNll()
+
+        _minosContext.update({
+            'fitter': self.fitter,
+            'args': self.args,
+        })
+        # One parameter per worker, replacements are forked from this untouched process.
+        pool = multiprocessing.Pool(processes=min(nWorkers, len(parNames)), maxtasksperchild=1)
+        try:
+            results = pool.map(_runMinosOnePar, parNames, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _minosContext.clear()
+
+        minosStatus, minosNll = 0, self.fitter.Save().minNll()
+        for result in results:
+            if result['status'] is None:
+                print("ERROR\t: MINOS of {0} failed in worker\n{1}".format(result['name'], result['error']))
+                if minosStatus == 0:
+                    minosStatus = -1
+                continue
+            self.args.find(result['name']).setAsymError(result['errorLo'], result['errorHi'])
+            if result['status'] != 0 and minosStatus == 0:
+                minosStatus = result['status']
+            if math.fabs(result['nll'] - minosNll) > 1e-6 * max(1., math.fabs(minosNll)):
+                # The serial path would have continued from the new minimum
+                print("WARNING\t: MINOS of {0} ended at nll {1}, differs from {2} at the MIGRAD minimum.".format(result['name'], result['nll'], minosNll))
+        return minosStatus, minosNll
+
         # Dont' draw profiled likelihood scanning with following link
         # https://root.cern.ch/root/html/tutorials/roofit/rf605_profilell.C.html
         # This build-in function doesn't handle variable transformation and unphysical region.
 
+# Workers are forked at the minimum and inherit the minimizer through this dict.
+_minosContext = {}
+
+def _runMinosOnePar(parName):
+    result = {'name': parName, 'status': None, 'nll': None, 'errorLo': 0., 'errorHi': 0., 'error': None}
+    try:
+        var = _minosContext['args'].find(parName)
+        minosResult = _minosContext['fitter'].FitMinos(ROOT.RooArgSet(var))
+        result.update({
+            'status': minosResult.status(),
+            'nll': minosResult.minNll(),
+            'errorLo': var.getErrorLo(),
+            'errorHi': var.getErrorHi(),
+        })
+    except Exception:
+        import traceback
+        result['error'] = traceback.format_exc()
+    return result
+
 def unboundFlToFl(unboundFl):
     return 0.5 + ROOT.TMath.ATan(unboundFl) / ROOT.TMath.Pi()
 
@@ -0,0 +1,93 @@
+// vim: set sts=4 sw=4 fdm=marker fdn=3 et:
+
+#include <iostream>
+#include <vector>
+
+#include "TIterator.h"
+#include "RooAbsArg.h"
+#include "RooArgSet.h"
+#include "RooRealVar.h"
+#include "RooCategory.h"
+#include "RooDataSet.h"
+
+#ifndef DATASUBSETTER_H
+#define DATASUBSETTER_H
+
+// Columnar snapshot of a RooDataSet to build many subsets by event index
+// without a python round trip per event.
+class DataSubsetter{
+public:
+    DataSubsetter(const RooDataSet&);
+    virtual ~DataSubsetter();
+
+    RooDataSet* Subset(const char* name, const int* indices, int nIndices);
+    int GetEntries(){return nEntries;}
+private:
+    const RooDataSet *src = 0;
+    RooArgSet *row = 0;
+    int nEntries = 0;
+    bool isWeighted = false;
+    std::vector<RooRealVar*> realArgs;
+    std::vector<std::vector<double> > realCols;
+    std::vector<RooCategory*> catArgs;
+    std::vector<std::vector<int> > catCols;
+    std::vector<double> weights;
+};
+
+DataSubsetter::DataSubsetter(const RooDataSet &data) : src(&data){
+    nEntries = src->numEntries();
+    isWeighted = src->isWeighted();
+    row = (RooArgSet*)src->get()->snapshot(kFALSE);
+
+    TIterator *iter = row->createIterator();
+    RooAbsArg *arg = 0;
+    while ((arg = (RooAbsArg*)iter->Next())) {
+        if (arg->InheritsFrom("RooRealVar")) {
+            realArgs.push_back((RooRealVar*)arg);
+        } else if (arg->InheritsFrom("RooCategory")) {
+            catArgs.push_back((RooCategory*)arg);
+        } else {
+            std::cout << "WARNING\t: DataSubsetter ignores " << arg->GetName() << " of type " << arg->ClassName() << std::endl;
+        }
+    }
+    delete iter;
+
+    realCols.assign(realArgs.size(), std::vector<double>(nEntries));
+    catCols.assign(catArgs.size(), std::vector<int>(nEntries));
+    if (isWeighted) weights.resize(nEntries);
+    for (int iEvt = 0; iEvt < nEntries; iEvt++) {
+        const RooArgSet *evt = src->get(iEvt);
+        for (size_t iArg = 0; iArg < realArgs.size(); iArg++) {
+            realCols[iArg][iEvt] = ((RooRealVar*)evt->find(*realArgs[iArg]))->getVal();
+        }
+        for (size_t iArg = 0; iArg < catArgs.size(); iArg++) {
+            catCols[iArg][iEvt] = ((RooCategory*)evt->find(*catArgs[iArg]))->getIndex();
+        }
+        if (isWeighted) weights[iEvt] = src->weight();
+    }
+}
+
+DataSubsetter::~DataSubsetter(){
+    delete row;
+    row = 0;
+}
+
+RooDataSet* DataSubsetter::Subset(const char* name, const int* indices, int nIndices){
+    RooDataSet *output = (RooDataSet*)src->emptyClone(name);
+    for (int iIdx = 0; iIdx < nIndices; iIdx++) {
+        int iEvt = indices[iIdx];
+        if (iEvt < 0 || iEvt >= nEntries) {
+            std::cout << "ERROR\t: DataSubsetter index " << iEvt << " out of range [0, " << nEntries << ")" << std::endl;
+            continue;
+        }
+        for (size_t iArg = 0; iArg < realArgs.size(); iArg++) {
+            realArgs[iArg]->setVal(realCols[iArg][iEvt]);
+        }
+        for (size_t iArg = 0; iArg < catArgs.size(); iArg++) {
+            catArgs[iArg]->setIndex(catCols[iArg][iEvt]);
+        }
+        output->add(*row, isWeighted ? weights[iEvt] : 1.);
+    }
+    return output;
+}
+#endif
@@ -1,6 +1,15 @@
 #include "TH2.h"
 #include "TF2.h"
 #include "TMinuit.h"
+#include "TMatrixD.h"
+#include "TMatrixDSym.h"
+#include "TVectorD.h"
+#include "TDecompChol.h"
+
+#include <cmath>
+#include <vector>
+#include <iostream>
+#include <algorithm>
 #include "RooMsgService.h"
 
 #ifndef EFFICIENCYFITTER_H
@@ -8,7 +17,7 @@
 
 TH2 *h2_fcn = 0;
 TF2 *f2_fcn = 0;
-int chi2Val = 0;
+double chi2Val = 0;
 void test(){
 RooMsgService::instance().setGlobalKillBelow(RooFit::FATAL);
 RooMsgService::instance().setSilentMode(kTRUE);
@@ -23,17 +32,117 @@ RooMsgService::instance().getStream(1).removeTopic(RooFit::Eval) ;
 RooMsgService::instance().Print() ;
 }
 
-void fcn_binnedChi2_2D(int &npar, double *gin, double &f, double *par, int iflag)
+// f2_fcn = offset + sum_k par[k]*basis_k, tabulated by PrecomputeBasis() for bins with non-zero error,
+// i.e. bin averages and values on a grid for the positivity check. Row-major, nBasisPar per row.
+int nBasisPar = 0;
+bool isBasisValid = false;
+const int nPosiGrid = 30; // Points per axis, the default of TF2::GetMinimumXY
+std::vector<double> binMeasure, binError, binOffset, binBasis;
+std::vector<double> gridOffset, gridBasis;
+
+bool PrecomputeBasis()
+{//{{{
+    // Valid only if f2_fcn is linear in its parameters, checked on the grid at the end.
+    nBasisPar = f2_fcn->GetNpar();
+    binMeasure.clear(); binError.clear(); binOffset.clear(); binBasis.clear();
+    gridOffset.clear(); gridBasis.clear();
+    std::vector<double> par(nBasisPar, 0.);
+    f2_fcn->SetParameters(&par[0]);
+    for (int i = 1; i <= h2_fcn->GetNbinsX(); i++) {
+        for (int j = 1; j <= h2_fcn->GetNbinsY(); j++) {
+            int gBin = h2_fcn->GetBin(i,j);
+            double error = h2_fcn->GetBinError(gBin);
+            if (error <= 0) continue;
+            double xi = h2_fcn->GetXaxis()->GetBinLowEdge(i);
+            double xf = h2_fcn->GetXaxis()->GetBinUpEdge(i);
+            double yi = h2_fcn->GetYaxis()->GetBinLowEdge(j);
+            double yf = h2_fcn->GetYaxis()->GetBinUpEdge(j);
+            double area = (xf-xi)*(yf-yi);
+            double offset = f2_fcn->Integral(xi,xf,yi,yf)/area;
+            binMeasure.push_back(h2_fcn->GetBinContent(gBin));
+            binError.push_back(error);
+            binOffset.push_back(offset);
+            for (int k = 0; k < nBasisPar; k++){
+                f2_fcn->SetParameter(k,1.);
+                binBasis.push_back(f2_fcn->Integral(xi,xf,yi,yf)/area-offset);
+                f2_fcn->SetParameter(k,0.);
+            }
+        }
+    }
+
+    double xmin = f2_fcn->GetXmin(), xmax = f2_fcn->GetXmax();
+    double ymin = f2_fcn->GetYmin(), ymax = f2_fcn->GetYmax();
+    for (int i = 0; i < nPosiGrid; i++) {
+        for (int j = 0; j < nPosiGrid; j++) {
+            double x = xmin + (xmax-xmin)*i/(nPosiGrid-1);
+            double y = ymin + (ymax-ymin)*j/(nPosiGrid-1);
+            double offset = f2_fcn->Eval(x,y);
+            gridOffset.push_back(offset);
+            for (int k = 0; k < nBasisPar; k++){
+                f2_fcn->SetParameter(k,1.);
+                gridBasis.push_back(f2_fcn->Eval(x,y)-offset);
+                f2_fcn->SetParameter(k,0.);
+            }
+        }
+    }
+
+    // Linearity check with all parameters switched on at once
+    isBasisValid = true;
+    for (int k = 0; k < nBasisPar; k++) par[k] = 0.1*(k+1);
+    f2_fcn->SetParameters(&par[0]);
+    for (size_t p = 0; p < gridOffset.size(); p += 7) {
+        double pred = gridOffset[p];
+        for (int k = 0; k < nBasisPar; k++) pred += gridBasis[p*nBasisPar+k]*par[k];
+        double x = xmin + (xmax-xmin)*(p/nPosiGrid)/(nPosiGrid-1);
+        double y = ymin + (ymax-ymin)*(p%nPosiGrid)/(nPosiGrid-1);
+        double val = f2_fcn->Eval(x,y);
+        if (fabs(val-pred) > 1e-9*(1.+fabs(val))) {
+            isBasisValid = false;
+            break;
+        }
+    }
+    return isBasisValid;
+}//}}}
+
+double binnedChi2(const double *par)
+{//{{{
+    double f = 0;
+    size_t nBins = binMeasure.size();
+    for (size_t b = 0; b < nBins; b++) {
+        const double *row = &binBasis[b*nBasisPar];
+        double pred = binOffset[b];
+        for (int k = 0; k < nBasisPar; k++) pred += row[k]*par[k];
+        double pull = (pred-binMeasure[b])/binError[b];
+        f += pull*pull;
+    }
+    return f;
+}//}}}
+
+bool isPositiveOnGrid(const double *par)
 {//{{{
+    size_t nPoints = gridOffset.size();
+    for (size_t p = 0; p < nPoints; p++) {
+        const double *row = &gridBasis[p*nBasisPar];
+        double val = gridOffset[p];
+        for (int k = 0; k < nBasisPar; k++) val += row[k]*par[k];
+        if (val < 0) return false;
+    }
+    return true;
+}//}}}
+
+void fcn_binnedChi2_2D_numeric(int &npar, double *gin, double &f, double *par, int iflag)
+{//{{{
+    // Integrate f2_fcn bin by bin, for formulae not linear in their parameters.
     f=0;
+    for (int k = 0; k < f2_fcn->GetNpar(); k++){
+        f2_fcn->SetParameter(k,par[k]);
+    }
     for (int i = 1; i <= h2_fcn->GetNbinsX(); i++) {
         for (int j = 1; j <= h2_fcn->GetNbinsY(); j++) {
             int gBin = h2_fcn->GetBin(i,j);
             double measure  = h2_fcn->GetBinContent(gBin);
             double error    = h2_fcn->GetBinError(gBin);
-            for (int k = 0; k < f2_fcn->GetNpar(); k++){
-                f2_fcn->SetParameter(k,par[k]);
-            }
+            if (error <= 0) continue; // As in PrecomputeBasis, such bins carry no information
             double xi = h2_fcn->GetXaxis()->GetBinLowEdge(i);
             double xf = h2_fcn->GetXaxis()->GetBinUpEdge(i);
             double yi = h2_fcn->GetYaxis()->GetBinLowEdge(j);
@@ -53,16 +162,38 @@ void fcn_binnedChi2_2D(int &npar, double *gin, double &f, double *par, int iflag
 
 }//}}}
 
+void fcn_binnedChi2_2D(int &npar, double *gin, double &f, double *par, int iflag)
+{//{{{
+    if (!isBasisValid) {
+        fcn_binnedChi2_2D_numeric(npar, gin, f, par, iflag);
+        return;
+    }
+    f = binnedChi2(par);
+    chi2Val = f;
+
+    // Prevent from negative function
+    if (!isPositiveOnGrid(par)){
+        f += 100*h2_fcn->GetNbinsX()*h2_fcn->GetNbinsY();
+    }
+}//}}}
+
 class EfficiencyFitter{
 public:
     EfficiencyFitter();
     virtual ~EfficiencyFitter();
     TH2* GetH2(){return h2_fcn;}
     TF2* GetF2(){return f2_fcn;}
-    int  GetChi2(){return chi2Val;}
+    double GetChi2(){return chi2Val;}
+    bool IsBasisValid(){return isBasisValid;}
     TMinuit* Init(int, TH2*, TF2*);
+    std::vector<double> EvalFCN(const std::vector<double>&);
+    int  SolveLinear();
+    double GetLinearParameter(int i){return linearSol(i);}
+    double GetLinearCovariance(int i, int j){return linearCov(i,j);}
 private:
     TMinuit *minuit = 0;
+    TVectorD linearSol;
+    TMatrixDSym linearCov;
 };
 
 EfficiencyFitter::EfficiencyFitter(){}
@@ -73,9 +204,59 @@ EfficiencyFitter::~EfficiencyFitter(){
 TMinuit* EfficiencyFitter::Init(int nPar, TH2 *h2, TF2 *f2){
     h2_fcn = h2;
     f2_fcn = f2;
+    if (!PrecomputeBasis()){
+        std::cout << "WARNING\t: f2 is not linear in its parameters, chi2 from numeric integration per call." << std::endl;
+    }
     minuit = new TMinuit(nPar);
     //minuit->SetPrintLevel(3); //Pritam
     minuit->SetFCN(fcn_binnedChi2_2D);
     return minuit;
 }
+std::vector<double> EfficiencyFitter::EvalFCN(const std::vector<double> &pars){
+    // FCN values, penalty included, of the parameter vectors concatenated in pars.
+    int nPar = f2_fcn->GetNpar();
+    int nVec = pars.size()/nPar;
+    std::vector<double> fcnVals(nVec, 0.);
+    std::vector<double> par(nPar);
+    int npar = nPar;
+    for (int v = 0; v < nVec; v++) {
+        std::copy(pars.begin()+v*nPar, pars.begin()+(v+1)*nPar, par.begin());
+        fcn_binnedChi2_2D(npar, 0, fcnVals[v], &par[0], 0);
+    }
+    return fcnVals;
+}
+int EfficiencyFitter::SolveLinear(){
+    // The same chi2 as fcn_binnedChi2_2D without the positivity penalty, quadratic in the parameters.
+    // Rows of the design matrix are the tabulated bin averages of the basis, divided by the bin error.
+    // Return 0 and leave f2 at the solution if the normal equations are solved, non-zero otherwise.
+    if (!isBasisValid) return 3;
+    int nPar = nBasisPar;
+    int nRows = binMeasure.size();
+    if (nRows < nPar) return 1;
+    TMatrixD design(nRows, nPar);
+    TVectorD target(nRows);
+    for (int b = 0; b < nRows; b++) {
+        for (int k = 0; k < nPar; k++){
+            design(b,k) = binBasis[b*nPar+k]/binError[b];
+        }
+        target(b) = (binMeasure[b]-binOffset[b])/binError[b];
+    }
+
+    TMatrixDSym normal(nPar);
+    normal.TMult(design);
+    TVectorD rhs = TMatrixD(TMatrixD::kTransposed, design)*target;
+    TDecompChol chol(normal);
+    if (!chol.Decompose()) return 2;
+    linearSol.ResizeTo(nPar);
+    linearSol = rhs;
+    chol.Solve(linearSol);
+    linearCov.ResizeTo(nPar, nPar);
+    chol.Invert(linearCov);
+
+    chi2Val = binnedChi2(linearSol.GetMatrixArray());
+    for (int k = 0; k < nPar; k++){
+        f2_fcn->SetParameter(k,linearSol(k));
+    }
+    return 0;
+}
 #endif
@@ -0,0 +1,162 @@
+/*****************************************************************************
+ * Project: RooFit                                                           *
+ *                                                                           *
+ * Factorised angular efficiency map                                         *
+ *   effi_norm * fL(CosThetaL) * fK(CosThetaK) * (1 + hasXTerm * xTerm)      *
+ *****************************************************************************/
+
+// Compiled replacement of the expr::effi_sigA string in pdfCollection.
+// Polynomials are evaluated with Horner's scheme, and the Legendre basis
+// P0..P4(CosThetaK) is computed once per event for all cross terms.
+
+#include "Riostream.h"
+
+#include "RooAngularEfficiency.h"
+#include "RooAbsReal.h"
+#include <math.h>
+#include <stdexcept>
+#include "TMath.h"
+
+ClassImp(RooAngularEfficiency);
+
+RooAngularEfficiency::RooAngularEfficiency(const char *name, const char *title,
+                       RooAbsReal& _CosThetaL,
+                       RooAbsReal& _CosThetaK,
+                       const RooArgList& _lCoefs,
+                       const RooArgList& _kCoefs,
+                       const RooArgList& _xCoefs,
+                       RooAbsReal& _effiNorm,
+                       RooAbsReal& _hasXTerm,
+                       Int_t _lShape) :
+  RooAbsReal(name,title),
+  CosThetaL("CosThetaL","CosThetaL",this,_CosThetaL),
+  CosThetaK("CosThetaK","CosThetaK",this,_CosThetaK),
+  lCoefs("lCoefs","lCoefs",this),
+  kCoefs("kCoefs","kCoefs",this),
+  xCoefs("xCoefs","xCoefs",this),
+  effiNorm("effiNorm","effiNorm",this,_effiNorm),
+  hasXTerm("hasXTerm","hasXTerm",this,_hasXTerm),
+  lShape(_lShape)
+{
+  lCoefs.add(_lCoefs) ;
+  kCoefs.add(_kCoefs) ;
+  xCoefs.add(_xCoefs) ;
+  if (lShape == Gaussians && lCoefs.getSize() % 3 != 0) {
+    coutE(InputArguments) << "RooAngularEfficiency::ctor(" << GetName() << ") number of Gaussian coefficients must be a multiple of 3" << endl ;
+    throw std::invalid_argument("RooAngularEfficiency: bad number of lCoefs") ;
+  }
+  if (xCoefs.getSize() % 5 != 0) {
+    coutE(InputArguments) << "RooAngularEfficiency::ctor(" << GetName() << ") number of cross term coefficients must be a multiple of 5" << endl ;
+    throw std::invalid_argument("RooAngularEfficiency: bad number of xCoefs") ;
+  }
+}
+
+
+RooAngularEfficiency::RooAngularEfficiency(const RooAngularEfficiency& other, const char* name) :
+  RooAbsReal(other,name),
+  CosThetaL("CosThetaL",this,other.CosThetaL),
+  CosThetaK("CosThetaK",this,other.CosThetaK),
+  lCoefs("lCoefs",this,other.lCoefs),
+  kCoefs("kCoefs",this,other.kCoefs),
+  xCoefs("xCoefs",this,other.xCoefs),
+  effiNorm("effiNorm",this,other.effiNorm),
+  hasXTerm("hasXTerm",this,other.hasXTerm),
+  lShape(other.lShape)
+{
+}
+
+
+Double_t RooAngularEfficiency::evaluateL(Double_t cosL) const
+{
+  const Int_t n = lCoefs.getSize() ;
+  Double_t result = 0 ;
+  if (lShape == Gaussians) {
+    for (Int_t i = 0; i < n; i += 3) {
+      const Double_t pull = (cosL - static_cast<RooAbsReal&>(lCoefs[i+1]).getVal())/static_cast<RooAbsReal&>(lCoefs[i+2]).getVal() ;
+      result += static_cast<RooAbsReal&>(lCoefs[i]).getVal()*TMath::Exp(-0.5*pull*pull) ;
+    }
+  } else {
+    for (Int_t i = n-1; i >= 0; --i) {
+      result = (result + static_cast<RooAbsReal&>(lCoefs[i]).getVal())*cosL ;
+    }
+    result += 1. ;
+  }
+  return result ;
+}
+
+
+Double_t RooAngularEfficiency::evaluateK(Double_t cosK) const
+{
+  Double_t result = 0 ;
+  for (Int_t i = kCoefs.getSize()-1; i >= 0; --i) {
+    result = (result + static_cast<RooAbsReal&>(kCoefs[i]).getVal())*cosK ;
+  }
+  return result + 1. ;
+}
+
+
+Double_t RooAngularEfficiency::evaluateXTerm(Double_t cosL, Double_t cosK) const
+{
+  const Double_t k2 = cosK*cosK ;
+  const Double_t legendre[5] = {1., cosK, 1.5*k2-0.5, (2.5*k2-1.5)*cosK, (4.375*k2-3.75)*k2+0.375} ;
+  Double_t result = 0 ;
+  for (Int_t row = xCoefs.getSize()/5-1; row >= 0; --row) {
+    Double_t rowSum = 0 ;
+    for (Int_t j = 0; j < 5; ++j) {
+      rowSum += static_cast<RooAbsReal&>(xCoefs[5*row+j]).getVal()*legendre[j] ;
+    }
+    result = result*cosL + rowSum ;
+  }
+  return result ;
+}
+
+
+Double_t RooAngularEfficiency::evaluate() const
+{
+  Double_t result = effiNorm*evaluateL(CosThetaL)*evaluateK(CosThetaK) ;
+  if (hasXTerm != 0) {
+    result *= 1. + hasXTerm*evaluateXTerm(CosThetaL, CosThetaK) ;
+  }
+  return result ;
+}
+
+
+TString RooAngularEfficiency::getExpression() const
+{
+  const char* l = CosThetaL.arg().GetName() ;
+  const char* k = CosThetaK.arg().GetName() ;
+
+  TString exprL ;
+  if (lShape == Gaussians) {
+    for (Int_t i = 0; i < lCoefs.getSize(); i += 3) {
+      exprL += TString::Format("%s%s*exp(-0.5*pow((%s-%s)/%s,2))", i ? "+" : "", lCoefs[i].GetName(), l, lCoefs[i+1].GetName(), lCoefs[i+2].GetName()) ;
+    }
+  } else {
+    exprL = "1" ;
+    for (Int_t i = 0; i < lCoefs.getSize(); ++i) {
+      exprL += TString::Format("+%s*pow(%s,%d)", lCoefs[i].GetName(), l, i+1) ;
+    }
+  }
+
+  TString exprK = "1" ;
+  for (Int_t i = 0; i < kCoefs.getSize(); ++i) {
+    exprK += TString::Format("+%s*pow(%s,%d)", kCoefs[i].GetName(), k, i+1) ;
+  }
+
+  const TString legendre[5] = {
+    "1",
+    TString::Format("%s", k),
+    TString::Format("(1.5*pow(%s,2)-0.5)", k),
+    TString::Format("(2.5*pow(%s,3)-1.5*%s)", k, k),
+    TString::Format("(4.375*pow(%s,4)-3.75*pow(%s,2)+0.375)", k, k)} ;
+  TString exprX ;
+  for (Int_t row = 0; row < xCoefs.getSize()/5; ++row) {
+    exprX += row ? "+(" : "(" ;
+    for (Int_t j = 0; j < 5; ++j) {
+      exprX += TString::Format("%s%s*%s", j ? "+" : "", xCoefs[5*row+j].GetName(), legendre[j].Data()) ;
+    }
+    exprX += TString::Format(")*pow(%s,%d)", l, row) ;
+  }
+
+  return TString::Format("%s*(%s)*(%s)*(1+%s*(%s))", effiNorm.arg().GetName(), exprL.Data(), exprK.Data(), hasXTerm.arg().GetName(), exprX.Data()) ;
+}
@@ -0,0 +1,62 @@
+/*****************************************************************************
+ * Project: RooFit                                                           *
+ *                                                                           *
+ * Factorised angular efficiency map                                         *
+ *   effi_norm * fL(CosThetaL) * fK(CosThetaK) * (1 + hasXTerm * xTerm)      *
+ *****************************************************************************/
+
+#ifndef ROOANGULAREFFICIENCY
+#define ROOANGULAREFFICIENCY
+
+#include "RooAbsReal.h"
+#include "RooRealProxy.h"
+#include "RooListProxy.h"
+#include "TString.h"
+
+class RooAngularEfficiency : public RooAbsReal {
+public:
+  // Shape of the CosThetaL factor
+  enum LShape { Polynomial = 0, // 1 + l1*x + l2*x^2 + ...
+                Gaussians  = 1  // l1*exp(-0.5*((x-l2)/l3)^2) + l4*exp(...) + ...
+  };
+
+  RooAngularEfficiency() {} ;
+  RooAngularEfficiency(const char *name, const char *title,
+                       RooAbsReal& _CosThetaL,
+                       RooAbsReal& _CosThetaK,
+                       const RooArgList& _lCoefs,
+                       const RooArgList& _kCoefs,
+                       const RooArgList& _xCoefs,
+                       RooAbsReal& _effiNorm,
+                       RooAbsReal& _hasXTerm,
+                       Int_t _lShape);
+  RooAngularEfficiency(const RooAngularEfficiency& other, const char* name=0) ;
+  virtual TObject* clone(const char* newname) const { return new RooAngularEfficiency(*this,newname); }
+  inline virtual ~RooAngularEfficiency() { }
+
+  // Equivalent TFormula expression in terms of the argument names
+  TString getExpression() const ;
+
+protected:
+
+  RooRealProxy CosThetaL ;
+  RooRealProxy CosThetaK ;
+  RooListProxy lCoefs ;
+  RooListProxy kCoefs ;
+  RooListProxy xCoefs ;  // 5 Legendre coefficients in CosThetaK per power of CosThetaL
+  RooRealProxy effiNorm ;
+  RooRealProxy hasXTerm ;
+  Int_t lShape ;
+
+  Double_t evaluate() const ;
+
+  Double_t evaluateL(Double_t cosL) const ;
+  Double_t evaluateK(Double_t cosK) const ;
+  Double_t evaluateXTerm(Double_t cosL, Double_t cosK) const ;
+
+private:
+
+  ClassDef(RooAngularEfficiency,1) // Factorised angular efficiency with Legendre cross terms
+};
+
+#endif
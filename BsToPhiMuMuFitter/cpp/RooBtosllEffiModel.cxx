@@ -0,0 +1,181 @@
+/*****************************************************************************
+ * Project: RooFit                                                           *
+ *                                                                           *
+ * Angular signal model times efficiency, with cached normalisation          *
+ *****************************************************************************/
+
+// Equivalent to RooEffProd(RooBtosllModel, effi), but the signal model is
+// linear in (1-fl), fl and afb:
+//   f = (1-fl)*g1 + fl*g2 + afb*g3
+// so the normalisation is (1-fl)*M1 + fl*M2 + afb*M3 with Mi = Int effi*gi.
+// The moments Mi are computed once by Gauss-Legendre quadrature and only
+// recomputed if one of the efficiency parameters or the range changes.
+// Per-event efficiency values are served by the effi proxy, which RooFit
+// caches in the dataset when the efficiency parameters are constant and
+// constant term optimisation is enabled in the likelihood.
+
+#include "Riostream.h"
+
+#include "RooBtosllEffiModel.h"
+#include "RooBtosllModel.h"
+#include "RooAbsRealLValue.h"
+#include <math.h>
+#include "TMath.h"
+
+ClassImp(RooBtosllEffiModel);
+
+namespace {
+  // Gauss-Legendre nodes and weights on [-1, 1]
+  void gaussLegendre(Int_t n, std::vector<Double_t>& nodes, std::vector<Double_t>& weights)
+  {
+    nodes.assign(n, 0.) ;
+    weights.assign(n, 0.) ;
+    for (Int_t i = 0; i < (n+1)/2; ++i) {
+      Double_t z = TMath::Cos(TMath::Pi()*(i+0.75)/(n+0.5)) ;
+      Double_t dp = 0 ;
+      for (Int_t iter = 0; iter < 100; ++iter) {
+        Double_t p0 = 1., p1 = 0. ;
+        for (Int_t j = 1; j <= n; ++j) {
+          const Double_t p2 = p1 ;
+          p1 = p0 ;
+          p0 = ((2.*j-1.)*z*p1 - (j-1.)*p2)/j ;
+        }
+        dp = n*(z*p0 - p1)/(z*z - 1.) ;
+        const Double_t dz = p0/dp ;
+        z -= dz ;
+        if (fabs(dz) < 1e-15) break ;
+      }
+      nodes[i] = -z ;
+      nodes[n-1-i] = z ;
+      weights[i] = weights[n-1-i] = 2./((1.-z*z)*dp*dp) ;
+    }
+  }
+}
+
+RooBtosllEffiModel::RooBtosllEffiModel(const char *name, const char *title,
+                       RooAbsReal& _CosThetaL,
+                       RooAbsReal& _CosThetaK,
+                       RooAbsReal& _unboundAfb,
+                       RooAbsReal& _unboundFl,
+                       RooAbsReal& _effi) :
+  RooAbsPdf(name,title),
+  CosThetaL("CosThetaL","CosThetaL",this,_CosThetaL),
+  CosThetaK("CosThetaK","CosThetaK",this,_CosThetaK),
+  unboundAfb("unboundAfb","unboundAfb",this,_unboundAfb),
+  unboundFl("unboundFl","unboundFl",this,_unboundFl),
+  effi("effi","effi",this,_effi),
+  _order(40),
+  _momentsValid(kFALSE),
+  _effiParams(0)
+{
+}
+
+
+RooBtosllEffiModel::RooBtosllEffiModel(const RooBtosllEffiModel& other, const char* name) :
+  RooAbsPdf(other,name),
+  CosThetaL("CosThetaL",this,other.CosThetaL),
+  CosThetaK("CosThetaK",this,other.CosThetaK),
+  unboundAfb("unboundAfb",this,other.unboundAfb),
+  unboundFl("unboundFl",this,other.unboundFl),
+  effi("effi",this,other.effi),
+  _order(other._order),
+  _momentsValid(kFALSE),
+  _effiParams(0)
+{
+}
+
+
+RooBtosllEffiModel::~RooBtosllEffiModel()
+{
+  delete _effiParams ;
+}
+
+
+Double_t RooBtosllEffiModel::evaluate() const
+{
+  Double_t fl, afb ;
+  RooBtosllModel::toPhysical(unboundAfb, unboundFl, afb, fl) ;
+  const Double_t l = CosThetaL, k2 = CosThetaK*CosThetaK, l2 = l*l ;
+  const Double_t sigA = (9.0/16.0)*(0.5*(1.0-fl)*(1.0-k2)*(1.0+l2) + 2.0*fl*k2*(1.0-l2) + afb*(1.0-k2)*l) ;
+  return sigA*effi ;
+}
+
+
+Int_t RooBtosllEffiModel::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  // Only the full 2D integral, projections are left to numeric integration.
+  if (matchArgs(allVars, analVars, CosThetaL, CosThetaK)) return 1 ;
+  return 0 ;
+}
+
+
+Bool_t RooBtosllEffiModel::effiChanged() const
+{
+  if (!_effiParams) {
+    _effiParams = effi.arg().getParameters(RooArgSet(CosThetaL.arg(), CosThetaK.arg())) ;
+    _effiParamValues.clear() ;
+  }
+  Bool_t changed = (_effiParamValues.size() != static_cast<size_t>(_effiParams->getSize())) ;
+  _effiParamValues.resize(_effiParams->getSize()) ;
+  TIterator* iter = _effiParams->createIterator() ;
+  Int_t idx = 0 ;
+  for (RooAbsArg* arg = (RooAbsArg*)iter->Next(); arg; arg = (RooAbsArg*)iter->Next(), ++idx) {
+    RooAbsReal* par = dynamic_cast<RooAbsReal*>(arg) ;
+    const Double_t val = par ? par->getVal() : 0. ;
+    if (val != _effiParamValues[idx]) {
+      _effiParamValues[idx] = val ;
+      changed = kTRUE ;
+    }
+  }
+  delete iter ;
+  return changed ;
+}
+
+
+void RooBtosllEffiModel::updateMoments(const char* rangeName) const
+{
+  RooAbsRealLValue* lvL = dynamic_cast<RooAbsRealLValue*>(const_cast<RooAbsReal*>(&CosThetaL.arg())) ;
+  RooAbsRealLValue* lvK = dynamic_cast<RooAbsRealLValue*>(const_cast<RooAbsReal*>(&CosThetaK.arg())) ;
+  const Double_t loL = CosThetaL.min(rangeName), hiL = CosThetaL.max(rangeName) ;
+  const Double_t loK = CosThetaK.min(rangeName), hiK = CosThetaK.max(rangeName) ;
+  const Double_t origL = lvL->getVal(), origK = lvK->getVal() ;
+
+  std::vector<Double_t> nodes, weights ;
+  gaussLegendre(_order, nodes, weights) ;
+  const Double_t halfL = 0.5*(hiL-loL), midL = 0.5*(hiL+loL) ;
+  const Double_t halfK = 0.5*(hiK-loK), midK = 0.5*(hiK+loK) ;
+
+  _moments[0] = _moments[1] = _moments[2] = 0. ;
+  for (Int_t i = 0; i < _order; ++i) {
+    const Double_t l = midL + halfL*nodes[i], l2 = l*l ;
+    lvL->setVal(l) ;
+    for (Int_t j = 0; j < _order; ++j) {
+      const Double_t k = midK + halfK*nodes[j], k2 = k*k ;
+      lvK->setVal(k) ;
+      const Double_t w = weights[i]*weights[j]*halfL*halfK*effi.arg().getVal() ;
+      _moments[0] += w*(9.0/16.0)*0.5*(1.0-k2)*(1.0+l2) ;
+      _moments[1] += w*(9.0/16.0)*2.0*k2*(1.0-l2) ;
+      _moments[2] += w*(9.0/16.0)*(1.0-k2)*l ;
+    }
+  }
+  lvL->setVal(origL) ;
+  lvK->setVal(origK) ;
+
+  _momentsBounds[0] = loL ; _momentsBounds[1] = hiL ;
+  _momentsBounds[2] = loK ; _momentsBounds[3] = hiK ;
+  _momentsValid = kTRUE ;
+}
+
+
+Double_t RooBtosllEffiModel::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  R__ASSERT(code == 1) ;
+  const Bool_t rangeChanged = _momentsBounds[0] != CosThetaL.min(rangeName) || _momentsBounds[1] != CosThetaL.max(rangeName)
+                            || _momentsBounds[2] != CosThetaK.min(rangeName) || _momentsBounds[3] != CosThetaK.max(rangeName) ;
+  if (effiChanged() || !_momentsValid || rangeChanged) {
+    updateMoments(rangeName) ;
+  }
+  Double_t fl, afb ;
+  RooBtosllModel::toPhysical(unboundAfb, unboundFl, afb, fl) ;
+  return (1.0-fl)*_moments[0] + fl*_moments[1] + afb*_moments[2] ;
+}
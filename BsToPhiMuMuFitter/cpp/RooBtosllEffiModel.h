@@ -0,0 +1,62 @@
+/*****************************************************************************
+ * Project: RooFit                                                           *
+ *                                                                           *
+ * Angular signal model times efficiency, with cached normalisation          *
+ *****************************************************************************/
+
+#ifndef ROOBTOSLLEFFIMODEL
+#define ROOBTOSLLEFFIMODEL
+
+#include <vector>
+
+#include "RooAbsPdf.h"
+#include "RooRealProxy.h"
+#include "RooAbsReal.h"
+#include "RooArgSet.h"
+
+class RooBtosllEffiModel : public RooAbsPdf {
+public:
+  RooBtosllEffiModel() {} ;
+  RooBtosllEffiModel(const char *name, const char *title,
+	      RooAbsReal& _CosThetaL,
+	      RooAbsReal& _CosThetaK,
+	      RooAbsReal& _unboundAfb,
+	      RooAbsReal& _unboundFl,
+	      RooAbsReal& _effi);
+  RooBtosllEffiModel(const RooBtosllEffiModel& other, const char* name=0) ;
+  virtual TObject* clone(const char* newname) const { return new RooBtosllEffiModel(*this,newname); }
+  virtual ~RooBtosllEffiModel() ;
+
+  Int_t getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* rangeName=0) const ;
+  Double_t analyticalIntegral(Int_t code, const char* rangeName=0) const ;
+
+  // Number of Gauss-Legendre nodes per dimension for the moments
+  void setIntegrationOrder(Int_t order) { _order = order ; _momentsValid = kFALSE ; }
+
+protected:
+
+  RooRealProxy CosThetaL ;
+  RooRealProxy CosThetaK ;
+  RooRealProxy unboundAfb ;
+  RooRealProxy unboundFl ;
+  RooRealProxy effi ;
+  Int_t _order ;
+
+  Double_t evaluate() const ;
+
+  // Moments of the efficiency with the three angular terms, see analyticalIntegral
+  void updateMoments(const char* rangeName) const ;
+  Bool_t effiChanged() const ;
+
+  mutable Bool_t _momentsValid ; //!
+  mutable Double_t _moments[3] ; //!
+  mutable Double_t _momentsBounds[4] ; //!
+  mutable RooArgSet* _effiParams ; //!
+  mutable std::vector<Double_t> _effiParamValues ; //!
+
+private:
+
+  ClassDef(RooBtosllEffiModel,1) // Angular signal model times efficiency
+};
+
+#endif
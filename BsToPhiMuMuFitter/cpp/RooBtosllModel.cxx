@@ -12,6 +12,7 @@
 #include "RooAbsReal.h" 
 #include "RooAbsCategory.h" 
 #include <math.h> 
+#include <algorithm>
 #include "TMath.h" 
 
 ClassImp(RooBtosllModel); 
@@ -50,8 +51,8 @@ Double_t RooBtosllModel::evaluate() const
 { 
   // ENTER EXPRESSION IN TERMS OF VARIABLE ARGUMENTS HERE 
   // Remark: The tranAs formula in older AN is wrong, unboundFl should be replaced with fl
-  Double_t fl = 0.5+TMath::ATan(unboundFl)/TMath::Pi() ; // [0.,1.]
-  Double_t afb = 2.0*(1.-fl)*TMath::ATan(unboundAfb)/TMath::Pi() ; // [-0.75, 0.75]
+  Double_t fl, afb ;
+  toPhysical(unboundAfb, unboundFl, afb, fl) ;
   //Double_t as = 1.78*TMath::Sqrt(3.*fs*(1.-fs)*fl)*transAs ; // [-(fs+3*fl(1-fs)), fs+3*fs*(1-fs)]
   
   //Double_t afb = (0.5-TMath::ATan(unboundFl)/TMath::Pi())*2*TMath::ATan(unboundAfb)/TMath::Pi(); 
@@ -63,3 +64,117 @@ Double_t RooBtosllModel::evaluate() const
   return result;
   // return result > 0 ? result : 0;
 } 
+
+
+void RooBtosllModel::toPhysical(Double_t uAfb, Double_t uFl, Double_t& afb, Double_t& fl)
+{
+  fl = 0.5+TMath::ATan(uFl)/TMath::Pi() ; // [0.,1.]
+  afb = 2.0*(1.-fl)*TMath::ATan(uAfb)/TMath::Pi() ; // [-0.75, 0.75]
+}
+
+
+#ifdef ROOBTOSLLMODEL_BATCH
+namespace {
+  // Element i of a batch, or the scalar value if the argument is not batched.
+  class BatchOrScalar {
+  public:
+    BatchOrScalar(RooSpan<const double> span, double scalar) : _span(span), _scalar(scalar), _isBatch(!span.empty()) { }
+    inline double operator[](std::size_t i) const { return _isBatch ? _span[i] : _scalar ; }
+    inline bool isBatch() const { return _isBatch ; }
+    inline std::size_t size() const { return _span.size() ; }
+  private:
+    RooSpan<const double> _span ;
+    double _scalar ;
+    bool _isBatch ;
+  };
+}
+
+RooSpan<double> RooBtosllModel::evaluateBatch(std::size_t begin, std::size_t batchSize) const
+{
+  // Same expression as evaluate(), written as c1*(1-K^2)*(1+L^2) + c2*K^2*(1-L^2) + c3*(1-K^2)*L
+  const RooSpan<const double> lData = CosThetaL.getValBatch(begin, batchSize) ;
+  const RooSpan<const double> kData = CosThetaK.getValBatch(begin, batchSize) ;
+  BatchOrScalar cosL(lData, CosThetaL) ;
+  BatchOrScalar cosK(kData, CosThetaK) ;
+  BatchOrScalar uAfb(unboundAfb.getValBatch(begin, batchSize), unboundAfb) ;
+  BatchOrScalar uFl(unboundFl.getValBatch(begin, batchSize), unboundFl) ;
+
+  auto output = _batchData.makeWritableBatchUnInit(begin, batchSize) ;
+  std::size_t n = output.size() ;
+  if (cosL.isBatch()) n = std::min(n, cosL.size()) ;
+  if (cosK.isBatch()) n = std::min(n, cosK.size()) ;
+
+  if (!uAfb.isBatch() && !uFl.isBatch()) {
+    // Parameter transforms once per batch
+    Double_t fl, afb ;
+    toPhysical(unboundAfb, unboundFl, afb, fl) ;
+    const double c1 = (9.0/16.0)*0.5*(1.0-fl) ;
+    const double c2 = (9.0/16.0)*2.0*fl ;
+    const double c3 = (9.0/16.0)*afb ;
+    if (cosL.isBatch() && cosK.isBatch()) {
+      // Tight loop over plain spans for the common case
+      for (std::size_t i = 0; i < n; ++i) {
+        const double l = lData[i], k2 = kData[i]*kData[i], l2 = l*l ;
+        output[i] = c1*(1.0-k2)*(1.0+l2) + c2*k2*(1.0-l2) + c3*(1.0-k2)*l ;
+      }
+    } else {
+      for (std::size_t i = 0; i < n; ++i) {
+        const double l = cosL[i], k2 = cosK[i]*cosK[i], l2 = l*l ;
+        output[i] = c1*(1.0-k2)*(1.0+l2) + c2*k2*(1.0-l2) + c3*(1.0-k2)*l ;
+      }
+    }
+  } else {
+    for (std::size_t i = 0; i < n; ++i) {
+      Double_t fl, afb ;
+      toPhysical(uAfb[i], uFl[i], afb, fl) ;
+      const double l = cosL[i], k2 = cosK[i]*cosK[i], l2 = l*l ;
+      output[i] = (9.0/16.0)*(0.5*(1.0-fl)*(1.0-k2)*(1.0+l2) + 2.0*fl*k2*(1.0-l2) + afb*(1.0-k2)*l) ;
+    }
+  }
+  return output ;
+}
+#endif
+
+
+Int_t RooBtosllModel::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  if (matchArgs(allVars, analVars, CosThetaL, CosThetaK)) return 3 ;
+  if (matchArgs(allVars, analVars, CosThetaL)) return 1 ;
+  if (matchArgs(allVars, analVars, CosThetaK)) return 2 ;
+  return 0 ;
+}
+
+
+Double_t RooBtosllModel::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  // Primitives of the angular terms
+  //   A(x) = x - x^3/3   for (1-x^2)
+  //   B(x) = x + x^3/3   for (1+x^2)
+  //   C(x) = x^3/3       for x^2
+  //   D(x) = x^2/2       for x
+  Double_t fl, afb ;
+  toPhysical(unboundAfb, unboundFl, afb, fl) ;
+
+  // Integrated primitive over the range, or the term itself if not integrated
+  Double_t facA_L, facB_L, facD_L, facA_K, facC_K ;
+  if (code & 1) {
+    const Double_t lo = CosThetaL.min(rangeName), hi = CosThetaL.max(rangeName) ;
+    const Double_t cube = (hi*hi*hi - lo*lo*lo)/3.0 ;
+    facA_L = (hi - lo) - cube ;
+    facB_L = (hi - lo) + cube ;
+    facD_L = (hi*hi - lo*lo)/2.0 ;
+  } else {
+    const Double_t l = CosThetaL ;
+    facA_L = 1.0 - l*l ; facB_L = 1.0 + l*l ; facD_L = l ;
+  }
+  if (code & 2) {
+    const Double_t lo = CosThetaK.min(rangeName), hi = CosThetaK.max(rangeName) ;
+    facC_K = (hi*hi*hi - lo*lo*lo)/3.0 ;
+    facA_K = (hi - lo) - facC_K ;
+  } else {
+    const Double_t k = CosThetaK ;
+    facA_K = 1.0 - k*k ; facC_K = k*k ;
+  }
+
+  return (9.0/16.0)*(0.5*(1.0-fl)*facA_K*facB_L + 2.0*fl*facC_K*facA_L + afb*facA_K*facD_L) ;
+}
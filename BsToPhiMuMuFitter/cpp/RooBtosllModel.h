@@ -12,6 +12,12 @@
 #include "RooCategoryProxy.h"
 #include "RooAbsReal.h"
 #include "RooAbsCategory.h"
+#include "RVersion.h"
+// evaluateBatch/getValBatch exist in 6.20 and 6.21 only, 6.22 moved to evaluateSpan with RunContext
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,20,0) && ROOT_VERSION_CODE < ROOT_VERSION(6,22,0)
+#define ROOBTOSLLMODEL_BATCH
+#include "RooSpan.h"
+#endif
  
 class RooBtosllModel : public RooAbsPdf {
 public:
@@ -27,6 +33,12 @@ public:
   virtual TObject* clone(const char* newname) const { return new RooBtosllModel(*this,newname); }
   inline virtual ~RooBtosllModel() { }
 
+  Int_t getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* rangeName=0) const ;
+  Double_t analyticalIntegral(Int_t code, const char* rangeName=0) const ;
+
+  // fl in [0, 1] and afb in [-0.75, 0.75] from the unbounded fit parameters
+  static void toPhysical(Double_t uAfb, Double_t uFl, Double_t& afb, Double_t& fl) ;
+
 protected:
 
   RooRealProxy CosThetaL ;
@@ -37,6 +49,9 @@ protected:
   RooRealProxy transAs ;*/
   
   Double_t evaluate() const ;
+#ifdef ROOBTOSLLMODEL_BATCH
+  RooSpan<double> evaluateBatch(std::size_t begin, std::size_t batchSize) const ;
+#endif
 
 private:
 
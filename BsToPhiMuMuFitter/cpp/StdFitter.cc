@@ -7,9 +7,18 @@
 #include "RooDataHist.h"
 
 #include "RooMinuit.h"
+#include "RooMinimizer.h"
 #include "RooFitResult.h"
 #include "RooLinkedList.h"
 #include "RooArgSet.h"
+#include "RooCmdArg.h"
+#include "RooGlobalFunc.h"
+#include "RVersion.h"
+
+#include <cmath>
+#include <string>
+#include <vector>
+#include <utility>
 
 
 #ifndef STDFITTER_H
@@ -21,24 +30,58 @@ public:
     virtual ~StdFitter();
 
     void addNLLOpt(RooCmdArg*);
-    RooMinuit* Init(RooAbsPdf*, RooDataSet*);
+    void SetOptimizeConst(int flag){optimizeConst = flag;}
+    void SetNumCPU(int nCPU, int strategy=0);
+    void SetBatchMode(bool flag);
+    void SetOffsetting(bool flag);
+    void SetMinimizerType(const char* type){minimizerType = type;}
+    void AddLadderStep(int strategy, double tolerance){ladder.push_back(std::make_pair(strategy, tolerance));}
+    void ClearLadder(){ladder.clear();}
+    void SetEdmMax(double val){edmMax = val;}
+    void SetSimplexFallback(bool flag){simplexFallback = flag;}
+    void SetPrintLevel(int level){printLevel = level;}
+    TObject* Init(RooAbsPdf*, RooDataSet*); // The minimizer in use, RooMinuit or RooMinimizer
     RooMinuit* Init(RooAbsReal*, RooDataHist*);
+    bool SetData(RooAbsData*);
+    void NotifyConstChange();
     RooFitResult* FitMigrad();
     void FitHesse();
     RooFitResult* FitMinos(RooArgSet&);
+    RooFitResult* Save();
 
     RooAbsReal* GetNLL(){return nll;}
-    RooMinuit* GetMinuit(){return minuit;}
+    RooMinuit* GetMinuit(){return minuit;}          // Null unless the "Minuit" backend is booked
+    RooMinimizer* GetMinimizer(){return minimizer;} // Null with the "Minuit" backend and for chi2 fits
 private:
-    RooMinuit *minuit = 0;
+    RooMinuit *minuit = 0;         // "Minuit" backend, deprecated
+    RooMinimizer *minimizer = 0;   // Any other backend, e.g. "Minuit2"
+    std::string minimizerType = "Minuit2";
+    std::vector<std::pair<int, double> > ladder; // (strategy, tolerance), tried in order
+    double edmMax = 1e-3;
+    bool simplexFallback = true;
+    int printLevel = 1;
+    template<class M> void setupMinimizer(M*);
+    template<class M> RooFitResult* runMigradLadder(M*);
+    double setTolerance(RooMinimizer*, double);
+    double setTolerance(RooMinuit*, double);
+    template<class M> RooFitResult* runMinos(M*, RooArgSet&);
+    bool isGoodMigrad(int status, const RooFitResult*, double tolerance=1.) const;
     RooAbsReal *nll = 0;
     RooLinkedList createNLLOpt;
+    int optimizeConst = 0; // Cache nodes depending only on observables and constant parameters
+    // Owned here such that the linked list never points to a python-side temporary
+    RooCmdArg numCPUArg;
+    RooCmdArg batchModeArg;
+    RooCmdArg offsetArg;
+    RooLinkedList buildOpt(bool forChi2=false);
 };
 
 StdFitter::StdFitter(){}
 StdFitter::~StdFitter(){
     delete minuit;
     minuit = 0;
+    delete minimizer;
+    minimizer = 0;
 }
 
 void StdFitter::addNLLOpt(RooCmdArg *cmd){
@@ -46,49 +89,173 @@ void StdFitter::addNLLOpt(RooCmdArg *cmd){
     this->createNLLOpt.Add(cmd);
 }
 
-RooMinuit* StdFitter::Init(RooAbsPdf* pdf, RooDataSet* data){
-    nll = pdf->createNLL(*data, this->createNLLOpt);
-    minuit = new RooMinuit(*nll);
+void StdFitter::SetNumCPU(int nCPU, int strategy){
+    numCPUArg = nCPU > 1 ? RooFit::NumCPU(nCPU, strategy) : RooCmdArg::none();
+}
+
+void StdFitter::SetBatchMode(bool flag){
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,20,0)
+    batchModeArg = flag ? RooFit::BatchMode(kTRUE) : RooCmdArg::none();
+#else
+    if (flag) std::cout << "WARNING\t: BatchMode requires ROOT 6.20 or later, ignored." << std::endl;
+    batchModeArg = RooCmdArg::none();
+#endif
+}
+
+void StdFitter::SetOffsetting(bool flag){
+    offsetArg = flag ? RooFit::Offset(kTRUE) : RooCmdArg::none();
+}
+
+RooLinkedList StdFitter::buildOpt(bool forChi2){
+    RooLinkedList opts(this->createNLLOpt);
+    if (numCPUArg.GetName()[0]) opts.Add(&numCPUArg);
+    if (forChi2) return opts;  // RooChi2Var supports neither batch mode nor offsetting
+    if (batchModeArg.GetName()[0]) opts.Add(&batchModeArg);
+    if (offsetArg.GetName()[0]) opts.Add(&offsetArg);
+    return opts;
+}
+
+TObject* StdFitter::Init(RooAbsPdf* pdf, RooDataSet* data){
+    RooLinkedList opts = buildOpt();
+    nll = pdf->createNLL(*data, opts);
+    if (minimizerType == "Minuit") {
+        minuit = new RooMinuit(*nll);
+        setupMinimizer(minuit);
+    } else {
+        minimizer = new RooMinimizer(*nll);
+        minimizer->setMinimizerType(minimizerType.c_str());
+        setupMinimizer(minimizer);
+    }
     //minuit->setPrintLevel(3); //Pritam
+    if (minimizer) return minimizer;
     return minuit;
 }
 
+bool StdFitter::SetData(RooAbsData* data){
+    // Keep the NLL graph and minimizer, the caller keeps data alive.
+    bool isOk = nll->setData(*data, kFALSE);
+    if (isOk && optimizeConst) {
+        // Rebuild the cache of constant terms for the new events
+        if (minimizer) {
+            minimizer->optimizeConst(0);
+            minimizer->optimizeConst(optimizeConst);
+        } else if (minuit) {
+            minuit->optimizeConst(0);
+            minuit->optimizeConst(optimizeConst);
+        }
+    }
+    return isOk;
+}
+
+void StdFitter::NotifyConstChange(){
+    // Constant parameters changed value outside the minimizer, refresh the cached terms before nll->getVal().
+    // The minimizers detect such changes by themselves.
+    if (nll && optimizeConst) nll->constOptimizeTestStatistic(RooAbsArg::ValueChange);
+}
+
+template<class M>
+void StdFitter::setupMinimizer(M* m){
+    if (optimizeConst) m->optimizeConst(optimizeConst);
+    m->setPrintLevel(printLevel);
+}
+
 RooMinuit* StdFitter::Init(RooAbsReal* pdf, RooDataHist* data){
     std::cout<<"CPP-StdFitter Init Begin:::::"<<std::endl;
-    nll = pdf->createChi2(*data, this->createNLLOpt);
+    RooLinkedList opts = buildOpt(true);
+    nll = pdf->createChi2(*data, opts);
     minuit = new RooMinuit(*nll);
     return minuit;
 }
 
-RooFitResult* StdFitter::FitMigrad(){
-    int isMigradConverge{-1};
+bool StdFitter::isGoodMigrad(int status, const RooFitResult *res, double tolerance) const{
+    // MIGRAD aims at edm < 0.002*tolerance*up, the acceptance scales along with a looser rung.
+    return status == 0 && fabs(res->minNll()) < 1e20 && res->edm() < edmMax * tolerance;
+}
+
+double StdFitter::setTolerance(RooMinimizer* m, double tolerance){
+    m->setEps(tolerance);
+    return tolerance;
+}
+
+double StdFitter::setTolerance(RooMinuit* m, double tolerance){
+    // RooMinuit::setEps is SET EPS (machine precision) and RooMinuit::migrad() always runs with tolerance 1.
+    if (tolerance != 1.) std::cout << "WARNING\t: Tolerance " << tolerance << " is not supported by RooMinuit, 1 is used." << std::endl;
+    return 1.;
+}
+
+template<class M>
+RooFitResult* StdFitter::runMigradLadder(M* m){
+    int status{-1};
     RooFitResult *res = 0;
-    for (int iL = 0; iL < 10; iL++) {
-        isMigradConverge = this->minuit->migrad();
-        
-        //isMigradConverge->printArgs(std::cout); //Pritam
-        res = this->minuit->save();
-        if (isMigradConverge == 0 && fabs(res->minNll()) < 1e20){
-            break;
+    if (ladder.empty()) {
+        // Legacy behaviour, retry with the default strategy.
+        for (int iL = 0; iL < 10; iL++) {
+            status = m->migrad();
+            delete res;
+            res = m->save();
+            if (status == 0 && fabs(res->minNll()) < 1e20) break;
         }
+        return res;
     }
-    return res;
-}
 
-void StdFitter::FitHesse(){
-    this->minuit->hesse();
+    // Each step starts from where the previous one stopped.
+    for (auto &step : ladder) {
+        m->setStrategy(step.first);
+        double tolerance = setTolerance(m, step.second);
+        status = m->migrad();
+        delete res;
+        res = m->save();
+        if (isGoodMigrad(status, res, tolerance)) return res;
+        std::cout << "StdFitter: MIGRAD with strategy " << step.first << ", tolerance " << step.second
+                  << " ended with status " << status << ", edm " << res->edm() << std::endl;
+    }
+
+    if (simplexFallback) {
+        // Move out of the problematic region, then polish with the last rung.
+        m->simplex();
+        status = m->migrad();
+        delete res;
+        res = m->save();
+        std::cout << "StdFitter: MIGRAD after SIMPLEX ended with status " << status << ", edm " << res->edm() << std::endl;
+    }
+    return res;
 }
 
-RooFitResult* StdFitter::FitMinos(RooArgSet& args){
+template<class M>
+RooFitResult* StdFitter::runMinos(M* m, RooArgSet& args){
     int isMinosValid{-1};
     RooFitResult *res = 0;
     for (int iL = 0; iL < 3; iL++) {
-        isMinosValid = this->minuit->minos(args);
-        res = this->minuit->save();
+        isMinosValid = m->minos(args);
+        delete res;
+        res = m->save();
         if (isMinosValid == 0 && fabs(res->minNll()) < 1e20){
             break;
         }
     }
     return res;
 }
+
+RooFitResult* StdFitter::FitMigrad(){
+    if (minimizer) return runMigradLadder(minimizer);
+    return runMigradLadder(minuit);
+}
+
+void StdFitter::FitHesse(){
+    if (minimizer) {
+        minimizer->hesse();
+    } else {
+        this->minuit->hesse();
+    }
+}
+
+RooFitResult* StdFitter::FitMinos(RooArgSet& args){
+    if (minimizer) return runMinos(minimizer, args);
+    return runMinos(minuit, args);
+}
+
+RooFitResult* StdFitter::Save(){
+    if (minimizer) return minimizer->save();
+    return minuit->save();
+}
 #endif
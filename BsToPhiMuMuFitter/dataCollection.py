@@ -2,13 +2,14 @@
 # -*- coding: utf-8 -*-
 # vim: set sw=4 ts=4 fdm=indent foldnestmax=3 ft=python et:
 
-import re, pdb
+import os, re, pdb
 import types
 import functools
 import itertools
 from array import array
 from copy import copy
 import math
+import time
 
 import BsToPhiMuMuFitter.cpp
 
@@ -29,6 +30,7 @@ CFG = DataReader.templateConfig()
 CFG.update({
     'argset': dataArgs,
     'lumi': -1,  # Keep a record, useful for mixing simulations samples
+    'preloadCache': modulePath + "/data/preloadCache",
     #'ifriendIndex': ["Bmass", "Mumumass"],
 })
 
@@ -119,126 +121,135 @@ accXEffThetaLBins = array('d', [-1., -0.8, -0.6, -0.4, -0.2, 0., 0.2, 0.4, 0.6,
 accXEffThetaKBins = array('d', [-1., -0.8, -0.6, -0.4, -0.2, 0., 0.2, 0.4, 0.6, 0.8, 1.])
 #accXEffThetaLBins = array('d', [-1, -0.7, -0.3, 0., 0.3, 0.7, 1.])
 #accXEffThetaKBins = array('d', [-1, -0.7, 0., 0.4, 0.8, 1.])
+def fillEffiHists(samples, nThreads=1):
+    """Fill the 2D histograms of several samples, with one event loop per sample.
+
+    samples is a list of (ifiles, treeName, hists), hists a list of (name, cutString, fillXY, binning).
+    All histograms of a sample are booked as lazy actions of the same RDataFrame, so its files are read once.
+    nThreads > 1 enables implicit MT for the loops, 0 for all cores, only if it is not enabled by the caller already.
+    Return a dict of name to the filled TH2D."""
+    enableMT = nThreads != 1 and not ROOT.ROOT.IsImplicitMTEnabled()
+    if enableMT:
+        ROOT.ROOT.EnableImplicitMT(nThreads)
+
+    results = {}
+    keepAlive = []
+    for ifiles, treeName, hists in samples:
+        if not hists:
+            continue
+        treein = TChain(treeName)
+        for f in ifiles:
+            treein.Add(f)
+        df = ROOT.RDataFrame(treein)
+        filtered = {}
+        for name, cutString, fillXY, binning in hists:
+            if cutString not in filtered:
+                filtered[cutString] = df.Filter(cutString)
+            fillY, fillX = fillXY.split(':')
+            results[name] = filtered[cutString].Histo2D((name, "") + binning, fillX, fillY)
+        keepAlive.append((treein, df, filtered))
+
+    startTime = time.time()
+    hists = {}
+    for name, ptr in results.items():
+        hists[name] = ptr.GetValue().Clone(name)  # The 1st GetValue of a sample runs its loop
+        hists[name].SetDirectory(0)
+    print("INFO\t: {0} histogram(s) of {1} sample(s) filled in {2:.1f} s".format(len(hists), len(keepAlive), time.time() - startTime))
+    if enableMT:
+        ROOT.ROOT.DisableImplicitMT()
+    return hists
+
+def effiHistBinnings(fineBins):
+    """Binnings of the 2D and fine histograms"""
+    return [
+        ("", (len(accXEffThetaLBins) - 1, accXEffThetaLBins, len(accXEffThetaKBins) - 1, accXEffThetaKBins)),
+        ("_fine", (fineBins, -1., 1., fineBins, -1., 1.)),
+    ]
+
+def writeEffiObjects(fin, outputs):
+    """Write (obj, name) pairs and flush once at the end.
+    Not atomic, a crash in between leaves the objects written so far, they are rebuilt in the next run only if a checked one is missing."""
+    fin.ReOpen("UPDATE")
+    fin.cd()
+    for obj, name in outputs:
+        obj.Write(name, ROOT.TObject.kOverwrite)
+    fin.Flush()
+    fin.ReOpen("READ")
+
+def openEffiFile(self, fname):
+    """Open read-only if fname exists, such that bins running in parallel only read it once built, see writeEffiObjects"""
+    return self.process.filemanager.open("buildAccXRecEffiHist", fname, "READ" if os.path.exists(fname) else "UPDATE")
+
 def buildTotalEffiHist(self):
     """Build efficiency histogram for later fitting/plotting"""
-    print("Now I am Here in buildAccXRecEffiHist")
-    fin = self.process.filemanager.open("buildAccXRecEffiHist", modulePath + "/data/accXrecEffHists_Run2016.root", "UPDATE")
+    fin = openEffiFile(self, modulePath + "/data/accXrecEffHists_Run2016.root")
 
-    # Build acceptance, reco efficiency, and accXrec
+    # Build accXrec of all bins missing from the file at once, each input sample read once
     forceRebuild = False
-    for binKey in q2bins.keys():
-        print q2bins.keys()
-        if binKey in ['jpsi', 'psi2s', 'peaks']:
-            continue
-        h2_accXrec = fin.Get("h2_accXrec1_{0}".format(binKey))
-        if h2_accXrec == None or forceRebuild:
-            print "\n\n", binKey, "\n\n"
-            #h2_acc = fin.Get("h2_acc_{0}".format(binKey))
-            #h2_rec = fin.Get("h2_rec_{0}".format(binKey))
-            h2_accXrec=fin.Get("h2_accXrec1_{0}".format(binKey)) #Total Eff
-
-            # Fill histograms
-            setupEfficiencyBuildProcedure = {}
-            setupEfficiencyBuildProcedure['acc'] = {
-                'ifiles': UnfilteredMC,
-                'baseString': re.sub("Mumumass", "sqrt(genQ2)", q2bins[binKey]['cutString']),
-                'cutString': "fabs(genMupEta)<2.2 && fabs(genMumEta)<2.2 && genMupPt>3.9 && genMumPt>3.9", # && KpPt>0.5 && KmPt>0.5 && fabs(KpEta)<2.4 && fabs(KmEta)<2.4",
-                'fillXY': "genCosThetaK:genCosThetaL"  # Y:X
-            }
-            setupEfficiencyBuildProcedure['rec'] = {
-                'ifiles': sigMCReader.cfg['ifile'],
-                'baseString': re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']),
-                'cutString': "({0}) && ({1}) && (Bmass > 4.7) && ({2})".format(cuts[-1], re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']), baseSel),
-                'fillXY': "CosThetaK:CosThetaL"  # Y:X
-            }
-            i=0 #testing events
-            h2=h2_accXrec; label='accXrec'  #, label in ((h2_accXrec, 'accXrec')):
-            if h2 == None or forceRebuild:
-                print("h2: ", h2, label)
-                print "BaseSTring: ", setupEfficiencyBuildProcedure['acc']['baseString']
-                print "CutString: ", setupEfficiencyBuildProcedure["rec"]['cutString']
-
-                treein = TChain() #flie=ROOT.TFile.Open(f); #treein.SetName(flie.GetListOfKeys().At(0).GetName())
-                for f in setupEfficiencyBuildProcedure['acc']['ifiles']:
-                    treein.Add(f);   print(f)
-                treein.Draw(">>totEvtList", setupEfficiencyBuildProcedure['acc']['baseString'])
-                totEvtList = ROOT.gDirectory.Get("totEvtList"); totEvtList.Print() #Pritam
-
-                treeinPassed = TChain()
-                for f in setupEfficiencyBuildProcedure['rec']['ifiles']:
-                    treeinPassed.Add(f);    print(f)
-                treeinPassed.Draw(">>accEvtList", setupEfficiencyBuildProcedure['rec']['cutString'])
-                accEvtList = ROOT.gDirectory.Get("accEvtList"); accEvtList.Print()
-
-                h2_total = TH2D("h2_{0}_{1}_total".format(label, binKey), "", len(accXEffThetaLBins) - 1, accXEffThetaLBins, len(accXEffThetaKBins) - 1, accXEffThetaKBins)
-                h2_passed = h2_total.Clone("h2_{0}_{1}_passed".format(label, binKey))
-
-                h2_fine_total = TH2D("h2_{0}_fine_{1}_total".format(label, binKey), "", 20, -1, 1, 20, -1, 1)
-                h2_fine_passed = h2_fine_total.Clone("h2_{0}_fine_{1}_passed".format(label, binKey))
-
-                treein.SetEventList(totEvtList)
-                for hist in h2_total, h2_fine_total:
-                    treein.Draw("{0}>>{1}".format(setupEfficiencyBuildProcedure['acc']['fillXY'], hist.GetName()), "", "goff")
-
-                treeinPassed.SetEventList(accEvtList)
-                for hist in h2_passed, h2_fine_passed:
-                    treeinPassed.Draw("{0}>>{1}".format(setupEfficiencyBuildProcedure['rec']['fillXY'], hist.GetName()), "", "goff")
-
-                h2_eff = TEfficiency(h2_passed, h2_total)
-                h2_eff_fine = TEfficiency(h2_fine_passed, h2_fine_total)
-
-                fin.cd()
-                for proj, var in [("ProjectionX", CosThetaL), ("ProjectionY", CosThetaK)]:
-                    proj_fine_total = getattr(h2_fine_total, proj)("{0}_{1}".format(h2_fine_total.GetName(), proj), 0, -1, "e")
-                    proj_fine_passed = getattr(h2_fine_passed, proj)("{0}_{1}".format(h2_fine_passed.GetName(), proj), 0, -1, "e")
-                    h_eff = TEfficiency(proj_fine_passed, proj_fine_total)
-                    h_eff.Write("h_{0}_fine_{1}_{2}".format(label, binKey, proj), ROOT.TObject.kOverwrite)
-
-                h2_eff.Write("h2Eff_{0}_{1}".format(label, binKey), ROOT.TObject.kOverwrite)           #Binned 2D Eff
-                h2_eff_fine.Write("h2_{0}_fine_{1}".format(label, binKey), ROOT.TObject.kOverwrite) #2D Efficiency Total 
-
-            # : Converting TEff to TH1D
-            fin.cd()
+    label = 'accXrec'
+    binKeys = [binKey for binKey in q2bins.keys() if binKey not in ['jpsi', 'psi2s', 'peaks'] and (forceRebuild or fin.Get("h2_accXrec1_{0}".format(binKey)) == None)]
+    if binKeys:
+        print("INFO\t: Build efficiency maps of {0}".format(binKeys))
+        totalHists = []
+        passedHists = []
+        for binKey in binKeys:
+            genCut = re.sub("Mumumass", "sqrt(genQ2)", q2bins[binKey]['cutString'])
+            recCut = "({0}) && ({1}) && (Bmass > 4.7) && ({2})".format(cuts[-1], re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']), baseSel)
+            for suffix, binning in effiHistBinnings(20):
+                totalHists.append(("h2_{0}{1}_{2}_total".format(label, suffix, binKey), genCut, "genCosThetaK:genCosThetaL", binning))  # Y:X
+                passedHists.append(("h2_{0}{1}_{2}_passed".format(label, suffix, binKey), recCut, "CosThetaK:CosThetaL", binning))
+        hists = fillEffiHists([(UnfilteredMC, "", totalHists), (sigMCReader.cfg['ifile'], "", passedHists)])
+
+        outputs = []
+        for binKey in binKeys:
+            h2_total = hists["h2_{0}_{1}_total".format(label, binKey)]
+            h2_passed = hists["h2_{0}_{1}_passed".format(label, binKey)]
+            h2_fine_total = hists["h2_{0}_fine_{1}_total".format(label, binKey)]
+            h2_fine_passed = hists["h2_{0}_fine_{1}_passed".format(label, binKey)]
+            h2_eff = TEfficiency(h2_passed, h2_total)
+            h2_eff_fine = TEfficiency(h2_fine_passed, h2_fine_total)
+            outputs.append((h2_eff, "h2Eff_{0}_{1}".format(label, binKey)))            #Binned 2D Eff
+            outputs.append((h2_eff_fine, "h2_{0}_fine_{1}".format(label, binKey)))    #2D Efficiency Total
+
+            # Converting TEff to TH1D
             for proj in ["ProjectionX", "ProjectionY"]:
-                #h_acc_fine = fin.Get("h_acc_fine_{0}_{1}".format(binKey, proj))
-                #h_rec_fine = fin.Get("h_rec_fine_{0}_{1}".format(binKey, proj))
-                h_accXrec_fineEff = fin.Get("h_accXrec_fine_{0}_{1}".format(binKey, proj))
+                proj_fine_total = getattr(h2_fine_total, proj)("{0}_{1}".format(h2_fine_total.GetName(), proj), 0, -1, "e")
+                proj_fine_passed = getattr(h2_fine_passed, proj)("{0}_{1}".format(h2_fine_passed.GetName(), proj), 0, -1, "e")
+                h_accXrec_fineEff = TEfficiency(proj_fine_passed, proj_fine_total)
+                outputs.append((h_accXrec_fineEff, "h_{0}_fine_{1}_{2}".format(label, binKey, proj)))
                 h_accXrec_fine = h_accXrec_fineEff.GetPassedHistogram().Clone("h_accXrec_fine_{0}_{1}".format(binKey, proj))
                 h_accXrec_fine.Reset("ICESM")
                 for b in range(1, h_accXrec_fine.GetNbinsX() + 1):
                     h_accXrec_fine.SetBinContent(b, h_accXrec_fineEff.GetEfficiency(b))
                     h_accXrec_fine.SetBinError(b, h_accXrec_fine.GetBinContent(b) * math.sqrt(1 / h_accXrec_fineEff.GetTotalHistogram().GetBinContent(b) + 1 / h_accXrec_fineEff.GetPassedHistogram().GetBinContent(b)))
-                h_accXrec_fine.Write("h_accXrec_{0}_{1}".format(binKey, proj), ROOT.TObject.kOverwrite)
+                outputs.append((h_accXrec_fine, "h_accXrec_{0}_{1}".format(binKey, proj)))
 
-            #h2_acc = fin.Get("h2_acc_{0}".format(binKey))
-            #h2_rec = fin.Get("h2_rec_{0}".format(binKey))
-            h2_accXrecEff1 = fin.Get("h2Eff_accXrec_{0}".format(binKey))        #2D Binned Eff
-            h2_accXrec1 = h2_accXrecEff1.GetPassedHistogram().Clone("h2_accXrec1_{0}".format(binKey)); print "Before Converting: ", type(h2_accXrecEff1), type(h2_accXrec1)
+            h2_accXrec1 = h2_eff.GetPassedHistogram().Clone("h2_accXrec1_{0}".format(binKey))
             h2_accXrec1.Reset("ICESM")
             for iL, iK in itertools.product(range(1, len(accXEffThetaLBins)), range(1, len(accXEffThetaKBins))):
-                if h2_accXrecEff1.GetTotalHistogram().GetBinContent(iL, iK) == 0:
+                if h2_eff.GetTotalHistogram().GetBinContent(iL, iK) == 0:
                     h2_accXrec1.SetBinContent(iL, iK, 0)
                     h2_accXrec1.SetBinError(iL, iK, 1)
                 else:
-                    iLK = h2_accXrecEff1.GetGlobalBin(iL, iK)
-                    h2_accXrec1.SetBinContent(iL, iK, h2_accXrecEff1.GetEfficiency(iLK))
-                    h2_accXrec1.SetBinError(iL, iK, h2_accXrec1.GetBinContent(iL, iK) * math.sqrt(1. / h2_accXrecEff1.GetTotalHistogram().GetBinContent(iLK) + 1. / h2_accXrecEff1.GetPassedHistogram().GetBinContent(iLK)))
+                    iLK = h2_eff.GetGlobalBin(iL, iK)
+                    h2_accXrec1.SetBinContent(iL, iK, h2_eff.GetEfficiency(iLK))
+                    h2_accXrec1.SetBinError(iL, iK, h2_accXrec1.GetBinContent(iL, iK) * math.sqrt(1. / h2_eff.GetTotalHistogram().GetBinContent(iLK) + 1. / h2_eff.GetPassedHistogram().GetBinContent(iLK)))
             h2_accXrec1.SetXTitle("cos#theta_{l}")
             h2_accXrec1.SetYTitle("cos#theta_{K}")
             h2_accXrec1.SetZTitle("Overall efficiency")
-            h2_accXrec1.Write("h2_accXrec1_{0}".format(binKey), ROOT.TObject.kOverwrite)
-            self.logger.logINFO("Overall efficiency is built.")
+            outputs.append((h2_accXrec1, "h2_accXrec1_{0}".format(binKey)))
 
-            h2_accXrecEff = fin.Get("h2Eff_accXrec_{0}".format(binKey))        #2D Binned Eff: Same as h2_accXrec1_binKey, but using CreateHistogram()
-            h2_accXrec = h2_accXrecEff.CreateHistogram(); h2_accXrec.SetTitle("Created from CreateHistogram() method")
+            h2_accXrec = h2_eff.CreateHistogram()  # Same as h2_accXrec1_binKey, but using CreateHistogram()
+            h2_accXrec.SetTitle("Created from CreateHistogram() method")
             h2_accXrec.SetXTitle("cos#theta_{l}")
             h2_accXrec.SetYTitle("cos#theta_{K}")
             h2_accXrec.SetZTitle("Overall efficiency")
-            h2_accXrec.Write("h2_accXrec_{0}".format(binKey), ROOT.TObject.kOverwrite)  # We are not going to use this as of now
-            self.logger.logINFO("Overall efficiency is built.")
+            outputs.append((h2_accXrec, "h2_accXrec_{0}".format(binKey)))  # We are not going to use this as of now
+        writeEffiObjects(fin, outputs)
+        self.logger.logINFO("Overall efficiency is built.")
 
     # Register the chosen one to sourcemanager
-    h2_accXrec = fin.Get("h2_accXrec1_{0}".format(self.process.cfg['binKey'])); print "Getting From File: ", type(h2_accXrec), "h2_accXrec1_{0}".format(self.process.cfg['binKey'])
+    h2_accXrec = fin.Get("h2_accXrec1_{0}".format(self.process.cfg['binKey']))
     self.cfg['source']['effiHistReader.h2_accXrec'] = h2_accXrec
     self.cfg['source']['effiHistReader.accXrec'] = RooDataHist("accXrec", "", RooArgList(CosThetaL, CosThetaK), ROOT.RooFit.Import(h2_accXrec)) # Effi 2D RooDataHist
     self.cfg['source']['effiHistReader.h_accXrec_fine_ProjectionX'] = fin.Get("h_accXrec_{0}_ProjectionX".format(self.process.cfg['binKey'])) #Effi of CosThetaL
@@ -251,118 +262,96 @@ def buildAccXRecEffiHist(self):
     if self.process.cfg['binKey'] not in targetBins:
         return
 
-    fin = self.process.filemanager.open("buildAccXRecEffiHist", modulePath + "/data/accXrecEffHists_Run2012.root", "UPDATE")
-    #pdb.set_trace()
-    # Build acceptance, reco efficiency, and accXrec
+    fin = openEffiFile(self, modulePath + "/data/accXrecEffHists_Run2012.root")
+    # Build acceptance, reco efficiency, and accXrec of all target bins missing from the file at once
     forceRebuild = False
 
-    binKey = self.process.cfg['binKey']
-    h2_accXrec = fin.Get("h2_accXrec_{0}".format(binKey))
-    if h2_accXrec == None or forceRebuild:
-        h2_acc = fin.Get("h2_acc_{0}".format(binKey))
-        h2_rec = fin.Get("h2_rec_{0}".format(binKey))
-
+    binKeys = [binKey for binKey in targetBins if forceRebuild or fin.Get("h2_accXrec_{0}".format(binKey)) == None]
+    if binKeys:
         # Fill histograms
-        setupEfficiencyBuildProcedure = {}
-        setupEfficiencyBuildProcedure['acc'] = {
-            'ifiles': [] if binKey in ['jpsi', 'psi2s'] else UnfilteredMC,
-            'baseString': re.sub("Mumumass", "sqrt(genQ2)", q2bins[binKey]['cutString']),
-            'cutString': "({0}) && fabs(genMupEta)<2.2 && fabs(genMumEta)<2.2 && genMupPt>4.0 && genMumPt>4.0".format(re.sub("Mumumass", "sqrt(genQ2)", q2bins[binKey]['cutString'])),
-            'fillXY': "genCosThetaK:genCosThetaL",  # Y:X
-            'weight': None
-        }
-        setupEfficiencyBuildProcedure['rec'] = {
-            'ifiles': sigMCReader.cfg['ifile'],
-            'baseString': "({0}) && ({1})".format(re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']), baseSel), #"{0}".format(setupEfficiencyBuildProcedure['acc']['baseString']),
-            'cutString': "(Bmass > 4.7) && ({0}) && ({1}) && ({2})".format(cuts_antiResVeto if binKey in ['jpsi', 'psi2s'] else cuts[-1], re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']), baseSel),
-            'fillXY': "CosThetaK:CosThetaL",  # Y:X
-            'weight': None
-        }
-        for h2, label in (h2_acc, 'acc'), (h2_rec, 'rec'):
-            if h2 == None or forceRebuild:
-                treein = TChain("tree")
-                for f in setupEfficiencyBuildProcedure[label]['ifiles']:
-                    treein.Add(f)
-
-                if setupEfficiencyBuildProcedure[label]['weight'] is None:
-                    df_tot = ROOT.RDataFrame(treein).Define('weight', "1").Filter(setupEfficiencyBuildProcedure[label]['baseString'])
-                else:
-                    df_tot = ROOT.RDataFrame(treein).Define('weight', *setupEfficiencyBuildProcedure[label]['weight']).Filter(setupEfficiencyBuildProcedure[label]['baseString'])
-                df_acc = df_tot.Filter(setupEfficiencyBuildProcedure[label]['cutString'])
-
-                fillXY = setupEfficiencyBuildProcedure[label]['fillXY'].split(':')
-                h2_total_config = ("h2_{0}_{1}_total".format(label, binKey), "", len(accXEffThetaLBins) - 1, accXEffThetaLBins, len(accXEffThetaKBins) - 1, accXEffThetaKBins)
-                h2_passed_config  = ("h2_{0}_{1}_passed".format(label, binKey), "", len(accXEffThetaLBins) - 1, accXEffThetaLBins, len(accXEffThetaKBins) - 1, accXEffThetaKBins)
-                h2_fine_total_config = ("h2_{0}_fine_{1}_total".format(label, binKey), "", 10, -1, 1, 10, -1, 1)
-                h2_fine_passed_config = ("h2_{0}_fine_{1}_passed".format(label, binKey), "", 10, -1, 1, 10, -1, 1)
-
-                h2ptr_total = df_tot.Histo2D(h2_total_config, fillXY[1], fillXY[0], "weight")
-                h2ptr_passed = df_acc.Histo2D(h2_passed_config, fillXY[1], fillXY[0], "weight")
-                h2ptr_fine_total = df_tot.Histo2D(h2_fine_total_config, fillXY[1], fillXY[0], "weight")
-                h2ptr_fine_passed = df_acc.Histo2D(h2_fine_passed_config, fillXY[1], fillXY[0], "weight")
-
-                h2_total = h2ptr_total.GetValue()
-                h2_passed = h2ptr_passed.GetValue()
-                h2_fine_total = h2ptr_fine_total.GetValue()
-                h2_fine_passed = h2ptr_fine_passed.GetValue()
-
-                print("{0}/{1}".format(df_acc.Count().GetValue(), df_tot.Count().GetValue()))
-                h2_eff = TEfficiency(h2_passed, h2_total)
-                h2_eff_fine = TEfficiency(h2_fine_passed, h2_fine_total)
-
-                #pdb.set_trace()
-                fin.cd()
-                for proj, var in [("ProjectionX", CosThetaL), ("ProjectionY", CosThetaK)]:
+        sampleHists = {'acc': [], 'rec': []}
+        for binKey in binKeys:
+            setupEfficiencyBuildProcedure = {}
+            setupEfficiencyBuildProcedure['acc'] = {
+                'baseString': re.sub("Mumumass", "sqrt(genQ2)", q2bins[binKey]['cutString']),
+                'cutString': "({0}) && fabs(genMupEta)<2.2 && fabs(genMumEta)<2.2 && genMupPt>4.0 && genMumPt>4.0".format(re.sub("Mumumass", "sqrt(genQ2)", q2bins[binKey]['cutString'])),
+                'fillXY': "genCosThetaK:genCosThetaL",  # Y:X
+            }
+            setupEfficiencyBuildProcedure['rec'] = {
+                'baseString': "({0}) && ({1})".format(re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']), baseSel), #"{0}".format(setupEfficiencyBuildProcedure['acc']['baseString']),
+                'cutString': "(Bmass > 4.7) && ({0}) && ({1}) && ({2})".format(cuts_antiResVeto if binKey in ['jpsi', 'psi2s'] else cuts[-1], re.sub("Mumumass", "sqrt(Q2)", q2bins[binKey]['cutString']), baseSel),
+                'fillXY': "CosThetaK:CosThetaL",  # Y:X
+            }
+            for label in 'acc', 'rec':
+                if forceRebuild or fin.Get("h2_{0}_{1}".format(label, binKey)) == None:
+                    procedure = setupEfficiencyBuildProcedure[label]
+                    for suffix, binning in effiHistBinnings(10):
+                        sampleHists[label].append(("h2_{0}{1}_{2}_total".format(label, suffix, binKey), procedure['baseString'], procedure['fillXY'], binning))
+                        sampleHists[label].append(("h2_{0}{1}_{2}_passed".format(label, suffix, binKey), "({0}) && ({1})".format(procedure['baseString'], procedure['cutString']), procedure['fillXY'], binning))
+        hists = fillEffiHists([(UnfilteredMC, "tree", sampleHists['acc']), (sigMCReader.cfg['ifile'], "tree", sampleHists['rec'])])
+
+        outputs = []
+        for binKey in binKeys:
+            effs = {}
+            for label in 'acc', 'rec':
+                if "h2_{0}_{1}_total".format(label, binKey) not in hists:
+                    # Built in a previous run
+                    effs[label] = fin.Get("h2_{0}_{1}".format(label, binKey))
+                    for proj in ["ProjectionX", "ProjectionY"]:
+                        effs[label, proj] = fin.Get("h_{0}_fine_{1}_{2}".format(label, binKey, proj))
+                    continue
+                h2_total = hists["h2_{0}_{1}_total".format(label, binKey)]
+                h2_passed = hists["h2_{0}_{1}_passed".format(label, binKey)]
+                h2_fine_total = hists["h2_{0}_fine_{1}_total".format(label, binKey)]
+                h2_fine_passed = hists["h2_{0}_fine_{1}_passed".format(label, binKey)]
+                print("{0}/{1}".format(h2_passed.GetEntries(), h2_total.GetEntries()))
+                effs[label] = TEfficiency(h2_passed, h2_total)
+                outputs.append((effs[label], "h2_{0}_{1}".format(label, binKey)))
+                outputs.append((TEfficiency(h2_fine_passed, h2_fine_total), "h2_{0}_fine_{1}".format(label, binKey)))
+                for proj in ["ProjectionX", "ProjectionY"]:
                     proj_fine_total = getattr(h2_fine_total, proj)("{0}_{1}".format(h2_fine_total.GetName(), proj), 0, -1, "e")
                     proj_fine_passed = getattr(h2_fine_passed, proj)("{0}_{1}".format(h2_fine_passed.GetName(), proj), 0, -1, "e")
-                    h_eff = TEfficiency(proj_fine_passed, proj_fine_total)
-                    h_eff.Write("h_{0}_fine_{1}_{2}".format(label, binKey, proj), ROOT.TObject.kOverwrite)
-
-                h2_eff.Write("h2_{0}_{1}".format(label, binKey), ROOT.TObject.kOverwrite)
-                h2_eff_fine.Write("h2_{0}_fine_{1}".format(label, binKey), ROOT.TObject.kOverwrite)
-
-                del df_acc, df_tot
-
-        #pdb.set_trace()
-        # Merge acc and rec to accXrec
-        fin.cd()
-        for proj in ["ProjectionX", "ProjectionY"]:
-            h_acc_fine = fin.Get("h_acc_fine_{0}_{1}".format(binKey, proj))
-            h_rec_fine = fin.Get("h_rec_fine_{0}_{1}".format(binKey, proj))
-            h_accXrec_fine = h_acc_fine.GetPassedHistogram().Clone("h_accXrec_fine_{0}_{1}".format(binKey, proj))
-            h_accXrec_fine.Reset("ICESM")
-            for b in range(1, h_accXrec_fine.GetNbinsX() + 1):
-                if h_rec_fine.GetTotalHistogram().GetBinContent(b) == 0 or h_rec_fine.GetPassedHistogram().GetBinContent(b) == 0:
-                    h_accXrec_fine.SetBinContent(b, 0)
-                    h_accXrec_fine.SetBinError(b, 1)
-                    print ">> Empty reco eff bin #", b
+                    effs[label, proj] = TEfficiency(proj_fine_passed, proj_fine_total)
+                    outputs.append((effs[label, proj], "h_{0}_fine_{1}_{2}".format(label, binKey, proj)))
+
+            # Merge acc and rec to accXrec
+            for proj in ["ProjectionX", "ProjectionY"]:
+                h_acc_fine = effs['acc', proj]
+                h_rec_fine = effs['rec', proj]
+                h_accXrec_fine = h_acc_fine.GetPassedHistogram().Clone("h_accXrec_fine_{0}_{1}".format(binKey, proj))
+                h_accXrec_fine.Reset("ICESM")
+                for b in range(1, h_accXrec_fine.GetNbinsX() + 1):
+                    if h_rec_fine.GetTotalHistogram().GetBinContent(b) == 0 or h_rec_fine.GetPassedHistogram().GetBinContent(b) == 0:
+                        h_accXrec_fine.SetBinContent(b, 0)
+                        h_accXrec_fine.SetBinError(b, 1)
+                        print(">> Empty reco eff bin #{0}".format(b))
+                    else:
+                        h_accXrec_fine.SetBinContent(b, h_acc_fine.GetEfficiency(b) * h_rec_fine.GetEfficiency(b))
+                        h_accXrec_fine.SetBinError(b, h_accXrec_fine.GetBinContent(b) * math.sqrt(1 / h_acc_fine.GetTotalHistogram().GetBinContent(b) + 1 / h_acc_fine.GetPassedHistogram().GetBinContent(b) + 1 / h_rec_fine.GetTotalHistogram().GetBinContent(b) + 1 / h_rec_fine.GetPassedHistogram().GetBinContent(b)))
+                outputs.append((h_accXrec_fine, "h_accXrec_{0}_{1}".format(binKey, proj)))
+
+            h2_acc = effs['acc']
+            h2_rec = effs['rec']
+            h2_accXrec_bin = h2_acc.GetPassedHistogram().Clone("h2_accXrec_{0}".format(binKey))
+            h2_accXrec_bin.Reset("ICESM")
+            for iL, iK in itertools.product(range(1, len(accXEffThetaLBins)), range(1, len(accXEffThetaKBins))):
+                if h2_rec.GetTotalHistogram().GetBinContent(iL, iK) == 0 or h2_rec.GetPassedHistogram().GetBinContent(iL, iK) == 0 or h2_acc.GetTotalHistogram().GetBinContent(iL, iK) == 0 or h2_acc.GetPassedHistogram().GetBinContent(iL, iK) == 0:
+                    h2_accXrec_bin.SetBinContent(iL, iK, 0)
+                    h2_accXrec_bin.SetBinError(iL, iK, 1)
+                    print(">> Empty recoORacc eff bin #{0} {1}".format(iL, iK))
                 else:
-                    h_accXrec_fine.SetBinContent(b, h_acc_fine.GetEfficiency(b) * h_rec_fine.GetEfficiency(b))
-                    h_accXrec_fine.SetBinError(b, h_accXrec_fine.GetBinContent(b) * math.sqrt(1 / h_acc_fine.GetTotalHistogram().GetBinContent(b) + 1 / h_acc_fine.GetPassedHistogram().GetBinContent(b) + 1 / h_rec_fine.GetTotalHistogram().GetBinContent(b) + 1 / h_rec_fine.GetPassedHistogram().GetBinContent(b)))
-            h_accXrec_fine.Write("h_accXrec_{0}_{1}".format(binKey, proj), ROOT.TObject.kOverwrite)
-
-        h2_acc = fin.Get("h2_acc_{0}".format(binKey))
-        h2_rec = fin.Get("h2_rec_{0}".format(binKey))
-        h2_accXrec = h2_acc.GetPassedHistogram().Clone("h2_accXrec_{0}".format(binKey))
-        h2_accXrec.Reset("ICESM")
-        for iL, iK in itertools.product(range(1, len(accXEffThetaLBins)), range(1, len(accXEffThetaKBins))):
-            if h2_rec.GetTotalHistogram().GetBinContent(iL, iK) == 0 or h2_rec.GetPassedHistogram().GetBinContent(iL, iK) == 0 or h2_acc.GetTotalHistogram().GetBinContent(iL, iK) == 0 or h2_acc.GetPassedHistogram().GetBinContent(iL, iK) == 0:
-                h2_accXrec.SetBinContent(iL, iK, 0)
-                h2_accXrec.SetBinError(iL, iK, 1)
-                print ">> Empty recoORacc eff bin #", iL, iK
-            else:
-                iLK = h2_acc.GetGlobalBin(iL, iK)
-                h2_accXrec.SetBinContent(iL, iK, h2_acc.GetEfficiency(iLK) * h2_rec.GetEfficiency(iLK))
-                h2_accXrec.SetBinError(iL, iK, h2_accXrec.GetBinContent(iL, iK) * math.sqrt(1 / h2_acc.GetTotalHistogram().GetBinContent(iLK) + 1 / h2_acc.GetPassedHistogram().GetBinContent(iLK) + 1 / h2_rec.GetTotalHistogram().GetBinContent(iLK) + 1 / h2_rec.GetPassedHistogram().GetBinContent(iLK)))
-        h2_accXrec.SetXTitle("cos#theta_{l}")
-        h2_accXrec.SetYTitle("cos#theta_{K}")
-        h2_accXrec.SetZTitle("Overall efficiency")
-
-        h2_accXrec.Write("h2_accXrec_{0}".format(binKey), ROOT.TObject.kOverwrite)
+                    iLK = h2_acc.GetGlobalBin(iL, iK)
+                    h2_accXrec_bin.SetBinContent(iL, iK, h2_acc.GetEfficiency(iLK) * h2_rec.GetEfficiency(iLK))
+                    h2_accXrec_bin.SetBinError(iL, iK, h2_accXrec_bin.GetBinContent(iL, iK) * math.sqrt(1 / h2_acc.GetTotalHistogram().GetBinContent(iLK) + 1 / h2_acc.GetPassedHistogram().GetBinContent(iLK) + 1 / h2_rec.GetTotalHistogram().GetBinContent(iLK) + 1 / h2_rec.GetPassedHistogram().GetBinContent(iLK)))
+            h2_accXrec_bin.SetXTitle("cos#theta_{l}")
+            h2_accXrec_bin.SetYTitle("cos#theta_{K}")
+            h2_accXrec_bin.SetZTitle("Overall efficiency")
+            outputs.append((h2_accXrec_bin, "h2_accXrec_{0}".format(binKey)))
+        writeEffiObjects(fin, outputs)
         self.logger.logINFO("Overall efficiency is built.")
 
     # Register the chosen one to sourcemanager
-    #  h2_accXrec = fin.Get("h2_accXrec_{0}".format(self.process.cfg['binKey']))
+    h2_accXrec = fin.Get("h2_accXrec_{0}".format(self.process.cfg['binKey']))
     self.cfg['source'][self.name + '.h2_accXrec'] = h2_accXrec
     self.cfg['source'][self.name + '.accXrec'] = RooDataHist("accXrec", "", RooArgList(CosThetaL, CosThetaK), ROOT.RooFit.Import(h2_accXrec))
     self.cfg['source'][self.name + '.h_accXrec_fine_ProjectionX'] = fin.Get("h_accXrec_{0}_ProjectionX".format(self.process.cfg['binKey']))
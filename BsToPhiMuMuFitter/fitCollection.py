@@ -96,6 +96,7 @@ setupSig2DFitter.update({
     'argPattern': ['unboundAfb', 'unboundFl'],
     'createNLLOpt': [],
     'argAliasInDB': {'unboundAfb': 'unboundAfb_RECO', 'unboundFl': 'unboundFl_RECO'},
+    'optimizeConst': 1,  # Per-event efficiency of f_sig2D is cached, see cpp/RooBtosllEffiModel.cxx
 })
 sig2DFitter = StdFitter(setupSig2DFitter)
 
@@ -133,6 +134,7 @@ setupFinalFitter.update({
     'FitMinos': [True, ('nSig', 'unboundAfb', 'unboundFl', 'nBkgComb')],
     'argAliasInDB': dict(setupSigMFitter['argAliasInDB'].items() + setupSigAFitter['argAliasInDB'].items()),
     'argAliasSaveToDB': False,
+    'optimizeConst': 1,  # Per-event efficiency of f_sig2D is cached, see cpp/RooBtosllEffiModel.cxx
 })
 finalFitter = StdFitter(setupFinalFitter)
 
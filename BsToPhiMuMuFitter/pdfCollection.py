@@ -14,7 +14,9 @@
 # In RooWorkspace.factory(), you MUST replace the calculation between numbers to a single float number, e.g. 2/3 -> 0.666667
 #   It is possible that the parser don't designed to handle RooAddition and RooProduct between RooConstVar
 
-import types, sys, pdb
+import re, types, sys, pdb
+import json
+import hashlib
 import functools
 from copy import copy, deepcopy
 from collections import OrderedDict
@@ -155,6 +157,40 @@ setupBuildEffiSigA = {
     ]
 }
 
+def buildCompiledEffiSigA(self, factoryCmd):
+    """Same parameters and shape as buildEffiSigA, but effi_sigA is a compiled RooAngularEfficiency"""
+    wspace = self.getWspace()
+    effi_sigA = wspace.obj("effi_sigA")
+    if effi_sigA == None:
+        self.logger.logINFO("Build effi_sigA from scratch.")
+        for v in ["CosThetaK", "CosThetaL"]:
+            if wspace.obj(v) == None:
+                getattr(wspace, 'import')(globals()[v])
+        for cmd in factoryCmd:
+            if not cmd.startswith("expr::effi_sigA("):
+                wspace.factory(cmd)
+
+        def coefList(prefix):
+            names = []
+            args_it = wspace.allVars().createIterator()
+            arg = args_it.Next()
+            while arg:
+                if re.match(r"^{0}\d+$".format(prefix), arg.GetName()):
+                    names.append(arg.GetName())
+                arg = args_it.Next()
+            coefs = ROOT.RooArgList()
+            for name in sorted(names, key=lambda name: int(name[len(prefix):])):
+                coefs.add(wspace.var(name))
+            return coefs
+        lShape = ROOT.RooAngularEfficiency.Gaussians if any(cmd.startswith("EXPR::effi_cosl(") and "exp(" in cmd for cmd in factoryCmd) else ROOT.RooAngularEfficiency.Polynomial
+        effi_sigA = ROOT.RooAngularEfficiency("effi_sigA", "", wspace.var("CosThetaL"), wspace.var("CosThetaK"),
+                                              coefList("l"), coefList("k"), coefList("x"),
+                                              wspace.var("effi_norm"), wspace.var("hasXTerm"), lShape)
+        getattr(wspace, 'import')(effi_sigA, ROOT.RooFit.RecycleConflictNodes())
+        wspace.importClassCode(ROOT.RooAngularEfficiency.Class())
+        effi_sigA = wspace.obj("effi_sigA")
+    self.cfg['source']['effi_sigA'] = effi_sigA
+
 setupBuildSigM = {
     'objName': "f_sigM",
     'varNames': ["Bmass"],
@@ -196,8 +232,17 @@ def buildSig(self):
     if f_sig3D == None:
         for k in ['effi_sigA', 'f_sigA', 'f_sigM']:
             locals()[k] = self.cfg['source'][k] if k in self.cfg['source'] else self.process.sourcemanager.get(k)
-        f_sig2D = RooEffProd("f_sig2D", "", locals()['f_sigA'], locals()['effi_sigA'])
-        getattr(wspace, 'import')(f_sig2D, ROOT.RooFit.RecycleConflictNodes())
+        if self.cfg.get('cachedSig2D', False):
+            # Normalisation from cached efficiency moments, see cpp/RooBtosllEffiModel.cxx
+            if wspace.obj("f_sigA") == None:
+                getattr(wspace, 'import')(locals()['f_sigA'])
+            f_sig2D = ROOT.RooBtosllEffiModel("f_sig2D", "", wspace.var("CosThetaL"), wspace.var("CosThetaK"), wspace.var("unboundAfb"), wspace.var("unboundFl"), locals()['effi_sigA'])
+            getattr(wspace, 'import')(f_sig2D, ROOT.RooFit.RecycleConflictNodes())
+            wspace.importClassCode(ROOT.RooBtosllEffiModel.Class())
+            f_sig2D = wspace.pdf("f_sig2D")
+        else:
+            f_sig2D = RooEffProd("f_sig2D", "", locals()['f_sigA'], locals()['effi_sigA'])
+            getattr(wspace, 'import')(f_sig2D, ROOT.RooFit.RecycleConflictNodes())
         if wspace.obj("f_sigM") == None:
             getattr(wspace, 'import')(locals()['f_sigM'])
         wspace.factory("PROD::f_sig3D(f_sigM, f_sig2D)")
@@ -326,41 +371,92 @@ SmoothBkgCmd['abovePsi2sA']=[0.6, 0.6, 0.6, 0.6]
 SmoothBkgCmd['abovePsi2sB']=[0.6, 0.6, 0.6, 0.6]
 SmoothBkgCmd['summary']=[0.6, 0.6, 0.6, 0.6]
 SmoothBkgCmd['summaryLowQ2']=[0.6, 0.6, 0.6, 0.6]
-def buildSmoothBkgCombA(self, factoryCmd):
-    """Build with RooWorkspace.factory. See also RooFactoryWSTool.factory"""
+def keysPdfHash(var, data, rho, nGridBins):
+    """Fingerprint of the inputs of a tabulated RooKeysPdf, i.e. the sideband selection, rho and the grid"""
+    content = {
+        'var': [var.GetName(), var.getMin(), var.getMax()],
+        'data': [data.GetName(), data.numEntries(), data.sumEntries(), data.mean(var)] + [data.moment(var, order) for order in (2, 3, 4)],
+        'rho': rho,
+        'nGridBins': nGridBins,
+    }
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+def buildGridKeysPdf(wspace, name, var, data, rho, nGridBins):
+    """RooKeysPdf tabulated once as a RooHistPdf with linear interpolation, normalised analytically.
+    The grid is refilled only if keysPdfHash differs from the one it was built with."""
+    key = keysPdfHash(var, data, rho, nGridBins)
+    pdf = wspace.pdf(name)
+    if pdf != None:
+        if not pdf.InheritsFrom("RooHistPdf"):
+            print("WARNING\t: {0} is a {1} in the workspace, not tabulated.".format(name, pdf.ClassName()))
+            return
+        if pdf.getStringAttribute("sourceHash") == key:
+            return
+        print("INFO\t: Inputs of {0} changed, refill its grid.".format(name))
+        dataHist = pdf.dataHist()
+    else:
+        # The datahist keeps its own binning, the default one of var is restored afterwards
+        binning = var.getBinning().clone("{0}_binning".format(name))
+        var.setBins(nGridBins)
+        dataHist = ROOT.RooDataHist("h_{0}".format(name), "", ROOT.RooArgSet(var))
+        var.setBinning(binning)
+
+    keys = RooKeysPdf("{0}_keys".format(name), "", var, data, RooKeysPdf.MirrorBoth, rho)
+    normSet = ROOT.RooArgSet(var)
+    for iBin in range(dataHist.numEntries()):
+        var.setVal(dataHist.get(iBin).getRealValue(var.GetName()))
+        dataHist.set(keys.getVal(normSet))
+
+    if pdf == None:
+        pdf = ROOT.RooHistPdf(name, name, ROOT.RooArgSet(var), dataHist, 1)
+        getattr(wspace, 'import')(pdf)
+        pdf = wspace.pdf(name)
+    pdf.setStringAttribute("sourceHash", key)
+    pdf.setValueDirty()
+
+def buildSmoothBkgCombA(self, factoryCmd, nGridBins=0):
+    """Build with RooWorkspace.factory. See also RooFactoryWSTool.factory
+    With nGridBins, each RooKeysPdf is tabulated on so many bins, see buildGridKeysPdf."""
     wspace = self.getWspace()
     Cmd=factoryCmd
     f_bkgCombAAltA = wspace.pdf("f_bkgCombAAltA")
+    if nGridBins > 0:
+        for name, var, dataName, rho in [("f_bkgCombAAltKUp", CosThetaK, 'dataReader.USB', Cmd[0]),
+                                         ("f_bkgCombAAltKLo", CosThetaK, 'dataReader.LSB', Cmd[1]),
+                                         ("f_bkgCombAAltLUp", CosThetaL, 'dataReader.USB', Cmd[2]),
+                                         ("f_bkgCombAAltLLo", CosThetaL, 'dataReader.LSB', Cmd[3])]:
+            buildGridKeysPdf(wspace, name, var, self.process.sourcemanager.get(dataName), rho, nGridBins)
     if f_bkgCombAAltA == None:
-        f_bkgCombAAltKUp = RooKeysPdf("f_bkgCombAAltKUp",
-                                      "f_bkgCombAAltKUp",
-                                      CosThetaK,
-                                      self.process.sourcemanager.get('dataReader.USB'),
-                                      RooKeysPdf.MirrorBoth, Cmd[0])
-        f_bkgCombAAltKLo = RooKeysPdf("f_bkgCombAAltKLo",
-                                      "f_bkgCombAAltKLo",
-                                      CosThetaK,
-                                      self.process.sourcemanager.get('dataReader.LSB'),
-                                      RooKeysPdf.MirrorBoth, Cmd[1])
-        f_bkgCombAAltLUp = RooKeysPdf("f_bkgCombAAltLUp",
-                                      "f_bkgCombAAltLUp",
-                                      CosThetaL,
-                                      self.process.sourcemanager.get('dataReader.USB'),
-                                      RooKeysPdf.MirrorBoth, Cmd[2])
-        f_bkgCombAAltLLo = RooKeysPdf("f_bkgCombAAltLLo",
-                                      "f_bkgCombAAltLLo",
-                                      CosThetaL,
-                                      self.process.sourcemanager.get('dataReader.LSB'),
-                                      RooKeysPdf.MirrorBoth, Cmd[3])
-        for f in f_bkgCombAAltKLo, f_bkgCombAAltKUp, f_bkgCombAAltLLo, f_bkgCombAAltLUp:
-            getattr(wspace, 'import')(f)
+        if nGridBins <= 0:
+            f_bkgCombAAltKUp = RooKeysPdf("f_bkgCombAAltKUp",
+                                          "f_bkgCombAAltKUp",
+                                          CosThetaK,
+                                          self.process.sourcemanager.get('dataReader.USB'),
+                                          RooKeysPdf.MirrorBoth, Cmd[0])
+            f_bkgCombAAltKLo = RooKeysPdf("f_bkgCombAAltKLo",
+                                          "f_bkgCombAAltKLo",
+                                          CosThetaK,
+                                          self.process.sourcemanager.get('dataReader.LSB'),
+                                          RooKeysPdf.MirrorBoth, Cmd[1])
+            f_bkgCombAAltLUp = RooKeysPdf("f_bkgCombAAltLUp",
+                                          "f_bkgCombAAltLUp",
+                                          CosThetaL,
+                                          self.process.sourcemanager.get('dataReader.USB'),
+                                          RooKeysPdf.MirrorBoth, Cmd[2])
+            f_bkgCombAAltLLo = RooKeysPdf("f_bkgCombAAltLLo",
+                                          "f_bkgCombAAltLLo",
+                                          CosThetaL,
+                                          self.process.sourcemanager.get('dataReader.LSB'),
+                                          RooKeysPdf.MirrorBoth, Cmd[3])
+            for f in f_bkgCombAAltKLo, f_bkgCombAAltKUp, f_bkgCombAAltLLo, f_bkgCombAAltLUp:
+                getattr(wspace, 'import')(f)
         wspace.factory("PROD::f_bkgCombAAltAUp(f_bkgCombAAltKUp,f_bkgCombAAltLUp)")
         wspace.factory("PROD::f_bkgCombAAltALo(f_bkgCombAAltKLo,f_bkgCombAAltLLo)")
         wspace.factory("SUM::f_bkgCombAAltA(frac_bkgCombAAltA[0.5,0,1]*f_bkgCombAAltALo,f_bkgCombAAltAUp)")
         f_bkgCombAAltA = wspace.pdf("f_bkgCombAAltA")
-        frac_bkgCombAAltA = wspace.var("frac_bkgCombAAltA")
-        frac_bkgCombAAltA.setVal(self.process.sourcemanager.get('dataReader.LSB').sumEntries() / (self.process.sourcemanager.get('dataReader.LSB').sumEntries() + self.process.sourcemanager.get('dataReader.USB').sumEntries()))
-        frac_bkgCombAAltA.setConstant(True)
+    frac_bkgCombAAltA = wspace.var("frac_bkgCombAAltA")
+    frac_bkgCombAAltA.setVal(self.process.sourcemanager.get('dataReader.LSB').sumEntries() / (self.process.sourcemanager.get('dataReader.LSB').sumEntries() + self.process.sourcemanager.get('dataReader.USB').sumEntries()))
+    frac_bkgCombAAltA.setConstant(True)
 
     self.cfg['source']['frac_bkgCombAAltA'] = frac_bkgCombAAltA
     self.cfg['source']['f_bkgCombAAltA'] = f_bkgCombAAltA
@@ -419,6 +515,11 @@ def customizeWspaceReader(self):
 stdWspaceReader.customize = types.MethodType(customizeWspaceReader, stdWspaceReader)
 
 CFG_PDFBuilder = ObjProvider.templateConfig()
+CFG_PDFBuilder.update({
+    'compiledEffiSigA': True,  # RooAngularEfficiency instead of expr::effi_sigA
+    'cachedSig2D': True,  # RooBtosllEffiModel instead of RooEffProd for f_sig2D
+    'keysPdfGridBins': 400,  # RooKeysPdf of f_bkgCombAAltA tabulated on so many bins, 0 for the plain RooKeysPdf
+})
 stdPDFBuilder = ObjProvider(copy(CFG_PDFBuilder)); stdPDFBuilder.name="stdPDFBuilder"
 def customizePDFBuilder(self):
     print("""Customize pdf for q2 bins""")
@@ -427,11 +528,14 @@ def customizePDFBuilder(self):
     for i in setupBuildEffiSigA['factoryCmd']:
         print("FactoryCMD: ", i)
     buildAnalyticBkgCombA = functools.partial(buildGenericObj, **setupBuildAnalyticBkgCombA)
-    buildEffiSigA = functools.partial(buildGenericObj, **setupBuildEffiSigA)
+    if self.cfg.get('compiledEffiSigA', False):
+        buildEffiSigA = functools.partial(buildCompiledEffiSigA, factoryCmd=setupBuildEffiSigA['factoryCmd'])
+    else:
+        buildEffiSigA = functools.partial(buildGenericObj, **setupBuildEffiSigA)
     
     setupSmoothBkg['factoryCmd'] = SmoothBkgCmd.get(self.process.cfg['binKey'], SmoothBkgCmd['DEFAULT'])
     print setupSmoothBkg
-    buildSmoothBkg = functools.partial(buildSmoothBkgCombA, **setupSmoothBkg)
+    buildSmoothBkg = functools.partial(buildSmoothBkgCombA, nGridBins=self.cfg.get('keysPdfGridBins', 0), **setupSmoothBkg)
     # Configure setup
     self.cfg.update({
         'wspaceTag': sharedWspaceTagString.format(binLabel=q2bins[self.process.cfg['binKey']]['label']),
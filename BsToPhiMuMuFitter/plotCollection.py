@@ -7,7 +7,6 @@ import re
 import math
 import types
 import functools
-import shelve
 from array import array
 
 import ROOT
@@ -16,6 +15,7 @@ import BsToPhiMuMuFitter.cpp
 from v2Fitter.FlowControl.Path import Path
 from v2Fitter.Fitter.FitterCore import FitterCore
 from BsToPhiMuMuFitter.anaSetup import q2bins, modulePath, bMassRegions
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 from BsToPhiMuMuFitter.StdFitter import unboundFlToFl, unboundAfbToAfb, flToUnboundFl, afbToUnboundAfb
 
 from BsToPhiMuMuFitter.FitDBPlayer import FitDBPlayer
@@ -505,7 +505,7 @@ def plotSummaryAfbFl(self, pltName, dbSetup, drawSM=False, marks=None):
                 self.logger.logERROR("Input db file {0} NOT found. Skip.".format(dbPat.format(binLabel=q2bins[binKey]['label'])))
                 continue
             try:
-                db = shelve.open(dbPat.format(binLabel=q2bins[binKey]['label']))
+                db = FitResultStore.getStore(dbPat.format(binLabel=q2bins[binKey]['label']), readonly=True)
                 unboundFl = db[argAliasInDB.get("unboundFl", "unboundFl")]
                 unboundAfb = db[argAliasInDB.get("unboundAfb", "unboundAfb")]
 
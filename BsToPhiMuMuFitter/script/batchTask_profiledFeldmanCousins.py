@@ -4,8 +4,8 @@
 import os, pdb
 import sys
 import re
+import glob
 import math
-import shelve
 import types
 import functools
 import itertools
@@ -14,6 +14,7 @@ from subprocess import call
 from copy import deepcopy
 
 from BsToPhiMuMuFitter.anaSetup import q2bins, modulePath
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 import BsToPhiMuMuFitter.StdFitter as StdFitter
 import v2Fitter.Batch.AbsBatchTaskWrapper as AbsBatchTaskWrapper
 
@@ -49,7 +50,7 @@ class ProfiledFCToyStudier(AbsToyStudier.AbsToyStudier):
     def getSubDataEntries(self, setIdx):
         expectedYield = 0
         try:
-            db = shelve.open(self.process.dbplayer.odbfile)
+            db = FitResultStore.getStore(self.process.dbplayer.odbfile)
             expectedYield += db['nSig']['getVal']
             expectedYield += db['nBkgComb']['getVal']
         finally:
@@ -89,21 +90,21 @@ class ProfiledFCToyStudier(AbsToyStudier.AbsToyStudier):
             self.treeContent.nll = self.fitter._nll.getVal()
             self.otree.Fill()
 
-    def _runSetsLoop(self):
+    def _runSetsLoop(self, setIndices=None):
         """Customization: No force reset initial db file"""
         # Check if profiling gives valid result
         self.process.dbplayer.resetDB(False)
-        for iSet in range(self.cfg['nSetOfToys']):
-            self.fitter.hookProcess(self.process)
-            self.fitter.customize()
+        if setIndices is None:
+            setIndices = range(self.cfg['nSetOfToys'])
+        for iSet in setIndices:
+            self._seedSet(iSet)
             self.currentSubDataEntries = self.getSubDataEntries(iSet)
-            self.fitter.pdf = self.process.sourcemanager.get(self.fitter.cfg['pdf'])
-            self.fitter.data = self.getSubData().next()
-            self.fitter._bookMinimizer()
-            self.fitter._preFitSteps()
+            self._bookFitter(self.getSubData().next())
             self.fitter._runFitSteps()  # Don't run fitter._postRunFitSteps, db will be overwritten
             self._postRunFitSteps(iSet)
-            self.fitter.reset()
+            if not self.cfg.get('residentFitter', False):
+                self.fitter.reset()
+        self._releaseFitter()
 
     def _postSetsLoop(self):
         """ Write otree to a file """
@@ -119,7 +120,9 @@ setupProfiledFCToyStudier.update({
     'name': "profiledFCToyStudier",
     'data': "ToyGenerator.mixedToy",
     'fitter': fitCollection.finalFitter,
+    'residentFitter': True,
     'nSetOfToys': 100,  # Typically 500 for acceptable precision, in proportion to generating time.
+    'checkpointEvery': 10,
 })
 profiledFCToyStudier = ProfiledFCToyStudier(setupProfiledFCToyStudier)
 
@@ -176,6 +179,147 @@ setupBatchTaskBestFit.update({
     'nJobs': 1,  # Fix to 1 for profiledFCToyStudier.cfg['nSetOfToys'] sets of toys
     'queue': "workday",
 })
+# Adaptive scan of profile points
+# Instead of the full grid, task_dir/profilePoints.txt lists the points and their nSetOfToys of the current round.
+# Each 'plan' starts from a coarse grid, then adds points and toys only where the interval endpoints are not
+# yet determined to the target precision. Merge setSummary of finished jobs before planning the next round.
+setupAdaptiveScan = {
+    'fineGrid': {
+        'afb': [0.01 * iAfbSet - 0.745 for iAfbSet in range(150)],
+        'fl': [0.01 * iFlSet + 0.005 for iFlSet in range(100)],
+    },
+    'coarseStride': 5,  # Every 5th point of the fine grid in the first round
+    'coarseToys': 20,
+    'maxToys': 500,
+    'precision': 0.005,  # Target statistical precision of interval endpoints
+    'coverage': 0.683,
+}
+
+def profilePointName(varName, varVal):
+    return "{0}{1:+.3f}".format(varName, varVal)
+
+def readSchedule(scheduleFile):
+    """Return round and list of (profilePoint, nSetOfToys)"""
+    scanRound = 0
+    schedule = []
+    with open(scheduleFile) as f:
+        for line in f:
+            if line.startswith("# round"):
+                scanRound = int(line.split()[2])
+            elif line.strip() and not line.startswith("#"):
+                point, nSetOfToys = line.split()
+                schedule.append((point, int(nSetOfToys)))
+    return scanRound, schedule
+
+def writeSchedule(scheduleFile, scanRound, schedule):
+    with open(scheduleFile + ".tmp", 'w') as f:
+        f.write("# round {0}\n".format(scanRound))
+        for point, nSetOfToys in schedule:
+            f.write("{0} {1}\n".format(point, nSetOfToys))
+    os.rename(scheduleFile + ".tmp", scheduleFile)
+
+def readProfileToys(task_dir, binKey):
+    """Map varName to {trueVal: [measured values]} from merged setSummary of each point"""
+    toys = {'afb': {}, 'fl': {}}
+    for point in os.listdir(task_dir):
+        parsePoint = re.match(r"^(afb|fl)([+-]0\.\d{3})$", point)
+        if not parsePoint:
+            continue
+        varName = parsePoint.group(1)
+        fname = os.path.join(task_dir, point, "setSummary_{0}.root".format(q2bins[binKey]['label']))
+        if os.path.exists(os.path.join(task_dir, point, "failed_in_profile_{0}.txt".format(q2bins[binKey]['label']))):
+            continue
+        if not os.path.exists(fname):
+            print("WARNING\t: No merged setSummary in {0}, skipped in planning".format(point))
+            continue
+        fin = ROOT.TFile(fname)
+        try:
+            toys[varName][float(parsePoint.group(2))] = [getattr(ev, varName) for ev in fin.Get("tree")]
+        finally:
+            fin.Close()
+    return toys
+
+def planVarScan(varName, toys, measVal, cfg):
+    """Schedule points and toys for one variable.
+
+    The FC interval contains the true values whose acceptance region covers measVal.
+    Its endpoints are located from q(t), the fraction of toys at true value t measured below measVal,
+    crossing (1-coverage)/2 and (1+coverage)/2 between adjacent points. A bracket wider than
+    the precision is split at a fine grid point, otherwise both ends get toys until the binomial
+    error of q propagated to the endpoint reaches the precision.
+    Return the scheduled {trueVal: nSetOfToys} and estimated endpoints [(t, sigma)]."""
+    trueVals = sorted(t for t in toys if toys[t])
+    nToys = dict((t, len(toys[t])) for t in trueVals)
+    q = dict((t, sum(1. for x in toys[t] if x < measVal) / nToys[t]) for t in trueVals)
+    scheduled = {}
+    endpoints = []
+
+    def requestToys(t, nTarget):
+        nTarget = min(int(math.ceil(nTarget)), cfg['maxToys'])
+        if nTarget > nToys.get(t, 0) + scheduled.get(t, 0):
+            scheduled[t] = nTarget - nToys.get(t, 0)
+
+    for alpha in [(1. - cfg['coverage']) / 2., (1. + cfg['coverage']) / 2.]:
+        for tLo, tHi in zip(trueVals[:-1], trueVals[1:]):
+            if (q[tLo] - alpha) * (q[tHi] - alpha) > 0:
+                continue
+            slope = (q[tHi] - q[tLo]) / (tHi - tLo)
+            tCross = tLo + (alpha - q[tLo]) / slope if slope != 0 else 0.5 * (tLo + tHi)
+            # Binomial error of q at the crossing, propagated with the local slope
+            sigma = math.sqrt(alpha * (1. - alpha) / min(nToys[tLo], nToys[tHi])) / abs(slope) if slope != 0 else float('inf')
+            endpoints.append((tCross, sigma))
+
+            inner = [t for t in cfg['fineGrid'][varName] if tLo + 1e-6 < t < tHi - 1e-6]
+            if tHi - tLo > 2 * cfg['precision'] and inner:
+                tNew = min(inner, key=lambda t: abs(t - tCross))
+                requestToys(tNew, min(nToys[tLo], nToys[tHi]))
+            elif sigma > cfg['precision']:
+                nTarget = alpha * (1. - alpha) / (cfg['precision'] * slope) ** 2 if slope != 0 else cfg['maxToys']
+                requestToys(tLo, nTarget)
+                requestToys(tHi, nTarget)
+
+        # Points classified by less than 2 sigma may hide another crossing.
+        for t in trueVals:
+            if 0 < abs(q[t] - alpha) < 2 * math.sqrt(alpha * (1. - alpha) / nToys[t]):
+                requestToys(t, 4 * alpha * (1. - alpha) / (q[t] - alpha) ** 2)
+    return scheduled, sorted(endpoints)
+
+def planAdaptiveScan(task_dir, args):
+    """Write the schedule of the next round to task_dir/profilePoints.txt"""
+    cfg = setupAdaptiveScan
+    scheduleFile = os.path.join(task_dir, "profilePoints.txt")
+    toys = readProfileToys(task_dir, args.binKey)
+    if not any(toys.values()):
+        scanRound = 0
+        schedule = []
+        for varName in ['afb', 'fl']:
+            for varVal in cfg['fineGrid'][varName][::cfg['coarseStride']]:
+                schedule.append((profilePointName(varName, varVal), cfg['coarseToys']))
+    else:
+        scanRound = readSchedule(scheduleFile)[0] + 1 if os.path.exists(scheduleFile) else 1
+        db = FitResultStore.getStore(os.path.join(args.dbDirPath, "fitResults_{0}.db".format(q2bins[args.binKey]['label'])), readonly=True)
+        measFl = StdFitter.unboundFlToFl(db['unboundFl']['getVal'])
+        measVal = {
+            'fl': measFl,
+            'afb': StdFitter.unboundAfbToAfb(db['unboundAfb']['getVal'], measFl),
+        }
+        schedule = []
+        for varName in ['afb', 'fl']:
+            scheduled, endpoints = planVarScan(varName, toys[varName], measVal[varName], cfg)
+            for t, sigma in endpoints:
+                print("INFO\t: {0} endpoint near {1:+.4f} +- {2:.4f}".format(varName, t, sigma))
+            for t in sorted(scheduled):
+                schedule.append((profilePointName(varName, t), scheduled[t]))
+
+    for point, nSetOfToys in schedule:
+        if not os.path.exists(os.path.join(task_dir, point)):
+            os.makedirs(os.path.join(task_dir, point))
+    writeSchedule(scheduleFile, scanRound, schedule)
+    if schedule:
+        print("INFO\t: Round {0} scheduled {1} point(s), {2} set(s) of toys in {3}".format(scanRound, len(schedule), sum(n for _, n in schedule), scheduleFile))
+    else:
+        print("INFO\t: Endpoints reached the target precision {0}, nothing to schedule".format(cfg['precision']))
+
 # Customize taskSubmitter and jobRunner if needed
 
 if __name__ == '__main__':
@@ -184,18 +328,6 @@ if __name__ == '__main__':
     p.addService("dbplayer", FitDBPlayer(absInputDir=os.path.join(modulePath, "input", "selected")))#Pritam
     task_dir = modulePath+"/batchTask_profiledFeldmanCousins"
 
-    for iAfbSet in range(150):
-        try:
-            os.makedirs("{0}/afb{1:+.3f}".format(task_dir, 0.01 * iAfbSet - 0.745))
-        except OSError:
-            pass
-    for iFlSet in range(100):
-        try:
-            os.makedirs("{0}/fl{1:+.3f}".format(task_dir, 0.01 * iFlSet + 0.005))
-        except OSError:
-            pass
-    profilePoints = [d for d in os.listdir(task_dir) if re.match(r"^(afb|fl)[+-]0\.\d{3}$", d)]
-
     parser = AbsBatchTaskWrapper.BatchTaskParser
     parser.add_argument(
         '--binKey',
@@ -211,6 +343,7 @@ if __name__ == '__main__':
         action="store_true",
         default=False,
         help="Submit the jobs. By default only show submit script to stdout.")
+    AbsBatchTaskWrapper.addExecutorArguments(BatchTaskSubparserSubmitProfile)
     BatchTaskSubparserSubmitProfile.set_defaults(func=AbsBatchTaskWrapper.submitTask)
 
     BatchTaskSubparserRunProfile = AbsBatchTaskWrapper.BatchTaskSubparsers.add_parser('run_profile')
@@ -238,6 +371,7 @@ if __name__ == '__main__':
         action="store_true",
         default=False,
         help="Submit the jobs. By default only show submit script to stdout.")
+    AbsBatchTaskWrapper.addExecutorArguments(BatchTaskSubparserSubmitBestFit)
     BatchTaskSubparserSubmitBestFit.set_defaults(func=AbsBatchTaskWrapper.submitTask)
     BatchTaskSubparserRunBestFit = AbsBatchTaskWrapper.BatchTaskSubparsers.add_parser('run_bestFit')
     BatchTaskSubparserRunBestFit.add_argument(
@@ -247,10 +381,51 @@ if __name__ == '__main__':
     )
     BatchTaskSubparserRunBestFit.set_defaults(func=AbsBatchTaskWrapper.runJob)
 
+    BatchTaskSubparserPlan = AbsBatchTaskWrapper.BatchTaskSubparsers.add_parser('plan')
+    BatchTaskSubparserPlan.add_argument(
+        "--precision",
+        dest="precision",
+        type=float,
+        default=setupAdaptiveScan['precision'],
+        help="Target precision of interval endpoints. (Default: {0})".format(setupAdaptiveScan['precision']))
+    BatchTaskSubparserPlan.add_argument(
+        "--maxToys",
+        dest="maxToys",
+        type=int,
+        default=setupAdaptiveScan['maxToys'],
+        help="Maximum sets of toys per profile point. (Default: {0})".format(setupAdaptiveScan['maxToys']))
+    BatchTaskSubparserPlan.add_argument(
+        "--dbDirPath",
+        dest="dbDirPath",
+        default=os.path.join(modulePath, "input", "selected"),
+        help="Input dir of db files with the measured values.")
+
     args = parser.parse_args()
     p.cfg['binKey'] = args.binKey
     p.cfg['bins'] = [args.binKey] #Pritam
 
+    # Profile points are scheduled by 'plan' if profilePoints.txt exists, otherwise the full grid is used.
+    scheduleFile = os.path.join(task_dir, "profilePoints.txt")
+    if args.Function_name == "plan":
+        setupAdaptiveScan.update({
+            'precision': args.precision,
+            'maxToys': args.maxToys,
+        })
+        planAdaptiveScan(task_dir, args)
+        sys.exit()
+    elif os.path.exists(scheduleFile):
+        scanRound, schedule = readSchedule(scheduleFile)
+        profilePoints = [point for point, nSetOfToys in schedule]
+    else:
+        scanRound, schedule = None, None
+        for varName in ['afb', 'fl']:
+            for varVal in setupAdaptiveScan['fineGrid'][varName]:
+                try:
+                    os.makedirs("{0}/{1}".format(task_dir, profilePointName(varName, varVal)))
+                except OSError:
+                    pass
+        profilePoints = [d for d in os.listdir(task_dir) if re.match(r"^(afb|fl)[+-]0\.\d{3}$", d)]
+
     if args.Function_name in ["submit_profile", "run_profile"]:
         if args.Function_name == "run_profile":
             print("INFO\t: Profiling job {1} with {0}".format(profilePoints[args.jobId], args.jobId))
@@ -293,7 +468,7 @@ if __name__ == '__main__':
                 if self.fitResult['profiler.migrad']['status'] != 0 or math.fabs(self.fitResult['profiler.minos']['nll']) > 1e20:
                     with open("failed_in_profile_{0}.txt".format(q2bins[self.process.cfg['binKey']]['label']), 'w') as f:
                         try:
-                            db = shelve.open(self.process.dbplayer.odbfile)
+                            db = FitResultStore.getStore(self.process.dbplayer.odbfile)
                             f.write(db.__repr__().replace("}", "\n"))
                         finally:
                             db.close()
@@ -336,7 +511,15 @@ if __name__ == '__main__':
             wrappedTask.task_dir = "{0}/{1}".format(task_dir, profilePoints[args.jobId])
             pdb.set_trace()
             p.dbplayer.absInputDir = wrappedTask.task_dir
-            wrappedTask.cfg['work_dir'] = ['toys_{0}'.format(datetime.utcnow().strftime("UTC-%Y%m%d-%H%M%S"))] * len(profilePoints)
+            # Resume the toys of a preempted job, i.e. left with a checkpoint but no setSummary
+            resumable = sorted(d for d in glob.glob(wrappedTask.task_dir + "/toys_UTC-*")
+                               if glob.glob(d + "/*.checkpoint.*") and not os.path.exists(d + "/setSummary_{0}.root".format(q2bins[args.binKey]['label'])))
+            if resumable:
+                print("INFO\t: Resume toys in {0}".format(resumable[-1]))
+                workDirName = os.path.basename(resumable[-1])
+            else:
+                workDirName = 'toys_{0}'.format(datetime.utcnow().strftime("UTC-%Y%m%d-%H%M%S"))
+            wrappedTask.cfg['work_dir'] = [workDirName] * len(profilePoints)
             toyCollection.sigToyGenerator.cfg.update({
                 'db': "{0}/fitResults_{{binLabel}}.db".format(wrappedTask.task_dir),
                 'saveAs': "sigToyGenerator_{0}.root".format(q2bins[args.binKey]['label']),
@@ -348,6 +531,15 @@ if __name__ == '__main__':
                 'preloadFiles': ["{0}/bkgCombToyGenerator_{1}.root".format(wrappedTask.task_dir, q2bins[args.binKey]['label'])],
             })
 
+            if schedule is not None:
+                # Toys of each round are new sets, not repeated ones of previous rounds
+                profiledFCToyStudier.cfg.update({
+                    'nSetOfToys': schedule[args.jobId][1],
+                    'baseSeed': "{0}.round{1}".format(profilePoints[args.jobId], scanRound),
+                })
+                toyCollection.bkgCombToyGenerator.cfg['scale'] = profiledFCToyStudier.cfg['nSetOfToys'] * 5
+                toyCollection.sigToyGenerator.cfg['scale'] = profiledFCToyStudier.cfg['nSetOfToys'] * 5
+
             # No run if failed in profiling
             if os.path.exists(wrappedTask.task_dir + "/failed_in_profile_{0}.txt".format(q2bins[args.binKey]['label'])):
                 print("INFO\t: Failed in profile step. Abort.\n")
@@ -5,7 +5,6 @@ import os
 import sys
 import re
 import math
-import shelve
 import types
 import functools
 import itertools
@@ -13,6 +12,7 @@ from datetime import datetime
 from copy import copy, deepcopy
 
 from SingleBuToKstarMuMuFitter.anaSetup import q2bins
+import SingleBuToKstarMuMuFitter.FitResultStore as FitResultStore
 import SingleBuToKstarMuMuFitter.StdFitter as StdFitter
 import v2Fitter.Batch.AbsBatchTaskWrapper as AbsBatchTaskWrapper
 
@@ -47,7 +47,7 @@ class ProfiledFCToyStudier(AbsToyStudier.AbsToyStudier):
     def getSubDataEntries(self, setIdx):
         expectedYield = 0
         try:
-            db = shelve.open(self.process.dbplayer.odbfile)
+            db = FitResultStore.getStore(self.process.dbplayer.odbfile)
             expectedYield += db['nSig']['getVal']
             expectedYield += db['nBkgComb']['getVal']
         finally:
@@ -87,21 +87,21 @@ class ProfiledFCToyStudier(AbsToyStudier.AbsToyStudier):
             self.treeContent.nll = self.fitter._nll.getVal()
             self.otree.Fill()
 
-    def _runSetsLoop(self):
+    def _runSetsLoop(self, setIndices=None):
         """Customization: No force reset initial db file"""
         # Check if profiling gives valid result
         self.process.dbplayer.resetDB(False)
-        for iSet in range(self.cfg['nSetOfToys']):
-            self.fitter.hookProcess(self.process)
-            self.fitter.customize()
+        if setIndices is None:
+            setIndices = range(self.cfg['nSetOfToys'])
+        for iSet in setIndices:
+            self._seedSet(iSet)
             self.currentSubDataEntries = self.getSubDataEntries(iSet)
-            self.fitter.pdf = self.process.sourcemanager.get(self.fitter.cfg['pdf'])
-            self.fitter.data = self.getSubData().next()
-            self.fitter._bookMinimizer()
-            self.fitter._preFitSteps()
+            self._bookFitter(self.getSubData().next())
             self.fitter._runFitSteps()  # Don't run fitter._postRunFitSteps, db will be overwritten
             self._postRunFitSteps(iSet)
-            self.fitter.reset()
+            if not self.cfg.get('residentFitter', False):
+                self.fitter.reset()
+        self._releaseFitter()
 
     def _postSetsLoop(self):
         """ Write otree to a file """
@@ -117,6 +117,7 @@ setupProfiledFCToyStudier.update({
     'name': "profiledFCToyStudier",
     'data': "ToyGenerator.mixedToy",
     'fitter': fitCollection.finalFitter,
+    'residentFitter': True,
     'nSetOfToys': 100,  # Typically 100 Toys * 5 submissions for acceptable precision, in proportion to generating time.
 })
 profiledFCToyStudier = ProfiledFCToyStudier(setupProfiledFCToyStudier)
@@ -265,7 +266,7 @@ if __name__ == '__main__':
                 if self.fitResult['profiler.migrad']['status'] != 0 or math.fabs(self.fitResult['profiler.minos']['nll']) > 1e20:
                     with open("failed_in_profile_{0}.txt".format(q2bins[self.process.cfg['binKey']]['label']), 'w') as f:
                         try:
-                            db = shelve.open(self.process.dbplayer.odbfile)
+                            db = FitResultStore.getStore(self.process.dbplayer.odbfile)
                             f.write(db.__repr__().replace("}", "\n"))
                         finally:
                             db.close()
@@ -308,6 +309,9 @@ if __name__ == '__main__':
             wrappedTask.task_dir = "{0}/{1}".format(task_dir, profilePoints[args.jobId])
             p.dbplayer.absInputDir = wrappedTask.task_dir
             wrappedTask.cfg['work_dir'] = ['toys_{0}'.format(datetime.utcnow().strftime("UTC-%Y%m%d-%H%M%S"))] * len(profilePoints)
+            if args.nWorkers:
+                # Single bin, share the toy sets instead
+                profiledFCToyStudier.cfg['nWorkers'] = args.nWorkers
 
             toyCollection.sigToyGenerator.cfg.update({
                 'scale': profiledFCToyStudier.cfg['nSetOfToys'] * 5,
@@ -3,13 +3,13 @@
 
 import os, pdb
 import sys
-import shelve
 import math
 import glob
 from subprocess import call
 from copy import copy, deepcopy
 
 from BsToPhiMuMuFitter.anaSetup import q2bins, modulePath
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 import BsToPhiMuMuFitter.StdFitter as StdFitter
 import v2Fitter.Batch.AbsBatchTaskWrapper as AbsBatchTaskWrapper
 
@@ -40,7 +40,7 @@ class SigMCStudier(AbsToyStudier.AbsToyStudier):
     """"""
     def getSubDataEntries(self, setIdx):
         try:
-            db = shelve.open(self.process.dbplayer.odbfile)
+            db = FitResultStore.getStore(self.process.dbplayer.odbfile)
             expectedYield = 400 #db['nSig']['getVal']
         finally:
             db.close()
@@ -89,6 +89,8 @@ setupSigMCStudier.update({
     'data': "sigMCValidation.Fit",
     'fitter': fitCollection.sig2DFitter,
     'nSetOfToys': 5,
+    'residentFitter': True,
+    'checkpointEvery': 20,
 })
 sigMCStudier = SigMCStudier(setupSigMCStudier)
 fitCollection.sig2DFitter.cfg['data'] = "sigMCValidation.Fit"
@@ -154,7 +156,7 @@ def func_postproc(args):
         h_setSummary_fl.Fit("f_setSummary_fl", "RL")
 
         # Draw
-        db = shelve.open(os.path.join(p.dbplayer.absInputDir, "fitResults_{0}.db".format(q2bins[binKey]['label'])))
+        db = FitResultStore.getStore(os.path.join(p.dbplayer.absInputDir, "fitResults_{0}.db".format(q2bins[binKey]['label'])))
         fl_GEN = StdFitter.unboundFlToFl(db['unboundFl_GEN']['getVal'])
         afb_GEN = StdFitter.unboundAfbToAfb(db['unboundAfb_GEN']['getVal'], fl_GEN)
         line = ROOT.TLine()
@@ -5,13 +5,13 @@ from __future__ import print_function
 
 import os
 import math
-import shelve
 from collections import OrderedDict
 
 import ROOT
 import BsToPhiMuMuFitter.cpp
 
 from BsToPhiMuMuFitter.anaSetup import q2bins, modulePath
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 from BsToPhiMuMuFitter.StdFitter import unboundFlToFl, unboundAfbToAfb
 from BsToPhiMuMuFitter.StdProcess import p
 
@@ -37,7 +37,7 @@ def table_sysFL_sysAFB():
         dbKeyToLine['syst_altFitRange'] = [r"$B$ mass range"]
         totalErrorLine = ["Total"]
         for binKey in ['belowJpsi', 'betweenPeaks', 'abovePsi2s', 'summary']:
-            db = shelve.open("{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']))
+            db = FitResultStore.getStore("{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']), readonly=True)
             totalSystErr = 0.
             for systKey, latexLine in dbKeyToLine.items():
                 err = db["{0}_{1}".format(systKey, var)]['getError']
@@ -79,7 +79,7 @@ def table_yields():
     binKeyToLine['abovePsi2s'] = ["5"]
     binKeyToLine['summary'] = ["0"]
     for binKey, latexLine in binKeyToLine.items():
-        db = shelve.open("{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']))
+        db = FitResultStore.getStore("{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']), readonly=True)
         latexLine.append("${0:.01f} \pm {1:.01f}$".format(db['nSig']['getVal'], db['nSig']['getError']))
         latexLine.append("${0:.01f} \pm {1:.01f}$".format(db['nBkgComb']['getVal'], db['nBkgComb']['getError']))
         db.close()
@@ -105,7 +105,7 @@ def table_coverageAFBFL():
     binKeyToLine['abovePsi2s'] = ["5"]
     binKeyToLine['summary'] = ["0"]
     for binKey, latexLine in binKeyToLine.items():
-        db = shelve.open("{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']))
+        db = FitResultStore.getStore("{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']), readonly=True)
         latexLine.append("{0:.1f}\%".format(db['stat_FC_afb']['coverage'] * 100.))
         latexLine.append("{0:.1f}\%".format(db['stat_FC_fl']['coverage'] * 100.))
         db.close()
@@ -145,7 +145,7 @@ def table_dataresAFBFL():
     ]
     for binKey, latexLine in binKeyToLine.items():
         if binKey not in ['jpsi', 'psi2s']:
-            db = shelve.open(r"{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']))
+            db = FitResultStore.getStore(r"{0}/fitResults_{1}.db".format(db_dir, q2bins[binKey]['label']), readonly=True)
             latexLine.append(r"${0:.01f} \pm {1:.01f}$".format(db['nSig']['getVal'], db['nSig']['getError']))
             fl = unboundFlToFl(db['unboundFl']['getVal'])
             latexLine.append("${0:.2f}^{{{1:+.2f}}}_{{{2:+.2f}}} \pm {3:.2f}$".format(
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# vim: set sts=4 sw=4 fdm=indent fdl=0 fdn=1 et:
+
+# Merge many fit result dbs, e.g. one per batch job, by a parallel tree reduction.
+# Example:
+#   python script/mergeFitDB.py -o fitResults_bin0.db -j 8 batchTask_*/job*/fitResults_bin0.db
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
+
+def mergeChunk(task):
+    """Merge a chunk of inputs, in order, into a new file"""
+    inputPaths, tmpDir, mode = task
+    fd, outputPath = tempfile.mkstemp(suffix=".db", prefix="mergeFitDB_", dir=tmpDir)
+    os.close(fd)
+    os.remove(outputPath)  # Let the store create it as SQLite
+    startTime = time.time()
+    nMerged = FitResultStore.mergeInto(outputPath, inputPaths, mode)
+    return outputPath, nMerged, time.time() - startTime
+
+def treeMerge(inputPaths, outputPath, mode="Overwrite", nWorkers=1, fanIn=16, tmpDir=None):
+    """Reduce inputPaths to outputPath, fanIn files per merge and nWorkers merges at a time.
+    The order of inputPaths is kept at every level, so the result is the same as a serial merge."""
+    if tmpDir is None:
+        tmpDir = os.path.dirname(os.path.abspath(outputPath))
+    if os.path.exists(outputPath):
+        # Existing records are the base, as for FitDBPlayer.MergeDB
+        inputPaths = [outputPath] + list(inputPaths)
+
+    startTime = time.time()
+    pool = Pool(processes=nWorkers) if nWorkers > 1 else None
+    level = list(inputPaths)
+    intermediates = set()
+    iLevel = 0
+    try:
+        while True:
+            tasks = [(level[i:i + fanIn], tmpDir, mode) for i in range(0, len(level), fanIn)]
+            results = pool.map(mergeChunk, tasks, chunksize=1) if pool else map(mergeChunk, tasks)
+            for path in level:
+                if path in intermediates:
+                    os.remove(path)
+                    intermediates.discard(path)
+            level = [r[0] for r in results]
+            intermediates.update(level)
+            print("INFO\t: Level {0}: {1} merge(s), {2} record(s) written, slowest {3:.1f} s".format(
+                iLevel, len(results), sum(r[1] for r in results), max(r[2] for r in results)))
+            iLevel += 1
+            if len(level) == 1:
+                break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    shutil.move(level[0], outputPath)
+    wallTime = time.time() - startTime
+    print("INFO\t: Merged {0} file(s) into {1} in {2:.1f} s ({3:.1f} file(s)/s)".format(
+        len(inputPaths), outputPath, wallTime, len(inputPaths) / max(wallTime, 1e-6)))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Merge fit result dbs with a parallel tree reduction.")
+    parser.add_argument(
+        'inputs',
+        nargs='+',
+        help="Input db files or glob patterns, merged in the given order. @file reads one path per line.",
+    )
+    parser.add_argument(
+        '-o', '--output',
+        dest='output',
+        required=True,
+        help="Output db file, existing records are kept as the base",
+    )
+    parser.add_argument(
+        '-m', '--mode',
+        dest='mode',
+        default="Overwrite",
+        choices=FitResultStore.mergeModes,
+        help="Policy for duplicated records (Default: Overwrite, the last input wins)",
+    )
+    parser.add_argument(
+        '-j', '--nWorkers',
+        dest='nWorkers',
+        type=int,
+        default=1,
+        help="Number of merges in parallel (Default: 1)",
+    )
+    parser.add_argument(
+        '-k', '--fanIn',
+        dest='fanIn',
+        type=int,
+        default=16,
+        help="Number of files per merge (Default: 16)",
+    )
+    parser.add_argument(
+        '--tmpDir',
+        dest='tmpDir',
+        default=None,
+        help="Directory of intermediate files (Default: directory of output)",
+    )
+    args = parser.parse_args()
+
+    inputPaths = []
+    for pattern in args.inputs:
+        if pattern.startswith("@"):
+            with open(pattern[1:]) as f:
+                inputPaths.extend(line.strip() for line in f if line.strip())
+        else:
+            inputPaths.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+    missing = [path for path in inputPaths if not os.path.exists(path)]
+    if missing:
+        print("ERROR\t: Input(s) not found: {0}".format(missing))
+        sys.exit(1)
+    if not inputPaths:
+        print("ERROR\t: No input")
+        sys.exit(1)
+    if args.fanIn < 2:
+        parser.error("fanIn must be at least 2")
+
+    treeMerge(inputPaths, args.output, args.mode, args.nWorkers, args.fanIn, args.tmpDir)
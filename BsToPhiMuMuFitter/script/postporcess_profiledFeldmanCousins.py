@@ -8,13 +8,17 @@ import sys
 import re
 import math
 import glob
-import shelve
-from subprocess import call
+import json
+import time
+import tempfile
+import traceback
 from argparse import ArgumentParser
 from multiprocessing import Pool
 
+import numpy as np
 import ROOT
 from BsToPhiMuMuFitter.anaSetup import modulePath, q2bins
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 from BsToPhiMuMuFitter.StdProcess import dbplayer
 from BsToPhiMuMuFitter.StdFitter import unboundFlToFl, unboundAfbToAfb
 from BsToPhiMuMuFitter.plotCollection import Plotter
@@ -22,184 +26,369 @@ from BsToPhiMuMuFitter.plotCollection import Plotter
 targetBinKeys = ["belowJpsi", "betweenPeaks", "abovePsi2s", "summary"]
 targetCoverage = 0.683
 
-def worker_mergeToys(task_dir):
-    for binKey in targetBinKeys:
-        for fileKey, wspaceKey in [("sigToyGenerator", "f_sig3DData"), ("bkgCombToyGenerator", "f_bkgCombData")]:
-            files = glob.glob(args.batchDir + "/" + task_dir + "/*/{0}_{1}.root".format(fileKey, q2bins[binKey]['label']))
-            merged_file = args.batchDir + "/" + task_dir + "/{0}_{1}.root".format(fileKey, q2bins[binKey]['label'])
-            if os.path.exists(merged_file) and args.mergeExists:
-                files.append(merged_file)
-
-            for fIdx, f in enumerate(files):
+def statFile(path):
+    fstat = os.stat(path)
+    return [fstat.st_mtime, fstat.st_size]
+
+def readManifest(merged_file):
+    """Inputs already in merged_file, None if it has to be built from scratch"""
+    manifestFile = merged_file + ".manifest.json"
+    if not (os.path.exists(merged_file) and os.path.exists(manifestFile)):
+        return None
+    with open(manifestFile) as f:
+        manifest = json.load(f)
+    if manifest.get('output') != statFile(merged_file):
+        # merged_file is modified by someone else
+        return None
+    return manifest
+
+def writeManifest(merged_file, manifest):
+    manifest['output'] = statFile(merged_file)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(merged_file), delete=False) as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(f.name, merged_file + ".manifest.json")
+
+def planMerge(task_dir, fileKey, dataKey, binKey):
+    """Decide the inputs of one merged file, only job outputs not merged yet unless rebuild is asked"""
+    label = q2bins[binKey]['label']
+    files = sorted(glob.glob(args.batchDir + "/" + task_dir + "/*/{0}_{1}.root".format(fileKey, label)))
+    merged_file = args.batchDir + "/" + task_dir + "/{0}_{1}.root".format(fileKey, label)
+    plan = {
+        'merged_file': merged_file,
+        'dataKey': dataKey,
+        'inputs': {},
+        'level': [],
+        'base': None,
+    }
+
+    manifest = None if args.rebuild else readManifest(merged_file)
+    if manifest is not None:
+        for f in files:
+            if f in manifest['inputs'] and manifest['inputs'][f] != statFile(f):
+                print("WARNING\t: {0} changed since last merge, rebuild {1}".format(f, merged_file))
+                manifest = None
+                break
+    if manifest is not None:
+        files = [f for f in files if f not in manifest['inputs']]
+        if not files:
+            return None
+        plan['base'] = manifest
+        plan['level'].append((merged_file, manifest['nEntries']))
+    elif os.path.exists(merged_file):
+        if dataKey is None:
+            # setSummary without manifest is never overwritten.
+            return None
+        elif args.mergeExists:
+            plan['level'].append((merged_file, None))
+
+    if not files:
+        if not plan['level']:
+            print("WARNING\t: {0}_{1}.root not found under {2}".format(fileKey, label, task_dir))
+        return None
+    for f in files:
+        plan['inputs'][f] = statFile(f)
+        plan['level'].append((f, None))
+    return plan
+
+def worker_mergeChunk(job):
+    """Merge a chunk of files in order. RooDataSet named dataKey is streamed one input at a time
+    into a vector store, reserved beforehand if the number of entries is known.
+    The merged RooDataSet is kept in memory until it is written, so a merge needs the memory of all entries of its inputs,
+    the final merge that of the whole output, whatever fanIn is.
+    Otherwise the files are merged as hadd does."""
+    result = {
+        'output': job['output'],
+        'nEntries': 0,
+        'bytesIn': sum(os.path.getsize(f) for f, nEntries in job['inputs']),
+        'wallTime': 0.,
+        'status': 0,
+        'error': None,
+    }
+    startTime = time.time()
+    fd, tmpName = tempfile.mkstemp(suffix=".root", prefix=".merge_", dir=os.path.dirname(job['output']))
+    os.close(fd)
+    try:
+        if job['dataKey'] is None:
+            merger = ROOT.TFileMerger(False)
+            merger.OutputFile(tmpName, "RECREATE")
+            for f, nEntries in job['inputs']:
+                merger.AddFile(f, False)
+            if not merger.Merge():
+                raise RuntimeError("Failed to merge {0}".format(job['output']))
+        else:
+            merged_dataset = None
+            for f, nEntries in job['inputs']:
+                fin = ROOT.TFile(f)
                 try:
-                    fin = ROOT.TFile(f)
-                    dataset = fin.Get(wspaceKey)
+                    dataset = fin.Get(job['dataKey'])
+                    if dataset == None:
+                        raise IOError("{0} not found in {1}".format(job['dataKey'], f))
+                    ROOT.SetOwnership(dataset, True)
                 finally:
                     fin.Close()
-
-                if fIdx == 0:
-                    merged_dataset = dataset
-                else:
-                    merged_dataset.append(dataset)
-
-            if len(files) > 0:
-                ofile = ROOT.TFile(merged_file, 'RECREATE')
-                #  print("DEBUG\t: Writing {0}_{1}.root under {2}".format(fileKey, q2bins[binKey]['label'], task_dir))
-                merged_dataset.Write()
-                ofile.Close()
-            else:
-                print("WARNING\t: {0}_{1}.root not found under {2}".format(fileKey, q2bins[binKey]['label'], task_dir))
+                if merged_dataset is None:
+                    merged_dataset = dataset.emptyClone()
+                    merged_dataset.convertToVectorStore()
+                    nExpected = sum(n for _, n in job['inputs']) if all(n is not None for _, n in job['inputs']) else None
+                    if nExpected and hasattr(merged_dataset.store(), "reserve"):
+                        merged_dataset.store().reserve(nExpected)
+                merged_dataset.append(dataset)
+                del dataset
+            result['nEntries'] = merged_dataset.numEntries()
+            ofile = ROOT.TFile(tmpName, 'RECREATE')
+            merged_dataset.Write()
+            ofile.Close()
+        os.rename(tmpName, job['output'])
+    except Exception:
+        result['status'] = 1
+        result['error'] = traceback.format_exc()
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+    result['wallTime'] = time.time() - startTime
+    return result
+
+def runMergePlans(plans):
+    """Reduce all plans level by level in one pool, args.fanIn files per merge.
+    Each level runs the merges of all task dirs and bins together."""
+    startTime = time.time()
+    nFiles = sum(len(plan['inputs']) for plan in plans)
+    bytesIn = 0
+    nMerges = 0
+    pool = Pool(processes=args.nWorkers)
+    try:
+        while plans:
+            jobs = []
+            owners = []
+            for plan in plans:
+                level = plan['level']
+                isFinal = len(level) <= args.fanIn
+                for idx in range(0, len(level), args.fanIn):
+                    if isFinal:
+                        output = plan['merged_file']
+                    else:
+                        fd, output = tempfile.mkstemp(suffix=".root", prefix=".merge_", dir=os.path.dirname(plan['merged_file']))
+                        os.close(fd)
+                    owners.append(plan)
+                    jobs.append({
+                        'inputs': level[idx:idx + args.fanIn],
+                        'output': output,
+                        'dataKey': plan['dataKey'],
+                        'isFinal': isFinal,
+                    })
+            results = pool.map(worker_mergeChunk, jobs, chunksize=1)
+            nMerges += len(jobs)
+            print("INFO\t: {0} merge(s) of {1} output(s) done, slowest {2:.1f} s".format(
+                len(jobs), len(plans), max(result['wallTime'] for result in results)))
+
+            for plan in plans:
+                # Intermediate files of the previous level are consumed
+                for f, nEntries in plan['level']:
+                    if os.path.basename(f).startswith(".merge_"):
+                        os.remove(f)
+                plan['level'] = []
+            for plan, job, result in zip(owners, jobs, results):
+                bytesIn += result['bytesIn']
+                if result['status'] != 0:
+                    plan['failed'] = True
+                    if not job['isFinal'] and os.path.exists(job['output']):
+                        os.remove(job['output'])
+                    print("ERROR\t: Failed to merge into {0}\n{1}".format(plan['merged_file'], result['error']))
+                    continue
+                plan['level'].append((result['output'], result['nEntries'] if plan['dataKey'] else None))
+                if job['isFinal']:
+                    manifest = plan['base'] if plan['base'] is not None else {'inputs': {}}
+                    manifest['inputs'].update(plan['inputs'])
+                    manifest['nEntries'] = result['nEntries']
+                    writeManifest(plan['merged_file'], manifest)
+                    plan['done'] = True
+            for plan in plans:
+                if plan.get('failed'):
+                    for f, nEntries in plan['level']:
+                        if os.path.basename(f).startswith(".merge_"):
+                            os.remove(f)
+            plans = [plan for plan in plans if not (plan.get('done') or plan.get('failed'))]
+    finally:
+        pool.close()
+        pool.join()
+
+    wallTime = max(time.time() - startTime, 1e-6)
+    print("INFO\t: Merged {0} new file(s) ({1:.1f} MB read) with {2} merge(s) in {3:.1f} s, {4:.1f} file(s)/s, {5:.1f} MB/s".format(
+        nFiles, bytesIn / 1e6, nMerges, wallTime, nFiles / wallTime, bytesIn / 1e6 / wallTime))
+
+def listTaskDirs(args):
+    return filter(lambda i: re.match(args.taskDirPatn, i) or re.match("bestFit", i), os.listdir(args.batchDir))
 
 def func_mergeToys(args):
     """Merge produced toys in work_dirs to task_dir"""
-    pool = Pool(processes=8)
-    pool.map(worker_mergeToys,
-             filter(lambda i: re.match(args.taskDirPatn, i) or re.match("bestFit", i), os.listdir(args.batchDir)))
-    pool.close()
-
-def worker_mergeSetSummary(task_dir):
-    for binKey in targetBinKeys:
-        fileKey = "setSummary"
-        files = glob.glob(args.batchDir + "/" + task_dir + "/*/{0}_{1}.root".format(fileKey, q2bins[binKey]['label']))
-        merged_file = args.batchDir + "/" + task_dir + "/{0}_{1}.root".format(fileKey, q2bins[binKey]['label'])
-
-        if os.path.exists(merged_file):
-            #  print("WARNING\t: {0} exists. Skip!".format(merged_file))
-            pass
-        elif len(files) > 0:
-            call(["hadd", merged_file] + files)
-        else:
-            print("WARNING\t: {0}_{1}.root not found under {2}".format(fileKey, q2bins[binKey]['label'], task_dir))
+    plans = []
+    for task_dir in listTaskDirs(args):
+        for binKey in targetBinKeys:
+            for fileKey, wspaceKey in [("sigToyGenerator", "f_sig3DData"), ("bkgCombToyGenerator", "f_bkgCombData")]:
+                plan = planMerge(task_dir, fileKey, wspaceKey, binKey)
+                if plan is not None:
+                    plans.append(plan)
+    runMergePlans(plans)
 
 def func_mergeSetSummary(args):
     """Merge produced toys in work_dirs to task_dir"""
-    pool = Pool(processes=8)
-    pool.map(worker_mergeSetSummary,
-             filter(lambda i: re.match(args.taskDirPatn, i) or re.match("bestFit", i), os.listdir(args.batchDir)))
-    pool.close()
+    plans = []
+    for task_dir in listTaskDirs(args):
+        for binKey in targetBinKeys:
+            plan = planMerge(task_dir, "setSummary", None, binKey)
+            if plan is not None:
+                plans.append(plan)
+    runMergePlans(plans)
     os.system("ls -l " + args.batchDir + "/*/setSummary_*.root")
     print("INFO\t: Please check the merged filesize makes sense, and then delete work_dirs.")
 
-def func_getFCConfInterval(args):
-    """Create FCConfInterval.root from setSummary.root"""
-    for binKey in targetBinKeys:
-        foutName = args.batchDir + "/FCConfInterval_{0}.root".format(q2bins[binKey]['label'])
-        if not os.path.exists(foutName):
-            fout = ROOT.TFile(foutName, 'RECREATE')
-            afbFitResults = {}
-            flFitResults = {}
-            for taskDir in filter(lambda i: re.match(r'(afb|fl)([+-]0\.\d{3})', i), os.listdir(args.batchDir)):
-                parseTaskDir = re.match(r'(afb|fl)([+-]0\.\d{3})', taskDir)
-                varName = parseTaskDir.group(1)
-                varVal = float(parseTaskDir.group(2))
-                setTag = "{0}{1:+04.0f}".format(varName, 1000 * varVal)
-                try:
-                    fin = ROOT.TFile(args.batchDir + "/" + taskDir + "/setSummary_{0}.root".format(q2bins[binKey]['label']))
-                    tree = fin.Get("tree")
-                    if varName == "afb":
-                        pdf = ROOT.TF1("pdf_{0}".format(setTag), "gaus(0)+[3]*exp(-0.5*(x/[4])**2)+[5]*exp(-0.5*((x-0.745)/[6])**2)+[7]*exp(-0.5*((x+0.745)/[8])**2)", -0.75, 0.75)
-                        pdf.SetParameter(1, varVal)
-                        pdf.SetParameter(2, 0.1)
-                        pdf.SetParameter(3, 10)
-                        pdf.SetParameter(4, 0.002)
-                        pdf.SetParameter(6, 0.002)
-                        pdf.SetParameter(8, 0.002)
-                        pdf.SetParLimits(0, 0, 10)
-                        pdf.SetParLimits(2, 0.02, 1)
-                        pdf.SetParLimits(3, 0., 200)  # spike at boundary
-                        pdf.SetParLimits(4, 0.001, 0.02)  # spike at boundary
-                        pdf.SetParLimits(5, 0., 200)  # spike at boundary
-                        pdf.SetParLimits(6, 0.001, 0.02)  # spike at boundary
-                        pdf.SetParLimits(7, 0., 200)  # spike at boundary
-                        pdf.SetParLimits(8, 0.001, 0.02)  # spike at boundary
-                        hist = ROOT.TH1F("hist_{0}".format(setTag), "", 1500, -0.75, 0.75)
-                        afbFitResults[varVal] = {
-                            'pdf': pdf,
-                            'hist': hist
-                        }
-                    else:
-                        pdf = ROOT.TF1("pdf_{0}".format(setTag), "gaus(0)+[3]*exp(-0.5*(x/[4])**2)+[5]*exp(-0.5*((x-0.995)/[6])**2)", 0, 1)
-                        pdf.SetParameter(1, varVal)
-                        pdf.SetParameter(2, 0.1)
-                        pdf.SetParameter(3, 10)
-                        pdf.SetParameter(4, 0.002)
-                        pdf.SetParameter(5, 10)
-                        pdf.SetParameter(6, 0.002)
-                        pdf.SetParLimits(0, 0, 10)
-                        pdf.SetParLimits(2, 0.02, 1)
-                        pdf.SetParLimits(3, 0., 200)  # spike at boundary
-                        pdf.SetParLimits(4, 0.001, 0.02)  # spike at boundary
-                        pdf.SetParLimits(5, 0., 200)  # spike at boundary
-                        pdf.SetParLimits(6, 0.001, 0.02)  # spike at boundary
-                        hist = ROOT.TH1F("hist_{0}".format(setTag), "", 1000, 0, 1)
-                        flFitResults[varVal] = {
-                            'pdf': pdf,
-                            'hist': hist
-                        }
-
-                    tree.Draw("{0} >> hist_{1}".format(varName, setTag))
-                    hist.SetDirectory(0)  # Decouple hist with fin
-                    hist.Scale(1 / hist.GetBinWidth(1) / hist.GetSumOfWeights())
-                    hist.Fit(pdf, "RLQ")
-
-                    fout.cd()
-                    hist.Write()
-                    pdf.Write()
-                finally:
-                    fin.Close()
+# Density of the measured value at each profile point, a core gaussian plus narrow spikes at the boundaries.
+beltModels = {
+    'afb': {
+        'tag': "Afb",
+        'range': (-0.75, 0.75),
+        'nBins': 1500,
+        'nLRatioBins': 150,
+        'spikes': [0., 0.745, -0.745],
+        'initPars': {2: 0.1, 3: 10, 4: 0.002, 6: 0.002, 8: 0.002},
+        'parLimits': {0: (0, 10), 2: (0.02, 1), 3: (0., 200), 4: (0.001, 0.02), 5: (0., 200), 6: (0.001, 0.02), 7: (0., 200), 8: (0.001, 0.02)},
+    },
+    'fl': {
+        'tag': "Fl",
+        'range': (0., 1.),
+        'nBins': 1000,
+        'nLRatioBins': 100,
+        'spikes': [0., 0.995],
+        'initPars': {2: 0.1, 3: 10, 4: 0.002, 5: 10, 6: 0.002},
+        'parLimits': {0: (0, 10), 2: (0.02, 1), 3: (0., 200), 4: (0.001, 0.02), 5: (0., 200), 6: (0.001, 0.02)},
+    },
+}
+
+def beltFormula(varName):
+    return "gaus(0)" + "".join("+[{0}]*exp(-0.5*((x{1:+g})/[{2}])**2)".format(3 + 2 * iSpike, -center, 4 + 2 * iSpike)
+                               for iSpike, center in enumerate(beltModels[varName]['spikes']))
+
+def evalBeltDensity(varName, pars, x):
+    """NumPy twin of beltFormula, pars in shape (nTrue, nPars) and x in shape (nX,), return shape (nTrue, nX)"""
+    p = pars.T[:, :, None]
+    x = x[None, :]
+    density = p[0] * np.exp(-0.5 * ((x - p[1]) / p[2]) ** 2)
+    for iSpike, center in enumerate(beltModels[varName]['spikes']):
+        density = density + p[3 + 2 * iSpike] * np.exp(-0.5 * ((x - center) / p[4 + 2 * iSpike]) ** 2)
+    return density
+
+def binCenters(lo, hi, nBins):
+    edges = np.linspace(lo, hi, nBins + 1)
+    return 0.5 * (edges[1:] + edges[:-1])
+
+def readSetSummary(fname, varName):
+    """Values of varName of all toys in one setSummary file"""
+    if not os.path.exists(fname):
+        return None
+    return np.asarray(ROOT.RDataFrame("tree", fname).AsNumpy([varName])[varName], dtype=np.float64)
+
+def fitBeltPoint(varName, varVal, setTag, values):
+    """Binned likelihood fit of the measured values at one profile point"""
+    model = beltModels[varName]
+    pdf = ROOT.TF1("pdf_{0}".format(setTag), beltFormula(varName), *model['range'])
+    pdf.SetParameter(1, varVal)
+    for iPar, val in model['initPars'].items():
+        pdf.SetParameter(iPar, val)
+    for iPar, limits in model['parLimits'].items():
+        pdf.SetParLimits(iPar, *limits)
+    hist = ROOT.TH1F("hist_{0}".format(setTag), "", model['nBins'], *model['range'])
+    hist.SetDirectory(0)
+    hist.FillN(len(values), values, np.ones(len(values)))
+    hist.Scale(1 / hist.GetBinWidth(1) / hist.GetSumOfWeights())
+    hist.Fit(pdf, "RLQ")
+    counts = np.histogram(values, bins=model['nBins'], range=model['range'])[0]
+    return hist, pdf, counts
+
+def buildBelt(varName, pars, counts, coverage=targetCoverage):
+    """Likelihood ratio ordering for all true values at once.
+    Bins of measured value are accepted in descending likelihood ratio until the toys in them reach coverage,
+    return the lower and upper bounds of the accepted region for each true value."""
+    model = beltModels[varName]
+    centers = binCenters(model['range'][0], model['range'][1], model['nBins'])
+    density = evalBeltDensity(varName, pars, centers)
+    lRatio = density / np.maximum(density.max(axis=0), np.finfo(np.float64).tiny)
+
+    order = np.argsort(-lRatio, axis=1, kind='mergesort')
+    rowIdx = np.arange(len(pars))[:, None]
+    prob = counts / np.maximum(counts.sum(axis=1, keepdims=True), 1.)
+    cumProb = np.cumsum(prob[rowIdx, order], axis=1)
+    nAccepted = np.argmax(cumProb >= coverage, axis=1) + 1
+    rank = np.empty_like(order)
+    rank[rowIdx, order] = np.arange(order.shape[1])[None, :]
+    accepted = rank < nAccepted[:, None]
+    ciLo = np.where(accepted, centers[None, :], np.inf).min(axis=1)
+    ciHi = np.where(accepted, centers[None, :], -np.inf).max(axis=1)
+    return ciLo, ciHi
+
+def fillLRatioHist(varName, trueVals, pars):
+    """Likelihood ratio map of measured value (x) vs true value (y)"""
+    model = beltModels[varName]
+    nBins = model['nLRatioBins']
+    hist = ROOT.TH2F("LRatio{0}".format(model['tag']), "", nBins, model['range'][0], model['range'][1], nBins, model['range'][0], model['range'][1])
+    density = evalBeltDensity(varName, pars, binCenters(model['range'][0], model['range'][1], nBins))
+    lRatio = density / np.maximum(density.max(axis=0), np.finfo(np.float64).tiny)
+    content = np.zeros((nBins + 2, nBins + 2))
+    for trueVal, row in zip(trueVals, lRatio):
+        content[hist.GetYaxis().FindBin(trueVal), 1:nBins + 1] = row
+    hist.SetContent(content.ravel())
+    return hist
+
+def worker_getFCConfInterval(binKey):
+    foutName = args.batchDir + "/FCConfInterval_{0}.root".format(q2bins[binKey]['label'])
+    if os.path.exists(foutName):
+        return
+    samples = {'afb': {}, 'fl': {}}
+    for taskDir in filter(lambda i: re.match(r'(afb|fl)([+-]0\.\d{3})', i), os.listdir(args.batchDir)):
+        parseTaskDir = re.match(r'(afb|fl)([+-]0\.\d{3})', taskDir)
+        varName = parseTaskDir.group(1)
+        values = readSetSummary(args.batchDir + "/" + taskDir + "/setSummary_{0}.root".format(q2bins[binKey]['label']), varName)
+        if values is None or len(values) == 0:
+            print("WARNING\t: No toy found under {0} for {1}".format(taskDir, binKey))
+            continue
+        samples[varName][float(parseTaskDir.group(2))] = values
+
+    fout = ROOT.TFile(foutName, 'RECREATE')
+    for varName in ["afb", "fl"]:
+        trueVals = sorted(samples[varName].keys())
+        pars = []
+        counts = []
+        for varVal in trueVals:
+            setTag = "{0}{1:+04.0f}".format(varName, 1000 * varVal)
+            hist, pdf, count = fitBeltPoint(varName, varVal, setTag, samples[varName][varVal])
+            fout.cd()
+            hist.Write()
+            pdf.Write()
+            pars.append([pdf.GetParameter(iPar) for iPar in range(pdf.GetNpar())])
+            counts.append(count)
+
+        graphs = (ROOT.TGraph(), ROOT.TGraph())
+        if trueVals:
+            pars = np.array(pars)
+            counts = np.array(counts, dtype=np.float64)
+            fillLRatioHist(varName, trueVals, pars).Write()
+            for trueVal, lo, hi in zip(trueVals, *buildBelt(varName, pars, counts)):
+                graphs[0].SetPoint(graphs[0].GetN(), lo, trueVal)
+                graphs[1].SetPoint(graphs[1].GetN(), hi, trueVal)
+        graphs[0].Write("gr_{0}CILo".format(varName))
+        graphs[1].Write("gr_{0}CIHi".format(varName))
+    fout.Close()
 
-            # Prepare likelihood ratio map for later use
-            LRatioAfb = ROOT.TH2F("LRatioAfb", "", 150, -0.75, 0.75, 150, -0.75, 0.75)
-            for afbMeas in afbFitResults.keys():
-                maxLh = max([afbFitResults[afbTrue]['pdf'].Eval(afbMeas) for afbTrue in afbFitResults.keys()])
-                for afbTrue in afbFitResults.keys():
-                    LRatioAfb.SetBinContent(LRatioAfb.FindBin(afbMeas, afbTrue), afbFitResults[afbTrue]['pdf'].Eval(afbMeas) / maxLh)
-            LRatioAfb.Write()
-
-            LRatioFl = ROOT.TH2F("LRatioFl", "", 100, 0., 1., 100, 0., 1.)
-            for flMeas in flFitResults.keys():
-                maxLh = max([flFitResults[flTrue]['pdf'].Eval(flMeas) for flTrue in flFitResults.keys()])
-                for flTrue in flFitResults.keys():
-                    LRatioFl.SetBinContent(LRatioFl.FindBin(flMeas, flTrue), flFitResults[flTrue]['pdf'].Eval(flMeas) / maxLh)
-            LRatioFl.Write()
-
-            # Scan confidence interval based on LR
-            gr_afbCILo = ROOT.TGraph()
-            gr_afbCIHi = ROOT.TGraph()
-            for afbTrue in afbFitResults.keys():
-                hcdf = afbFitResults[afbTrue]['hist'].GetCumulative()
-                cumulativeMax = hcdf.GetBinContent(hcdf.GetNbinsX())
-                afbTrueBin = LRatioAfb.GetYaxis().FindBin(afbTrue)
-                minAfbBin, maxAfbBin = 1, hcdf.GetNbinsX()
-                while (hcdf.GetBinContent(maxAfbBin) - hcdf.GetBinContent(minAfbBin)) / cumulativeMax > targetCoverage:
-                    if LRatioAfb.GetBinContent(LRatioAfb.FindBin(hcdf.GetXaxis().GetBinCenter(minAfbBin), afbTrue))\
-                            > LRatioAfb.GetBinContent(LRatioAfb.FindBin(hcdf.GetXaxis().GetBinCenter(maxAfbBin), afbTrue)):
-                        maxAfbBin -= 1
-                    else:
-                        minAfbBin += 1
-                gr_afbCILo.SetPoint(afbTrueBin, hcdf.GetXaxis().GetBinCenter(minAfbBin), afbTrue)
-                gr_afbCIHi.SetPoint(afbTrueBin, hcdf.GetXaxis().GetBinCenter(maxAfbBin), afbTrue)
-            gr_afbCILo.Write("gr_afbCILo")
-            gr_afbCIHi.Write("gr_afbCIHi")
-
-            gr_flCILo = ROOT.TGraph()
-            gr_flCIHi = ROOT.TGraph()
-            for flTrue in flFitResults.keys():
-                hcdf = flFitResults[flTrue]['hist'].GetCumulative()
-                cumulativeMax = hcdf.GetBinContent(hcdf.GetNbinsX())
-                flTrueBin = LRatioFl.GetYaxis().FindBin(flTrue)
-                minFlBin, maxFlBin = 1, hcdf.GetNbinsX()
-                while (hcdf.GetBinContent(maxFlBin) - hcdf.GetBinContent(minFlBin)) / cumulativeMax > targetCoverage:
-                    if LRatioFl.GetBinContent(LRatioFl.FindBin(hcdf.GetXaxis().GetBinCenter(minFlBin), flTrue))\
-                            > LRatioFl.GetBinContent(LRatioFl.FindBin(hcdf.GetXaxis().GetBinCenter(maxFlBin), flTrue)):
-                        maxFlBin -= 1
-                    else:
-                        minFlBin += 1
-                gr_flCILo.SetPoint(flTrueBin, hcdf.GetXaxis().GetBinCenter(minFlBin), flTrue)
-                gr_flCIHi.SetPoint(flTrueBin, hcdf.GetXaxis().GetBinCenter(maxFlBin), flTrue)
-            gr_flCILo.Write("gr_flCILo")
-            gr_flCIHi.Write("gr_flCIHi")
-            fout.Close()
+def func_getFCConfInterval(args):
+    """Create FCConfInterval.root from setSummary.root, bins in parallel"""
+    if args.nWorkers > 1:
+        pool = Pool(processes=min(args.nWorkers, len(targetBinKeys)))
+        try:
+            pool.map(worker_getFCConfInterval, targetBinKeys, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for binKey in targetBinKeys:
+            worker_getFCConfInterval(binKey)
 
 def filterVeryBiasedPoint(gr, nSigma=1):
     """Clean very biased point in TGraph"""
@@ -264,8 +453,8 @@ def func_fitFCConfInterval(args):
             Plotter.latexCMSExtra()
             Plotter.latexLumi()
 
-        db = shelve.open(args.dbDirPath + "/fitResults_{0}.db".format(q2bins[binKey]['label']),
-                         writeback=True if args.saveToDB else False)
+        db = FitResultStore.getStore(args.dbDirPath + "/fitResults_{0}.db".format(q2bins[binKey]['label']),
+                                     readonly=not args.saveToDB)
         fl = unboundFlToFl(db['unboundFl']['getVal'])
         afb = unboundAfbToAfb(db['unboundAfb']['getVal'], fl)
         fin = ROOT.TFile(args.batchDir + "/FCConfInterval_{0}.root".format(q2bins[binKey]['label']))
@@ -360,17 +549,18 @@ def func_fitFCConfInterval(args):
             Plotter.canvas.Print(args.batchDir + "/FCConfInterval_fl_global_{0}.pdf".format(q2bins[binKey]['label']))
 
         if args.saveToDB:
-            db['stat_FC_afb'] = {
+            stat_FC_afb = {
                 'getErrorHi': stat_FC_afb_getErrorHi,
                 'getErrorLo': stat_FC_afb_getErrorLo,
             }
-            db['stat_FC_fl'] = {
+            stat_FC_fl = {
                 'getErrorHi': stat_FC_fl_getErrorHi,
                 'getErrorLo': stat_FC_fl_getErrorLo,
             }
             if stat_FC_afb_coverage != 0 and stat_FC_fl_coverage != 0:
-                db['stat_FC_afb']['coverage'] = stat_FC_afb_coverage
-                db['stat_FC_fl']['coverage'] = stat_FC_fl_coverage
+                stat_FC_afb['coverage'] = stat_FC_afb_coverage
+                stat_FC_fl['coverage'] = stat_FC_fl_coverage
+            db.update({'stat_FC_afb': stat_FC_afb, 'stat_FC_fl': stat_FC_fl})
             print(db['stat_FC_afb'])
             print(db['stat_FC_fl'])
 
@@ -403,6 +593,29 @@ if __name__ == '__main__':
         help="Regex pattern of task_dir under batchDir",
     )
 
+    parser.add_argument(
+        '-j', '--nWorkers',
+        dest="nWorkers",
+        type=int,
+        default=8,
+        help="Number of merges in parallel, over files, bins and task_dirs (Default: 8)",
+    )
+
+    parser.add_argument(
+        '-k', '--fanIn',
+        dest="fanIn",
+        type=int,
+        default=16,
+        help="Number of files per merge (Default: 16). Each RooDataSet merge holds all of its entries in memory, the final one the whole output, per parallel merge",
+    )
+
+    parser.add_argument(
+        '--rebuild',
+        dest="rebuild",
+        action='store_true',
+        help="Merge all job outputs again instead of only the new ones. (Default: False)",
+    )
+
     subparsers = parser.add_subparsers(help='Functions', dest='Function_name')
     subparser_mergeToys = subparsers.add_parser('mergeToys')
     subparser_mergeToys.add_argument(
@@ -441,6 +654,8 @@ if __name__ == '__main__':
     )
 
     args = parser.parse_args()
+    if args.fanIn < 2:
+        parser.error("fanIn must be at least 2")
     args.func(args)
 
     sys.exit()
@@ -11,6 +11,7 @@ import BsToPhiMuMuFitter.fitCollection as fitCollection
 import BsToPhiMuMuFitter.plotCollection as plotCollection
 from BsToPhiMuMuFitter.anaSetup import q2bins
 from BsToPhiMuMuFitter.StdProcess import p
+from v2Fitter.FlowControl.BinPool import runBinsInPool
 from argparse import ArgumentParser
 
 # Standard fitting procedures
@@ -41,14 +42,34 @@ if __name__ == '__main__':
     parser = ArgumentParser(prog='seqCollection')
     parser.add_argument('-b', '--binKey', dest='binKey', type=str, default=p.cfg['binKey'])
     parser.add_argument('-s', '--seq', dest='seqKey', type=str, default=None)
+    parser.add_argument('-j', '--nWorkers', dest='nWorkers', type=int, default=1, help="Number of bins to be processed in parallel.")
+    parser.add_argument('--minosWorkers', dest='minosWorkers', type=int, default=1, help="Number of processes for MINOS of the final fit, one parameter each.")
     args = parser.parse_args()
     if args.binKey =="all":                                                                                                                    
         p.cfg['bins'] = ["belowJpsiA", "belowJpsiB", "belowJpsiC", "betweenPeaks", "abovePsi2sA", "abovePsi2sB", "summary", "summaryLowQ2"]
     else: 
         p.cfg['bins'] = [key for key in q2bins.keys() if q2bins[key]['label']==args.binKey]
     p.cfg['seqKey']= args.seqKey
+    # Standalone final fit only, toy studies keep the serial default.
+    fitCollection.finalFitter.cfg['minosWorkers'] = args.minosWorkers
     #pdb.set_trace()
     #p.name="sigMCValidationProcess" 
+    if args.nWorkers > 1 and len(p.cfg['bins']) > 1:
+        # The efficiency maps of all bins are built into a shared file in one go, do it here before forking.
+        if dataCollection.effiHistReader in predefined_sequence[args.seqKey]:
+            p.cfg['binKey'] = p.cfg['bins'][0]
+            p.setSequence([dataCollection.effiHistReader])
+            try:
+                p.beginSeq()
+                p.runSeq()
+            finally:
+                p.endSeq()
+                p.reset()
+                for obj in p._sequence: obj.reset()
+        results = runBinsInPool(p, predefined_sequence[args.seqKey], p.cfg['bins'], args.nWorkers)
+        if any(r['status'] != 0 for r in results):
+            sys.exit(1)
+        sys.exit(0)
     for b in p.cfg['bins']:
         p.cfg['binKey'] = b
         p.setSequence(predefined_sequence[args.seqKey])
@@ -4,8 +4,8 @@
 from __future__ import print_function
 
 import os, sys, math, pdb
+import time
 import types
-import shelve
 import functools
 from copy import deepcopy
 
@@ -16,6 +16,7 @@ from v2Fitter.Fitter.FitterCore import FitterCore
 from v2Fitter.Fitter.AbsToyStudier import AbsToyStudier
 from v2Fitter.Fitter.DataReader import DataReader
 from BsToPhiMuMuFitter.anaSetup import q2bins #, cut_kshortWindow
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 from BsToPhiMuMuFitter.StdFitter import StdFitter, unboundFlToFl, unboundAfbToAfb
 from BsToPhiMuMuFitter.FitDBPlayer import FitDBPlayer
 from BsToPhiMuMuFitter.plotCollection import Plotter, plotter
@@ -31,6 +32,132 @@ from argparse import ArgumentParser
 
 # Limited MC size
 # # Determinded by varying efficiency map with FitDBPlayer.fluctuateFromDB.
+def getEffiCovariance(dbfile, effiArgs):
+    """Covariance of effiArgs saved by the efficiency fit, diagonal from their errors if unavailable"""
+    names = [effiArg.GetName() for effiArg in effiArgs]
+    cov = FitDBPlayer.getCovarianceFromDB(dbfile, fitCollection.effiFitter.name)
+    if cov is not None and all(name in cov['params'] for name in names):
+        idx = [cov['params'].index(name) for name in names]
+        return [[cov['matrix'][i][j] for j in idx] for i in idx]
+    print("WARNING\t: No reliable covariance of the efficiency fit, correlations of cross terms are ignored.")
+    return [[effiArg.getError()**2 if iArg == jArg else 0. for jArg, _ in enumerate(effiArgs)] for iArg, effiArg in enumerate(effiArgs)]
+
+def getLinearEffiResponse(fitter, effiArgs, effiSigmas, stepFrac=0.1):
+    """Shift of the fitted parameters per unit shift of effiArgs, J = -V*M at the minimum of fitter.
+    V is the covariance of the fit and M the cross-derivatives of the NLL, by finite differences.
+    Return the floating parameters and J."""
+    fitResult = fitter.fitter.Save()
+    floatPars = fitResult.floatParsFinal()
+    covMatrix = fitResult.covarianceMatrix()
+    nPar = floatPars.getSize()
+    thetas = [fitter.args.find(floatPars.at(iPar).GetName()) for iPar in range(nPar)]
+    thetaSteps = [stepFrac * math.sqrt(covMatrix(iPar, iPar)) for iPar in range(nPar)]
+    nll = fitter._nll
+
+    thetaSpans = [0.] * nPar
+    crossDeriv = [[0.] * len(effiArgs) for iPar in range(nPar)]
+    for jEffi, effiArg in enumerate(effiArgs):
+        effiVal = effiArg.getVal()
+        effiShifted = []
+        nllVals = {}
+        for effiSign in (1, -1):
+            effiArg.setVal(effiVal + effiSign * effiSigmas[jEffi])
+            effiShifted.append(effiArg.getVal())
+            fitter.fitter.NotifyConstChange()
+            for iPar, theta in enumerate(thetas):
+                thetaVal = theta.getVal()
+                thetaShifted = []
+                for thetaSign in (1, -1):
+                    theta.setVal(thetaVal + thetaSign * thetaSteps[iPar])
+                    thetaShifted.append(theta.getVal())
+                    nllVals[iPar, effiSign, thetaSign] = nll.getVal()
+                theta.setVal(thetaVal)
+                thetaSpans[iPar] = thetaShifted[0] - thetaShifted[1]  # Steps may be clipped at the limits
+        effiArg.setVal(effiVal)
+        fitter.fitter.NotifyConstChange()
+        for iPar in range(nPar):
+            crossDeriv[iPar][jEffi] = (nllVals[iPar, 1, 1] - nllVals[iPar, 1, -1] - nllVals[iPar, -1, 1] + nllVals[iPar, -1, -1]) / (thetaSpans[iPar] * (effiShifted[0] - effiShifted[1]))
+
+    response = [[-sum(covMatrix(iPar, kPar) * crossDeriv[kPar][jEffi] for kPar in range(nPar)) for jEffi in range(len(effiArgs))] for iPar in range(nPar)]
+    return thetas, response
+
+def getCholeskyFactor(covMatrix):
+    """Lower triangular L with L*L^T = covMatrix, such that L*z is correlated for z of independent unit Gaussians"""
+    nDim = len(covMatrix)
+    mat = ROOT.TMatrixDSym(nDim)
+    for i in range(nDim):
+        for j in range(nDim):
+            mat[i][j] = covMatrix[i][j]
+    chol = ROOT.TDecompChol(mat)
+    if not chol.Decompose():
+        print("WARNING\t: Covariance of the efficiency fit is not positive definite, correlations are ignored.")
+        return [[math.sqrt(max(covMatrix[i][i], 0.)) if i == j else 0. for j in range(nDim)] for i in range(nDim)]
+    upper = chol.GetU()
+    return [[upper(j, i) for j in range(nDim)] for i in range(nDim)]
+
+def runLinearRandEffi(fitter, foutName, nSamples, nValidation):
+    """Propagate the covariance of the cross terms to afb and fl with the linearised response of the nominal fit.
+    Only nValidation of the nSamples variations are refitted, to compare with the linear prediction."""
+    effiArgs = []
+    FitterCore.ArgLooper(fitter.args, lambda iArg: effiArgs.append(iArg), targetArgs=[r"x\d{1,2}"])
+    effiArgs.sort(key=lambda iArg: int(iArg.GetName()[1:]))
+    effiCov = getEffiCovariance(fitter.process.dbplayer.odbfile, effiArgs)
+    effiVals = [effiArg.getVal() for effiArg in effiArgs]
+    effiSigmas = [math.sqrt(effiCov[i][i]) for i in range(len(effiArgs))]
+    lowerFactor = getCholeskyFactor(effiCov)
+
+    startTime = time.time()
+    thetas, response = getLinearEffiResponse(fitter, effiArgs, effiSigmas)
+    thetaVals = [theta.getVal() for theta in thetas]
+    # Shift of the fitted parameters for unit Gaussians, response*L
+    sampleResponse = [[sum(response[iPar][kEffi] * lowerFactor[kEffi][jEffi] for kEffi in range(len(effiArgs))) for jEffi in range(len(effiArgs))] for iPar in range(len(thetas))]
+    print("INFO\t: Linear response of {0} parameter(s) to {1} cross term(s) in {2:.1f} s".format(len(thetas), len(effiArgs), time.time() - startTime))
+
+    afb = fitter.process.sourcemanager.get('afb')
+    fl = fitter.process.sourcemanager.get('fl')
+    hist_afb = ROOT.TH1F("hist_afb", "", 300, -0.75, 0.75)
+    hist_afb.GetXaxis().SetTitle("A_{{FB}}")
+    hist_fl = ROOT.TH1F("hist_fl", "", 200, 0., 1.)
+    hist_fl.GetXaxis().SetTitle("F_{{L}}")
+    validation = ROOT.TNtuple("validation", "Linear prediction vs refit", "afbLinear:afbRefit:flLinear:flRefit:status")
+
+    def setLinear(gaus):
+        for iPar, theta in enumerate(thetas):
+            theta.setVal(thetaVals[iPar] + sum(sampleResponse[iPar][jEffi] * gaus[jEffi] for jEffi in range(len(effiArgs))))
+
+    def restoreNominal():
+        for iPar, theta in enumerate(thetas):
+            theta.setVal(thetaVals[iPar])
+        for jEffi, effiArg in enumerate(effiArgs):
+            effiArg.setVal(effiVals[jEffi])
+        fitter.fitter.NotifyConstChange()
+
+    startTime = time.time()
+    for iSample in range(nSamples):
+        gaus = [ROOT.gRandom.Gaus() for jEffi in range(len(effiArgs))]
+        setLinear(gaus)
+        afbLinear, flLinear = afb.getVal(), fl.getVal()
+        hist_afb.Fill(afbLinear)
+        hist_fl.Fill(flLinear)
+        if iSample < nValidation:
+            restoreNominal()
+            for jEffi, effiArg in enumerate(effiArgs):
+                effiArg.setVal(effiVals[jEffi] + sum(lowerFactor[jEffi][kEffi] * gaus[kEffi] for kEffi in range(len(effiArgs))))
+            fitter.fitter.NotifyConstChange()
+            status = fitter.fitter.FitMigrad().status()
+            validation.Fill(afbLinear, afb.getVal(), flLinear, fl.getVal(), status)
+            print("INFO\t: Validation {0}: afb {1:.4f} (linear) {2:.4f} (refit), fl {3:.4f} (linear) {4:.4f} (refit), status {5}".format(
+                iSample, afbLinear, afb.getVal(), flLinear, fl.getVal(), status))
+        restoreNominal()
+    print("INFO\t: {0} variation(s) in {1:.1f} s, {2} refitted".format(nSamples, time.time() - startTime, min(nValidation, nSamples)))
+
+    fout = ROOT.TFile(foutName, "RECREATE")
+    fout.cd()
+    hist_afb.Write()
+    hist_fl.Write()
+    validation.Write()
+    fout.Close()
+
 def func_randEffi(args):
     """ Typically less than 5% """
     setupFinalRandEffiFitter = deepcopy(fitCollection.setupFinalFitter)
@@ -55,7 +182,9 @@ def func_randEffi(args):
 
     finalRandEffiFitter._preFitSteps = types.MethodType(preFitSteps_randEffi, finalRandEffiFitter)
 
-    foutName = "syst_randEffi_{0}.root".format(q2bins[args.binKey]['label'])
+    # Each mode keeps its own output, a result of one mode is never taken for the other
+    foutPrefix = "syst_randEffiLinear" if args.mode == 'linear' else "syst_randEffi"
+    foutName = "{0}_{1}.root".format(foutPrefix, q2bins[args.binKey]['label'])
     class effiStudier(AbsToyStudier):
         def _preSetsLoop(self):
             self.hist_afb = ROOT.TH1F("hist_afb", "", 300, -0.75, 0.75)
@@ -73,6 +202,9 @@ def func_randEffi(args):
                 self.hist_afb.Fill(afb.getVal())
                 self.hist_fl.Fill(fl.getVal())
 
+        def checkpointObjects(self):
+            return {'hist_afb': self.hist_afb, 'hist_fl': self.hist_fl}
+
         def _postSetsLoop(self):
             fout = ROOT.TFile(foutName, "RECREATE")
             fout.cd()
@@ -93,13 +225,23 @@ def func_randEffi(args):
         'data': "dataReader.Fit",
         'fitter': finalRandEffiFitter,
         'nSetOfToys': 200,
+        'nWorkers': args.nWorkers,
+        'baseSeed': args.baseSeed,
+        'checkpointEvery': 20,
     })
     studier = effiStudier(setupStudier)
 
+    # Linear mode fits once, with Hesse for the covariance, and propagates the cross terms from there
+    setupNominalFitter = deepcopy(setupFinalRandEffiFitter)
+    setupNominalFitter.update({
+        'FitHesse': True,
+    })
+    nominalFitter = StdFitter(setupNominalFitter)
+
     p.setSequence([
         pdfCollection.stdWspaceReader,
         dataCollection.dataReader,
-        studier,
+        nominalFitter if args.mode == 'linear' else studier,
     ])
 
     try:
@@ -107,7 +249,11 @@ def func_randEffi(args):
         if os.path.exists("{0}".format(foutName)):
             print("{0} exists, skip fitting procedure".format(foutName))
         else:
+            if args.mode == 'linear' and args.baseSeed is not None:
+                ROOT.gRandom.SetSeed(args.baseSeed)
             p.runSeq()
+            if args.mode == 'linear':
+                runLinearRandEffi(nominalFitter, foutName, args.nSamples, args.nValidation)
 
         fin = ROOT.TFile("{0}".format(foutName))
 
@@ -139,14 +285,14 @@ def func_randEffi(args):
             Plotter.latexCMSMark()
             Plotter.latexCMSExtra()
             Plotter.latexCMSSim()
-            canvas.Print("syst_randEffi_afb_{0}.pdf".format(q2bins[args.binKey]['label']))
+            canvas.Print("{0}_afb_{1}.pdf".format(foutPrefix, q2bins[args.binKey]['label']))
 
             hist_fl.GetXaxis().SetTitle("F_{{L}}")
             hist_fl.Draw("HIST")
             Plotter.latexCMSMark()
             Plotter.latexCMSExtra()
             Plotter.latexCMSSim()
-            canvas.Print("syst_randEffi_fl_{0}.pdf".format(q2bins[args.binKey]['label']))
+            canvas.Print("{0}_fl_{1}.pdf".format(foutPrefix, q2bins[args.binKey]['label']))
 
         if args.updateDB:
             FitDBPlayer.UpdateToDB(p.dbplayer.odbfile, syst_randEffi)
@@ -158,7 +304,7 @@ def func_randEffi(args):
 def updateToDB_altShape(args, tag):
     pdb.set_trace()
     """ Template db entry maker for syst """
-    db = shelve.open(p.dbplayer.odbfile)
+    db = FitResultStore.getStore(p.dbplayer.odbfile)
     nominal_fl = unboundFlToFl(db['unboundFl']['getVal'])
     nominal_afb = unboundAfbToAfb(db['unboundAfb']['getVal'], nominal_fl)
     db.close()
@@ -215,7 +361,7 @@ def func_simMismodel(args):
     p.setSequence([])
     try:
         p.beginSeq()
-        db = shelve.open(p.dbplayer.odbfile)
+        db = FitResultStore.getStore(p.dbplayer.odbfile)
         fl_GEN = unboundFlToFl(db['unboundFl_GEN']['getVal'])
         fl_RECO = unboundFlToFl(db['unboundFl_RECO']['getVal'])
         afb_GEN = unboundAfbToAfb(db['unboundAfb_GEN']['getVal'], fl_GEN)
@@ -473,7 +619,7 @@ def func_makeLatexTable(args):
         }
         totalErrorLine = ["Total"]
         for binKey in ['belowJpsi', 'betweenPeaks', 'abovePsi2s', 'summary']:
-            db = shelve.open("{0}/fitResults_{1}.db".format(p.dbplayer.absInputDir, q2bins[binKey]['label']))
+            db = FitResultStore.getStore("{0}/fitResults_{1}.db".format(p.dbplayer.absInputDir, q2bins[binKey]['label']))
             totalSystErr = 0.
             for systKey, latexLine in dbKeyToLine.items():
                 err = db["{0}_{1}".format(systKey, var)]['getError']
@@ -526,6 +672,41 @@ if __name__ == '__main__':
     subparsers = parser.add_subparsers(help="Functions", dest='Function_name')
 
     subparser_randEffi = subparsers.add_parser('randEffi')
+    subparser_randEffi.add_argument(
+        '-j', '--nWorkers',
+        dest='nWorkers',
+        type=int,
+        default=1,
+        help="Number of processes sharing the toy sets (Default: 1)",
+    )
+    subparser_randEffi.add_argument(
+        '--seed',
+        dest='baseSeed',
+        type=int,
+        default=None,
+        help="Base seed of per-set seeds, reproducible for any number of workers",
+    )
+    subparser_randEffi.add_argument(
+        '--mode',
+        dest='mode',
+        default='refit',
+        choices=['refit', 'linear'],
+        help="refit: refit per variation of the cross terms. linear: propagate their covariance with the linearised nominal fit (Default: refit)",
+    )
+    subparser_randEffi.add_argument(
+        '--nSamples',
+        dest='nSamples',
+        type=int,
+        default=10000,
+        help="Number of correlated variations in linear mode (Default: 10000)",
+    )
+    subparser_randEffi.add_argument(
+        '--nValidation',
+        dest='nValidation',
+        type=int,
+        default=10,
+        help="Number of variations also refitted in linear mode, for validation (Default: 10)",
+    )
     subparser_randEffi.set_defaults(func=func_randEffi)
 
     subparser_altEffi = subparsers.add_parser('altEffi')
@@ -5,9 +5,9 @@
 import types
 from copy import deepcopy
 import functools
-import shelve
 
 from BsToPhiMuMuFitter.anaSetup import q2bins, modulePath
+import BsToPhiMuMuFitter.FitResultStore as FitResultStore
 from BsToPhiMuMuFitter.varCollection import Bmass, CosThetaL, CosThetaK
 
 from v2Fitter.Fitter.ToyGenerator import ToyGenerator
@@ -70,7 +70,7 @@ def decorator_setExpectedEvents(yieldVars=None):
 
             expectedYields = 0
             try:
-                db = shelve.open(self.cfg['db'].format(binLabel=q2bins[self.process.cfg['binKey']]['label']))
+                db = FitResultStore.getStore(self.cfg['db'].format(binLabel=q2bins[self.process.cfg['binKey']]['label']))
                 for yVar in yieldVars:
                     try:
                         expectedYields += self.params.find(yVar).getVal()
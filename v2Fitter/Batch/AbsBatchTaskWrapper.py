@@ -4,12 +4,13 @@
 import os
 import abc
 import __main__
-import tempfile
 from copy import copy
-from subprocess import call
 
 import v2Fitter.Batch.batchConfig as batchConfig
+from v2Fitter.Batch.Executor import executors
 from v2Fitter.FlowControl.Logger import Logger
+from v2Fitter.FlowControl.BinPool import runBinsInPool
+from v2Fitter.FlowControl.Checkpoint import BinCheckpoint
 
 from argparse import ArgumentParser
 
@@ -43,6 +44,7 @@ class AbsBatchTaskWrapper:
             'nJobs': 1,
             'queue': batchConfig.BATCH_QUEUE,
             'work_dir': None,
+            'nWorkers': 1,  # Bins processed in parallel within a job
         }
         return cfg
 
@@ -82,14 +84,35 @@ when_to_transfer_output = ON_EXIT
         if wrapper_kwargs is None:
             wrapper_kwargs = {}
         p = self.getWrappedProcess(process, jobId, **wrapper_kwargs)
+        # Provenance of the outputs, e.g. records in fit result db
+        os.environ['V2FITTER_JOBID'] = "{0}.{1}".format(self.name, jobId)
         if self.cfg['work_dir'] is None:
             p.work_dir = os.path.join(self.task_dir, "job{jobId:04d}".format(jobId=jobId))
         elif isinstance(self.cfg['work_dir'], str):
             p.work_dir = os.path.join(self.task_dir, self.cfg['work_dir'])
         else:
             p.work_dir = os.path.join(self.task_dir, self.cfg['work_dir'][jobId])
-        
-        for binKey in p.cfg['bins']:
+
+        # A rerun of a preempted job skips the bins finished before, the checkpoint is removed once all bins are done
+        checkpoint = BinCheckpoint(os.path.join(p.work_dir, "checkpoint.json"))
+        doneBins = checkpoint.doneBins()
+        bins = [binKey for binKey in p.cfg['bins'] if binKey not in doneBins]
+        if len(bins) < len(p.cfg['bins']):
+            self.logger.logINFO("Job {0} resumes in {1}, skip finished bin(s) {2}".format(jobId, p.work_dir, [binKey for binKey in p.cfg['bins'] if binKey in doneBins]))
+
+        if self.cfg.get('nWorkers', 1) > 1 and len(bins) > 1:
+            results = runBinsInPool(p, p._sequence, bins, self.cfg['nWorkers'])
+            for result in results:
+                self.logger.logINFO("Job {0} bin {1}: status {2}, {3:.1f} s, outputs {4}".format(jobId, result['binKey'], result['status'], result['wallTime'], result['outputs']))
+                if result['status'] == 0:
+                    checkpoint.markDone(result['binKey'])
+            os.chdir(self.task_dir)
+            if any(r['status'] != 0 for r in results):
+                raise RuntimeError("Job {0} failed in bin(s) {1}".format(jobId, [r['binKey'] for r in results if r['status'] != 0]))
+            checkpoint.remove()
+            return
+
+        for binKey in bins:
             p.cfg['binKey']=binKey
             p.setSequence(p._sequence)
             try:
@@ -99,10 +122,14 @@ when_to_transfer_output = ON_EXIT
                 p.endSeq()
                 p.reset()
                 for obj in p._sequence: obj.reset()
+            checkpoint.markDone(binKey)
 
             # HTCondor does not transfer output directory but only file
             os.chdir(self.task_dir)
 
+        # Finished, a later rerun of this job starts over
+        checkpoint.remove()
+
 # Followings are pre-defined procedure to reduce routine
 
 BatchTaskParser = ArgumentParser(
@@ -137,6 +164,29 @@ BatchTaskSubparserSubmit.add_argument(
     action="store_true", # Default: false
     help="Submit the jobs. By default only show submit script to stdout.")
 
+def addExecutorArguments(subparser):
+    """Options to choose and configure the backend of submitTask"""
+    subparser.add_argument(
+        "--backend",
+        dest="backend",
+        choices=sorted(executors.keys()),
+        default=batchConfig.BATCH_SCHEDULER,
+        help="Where to run the jobs. (Default: {0})".format(batchConfig.BATCH_SCHEDULER))
+    subparser.add_argument(
+        "-p", "--nParallelJobs",
+        dest="nParallelJobs",
+        type=int,
+        default=1,
+        help="Number of jobs running at the same time with the local backend.")
+    subparser.add_argument(
+        "--maxRetries",
+        dest="maxRetries",
+        type=int,
+        default=0,
+        help="Number of reruns of a failed job with the local backend.")
+
+addExecutorArguments(BatchTaskSubparserSubmit)
+
 def submitTask(args):
     if args.queue:
         args.wrapper.cfg['queue'] = args.queue
@@ -144,13 +194,11 @@ def submitTask(args):
         args.wrapper.cfg['nJobs'] = args.nJobs
     jdl = args.wrapper.createJdl(parser_args=args)
 
-    if args.doSubmit:
-        with tempfile.NamedTemporaryFile() as tmp:
-            tmp.write(jdl)
-            tmp.flush()
-            call("condor_submit {0}".format(tmp.name), shell=True)
-    else:
-        print(jdl)
+    executor = executors[getattr(args, 'backend', batchConfig.BATCH_SCHEDULER)](args.wrapper, cfg={
+        'nParallelJobs': getattr(args, 'nParallelJobs', 1),
+        'maxRetries': getattr(args, 'maxRetries', 0),
+    })
+    executor.submit(jdl, doSubmit=args.doSubmit)
 
 BatchTaskSubparserSubmit.set_defaults(func=submitTask)
 
@@ -160,8 +208,16 @@ BatchTaskSubparserRun.add_argument(
     type=int,
     help="JobId is used to specify which work_dir to go."
 )
+BatchTaskSubparserRun.add_argument(
+    "-j", "--nWorkers",
+    dest="nWorkers",
+    type=int,
+    default=None,
+    help="Number of bins to be processed in parallel.")
 
 def runJob(args):
+    if getattr(args, 'nWorkers', None):
+        args.wrapper.cfg['nWorkers'] = args.nWorkers
     args.wrapper.runWrappedProcess(process=args.process, jobId=args.jobId)
     pass
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set sw=4 ts=4 fdm=indent fdl=1 fdn=3 ft=python et:
+
+# Description     : Backends running the jobs of a batch task, selected by name in executors
+
+from __future__ import print_function
+
+import os
+import sys
+import abc
+import json
+import time
+import shlex
+import socket
+import tempfile
+import threading
+from subprocess import call
+from multiprocessing.pool import ThreadPool
+
+def parseJdl(jdl):
+    """List the jobs of a rendered jdl, each a dict of lower-cased submit commands plus jobId.
+    $(Process) counts over all queue statements, as in HTCondor."""
+    attrs = {}
+    jobs = []
+    for line in jdl.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.lower().startswith("queue"):
+            fields = line.split()
+            nJobs = int(fields[1]) if len(fields) > 1 else 1
+            for iJob in range(nJobs):
+                jobId = len(jobs)
+                job = dict((key, val.replace("$(Process)", str(jobId))) for key, val in attrs.items())
+                job['jobId'] = jobId
+                jobs.append(job)
+        elif "=" in line:
+            key, val = line.split("=", 1)
+            attrs[key.strip().lower()] = val.strip()
+    return jobs
+
+class AbsExecutor(object):
+    """Run the jobs described by the jdl of an AbsBatchTaskWrapper"""
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, wrapper, cfg=None):
+        self.wrapper = wrapper
+        self.cfg = self.templateCfg()
+        if cfg is not None:
+            self.cfg.update(cfg)
+
+    @classmethod
+    def templateCfg(cls):
+        return {}
+
+    @abc.abstractmethod
+    def submit(self, jdl, doSubmit=False):
+        """Run or submit the jobs, or only show what would be done if not doSubmit"""
+        raise NotImplementedError
+
+class CondorExecutor(AbsExecutor):
+    """Hand the jdl to condor_submit"""
+    def submit(self, jdl, doSubmit=False):
+        if doSubmit:
+            with tempfile.NamedTemporaryFile() as tmp:
+                tmp.write(jdl)
+                tmp.flush()
+                call("condor_submit {0}".format(tmp.name), shell=True)
+        else:
+            print(jdl)
+
+class LocalExecutor(AbsExecutor):
+    """Run the jobs on this machine, nParallelJobs at a time.
+
+    Each job runs the executable of the jdl with the current python, in its initialdir.
+    stdout and stderr go to the output and error files of the jdl, task_dir/log/{out,err}.<jobId> by default.
+    Failed jobs are retried up to maxRetries times. Status of every job is kept in task_dir/log/manifest.json.
+    """
+    @classmethod
+    def templateCfg(cls):
+        cfg = {
+            'nParallelJobs': 1,
+            'maxRetries': 0,
+        }
+        return cfg
+
+    def __init__(self, wrapper, cfg=None):
+        super(LocalExecutor, self).__init__(wrapper, cfg)
+        self.manifestFile = os.path.join(self.wrapper.task_dir, "log", "manifest.json")
+        self._lock = threading.Lock()
+
+    def getCommand(self, job):
+        return [sys.executable, job['executable']] + shlex.split(job.get('arguments', ""))
+
+    def _logPath(self, job, key, default):
+        path = job.get(key, default.format(jobId=job['jobId']))
+        return os.path.join(job.get('initialdir', self.wrapper.task_dir), path)
+
+    def runJob(self, job):
+        """Run one job with retries, return its manifest entry"""
+        cwd = job.get('initialdir', self.wrapper.task_dir)
+        outPath = self._logPath(job, 'output', "log/out.{jobId}")
+        errPath = self._logPath(job, 'error', "log/err.{jobId}")
+        for path in [outPath, errPath]:
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Created by a concurrent job
+                    pass
+        entry = {
+            'jobId': job['jobId'],
+            'command': self.getCommand(job),
+            'host': socket.gethostname(),
+            'status': None,
+            'attempts': 0,
+            'startTime': time.time(),
+            'wallTime': 0.,
+            'output': outPath,
+            'error': errPath,
+        }
+        while entry['attempts'] <= self.cfg['maxRetries']:
+            entry['attempts'] += 1
+            with open(outPath, 'a') as fout, open(errPath, 'a') as ferr:
+                header = "# Attempt {0} of job {1} at {2}: {3}\n".format(entry['attempts'], job['jobId'], time.strftime("%Y-%m-%d %H:%M:%S"), " ".join(entry['command']))
+                fout.write(header)
+                ferr.write(header)
+                fout.flush()
+                ferr.flush()
+                entry['status'] = call(entry['command'], cwd=cwd, stdout=fout, stderr=ferr)
+            if entry['status'] == 0:
+                break
+        entry['wallTime'] = time.time() - entry['startTime']
+        self._updateManifest(entry)
+        return entry
+
+    def _updateManifest(self, entry):
+        """Keep the latest entry of each job, written atomically after every job"""
+        with self._lock:
+            manifest = {'task': self.wrapper.name, 'jobs': {}}
+            if os.path.exists(self.manifestFile):
+                with open(self.manifestFile) as f:
+                    manifest = json.load(f)
+            manifest['jobs'][str(entry['jobId'])] = entry
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.manifestFile), delete=False) as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.rename(f.name, self.manifestFile)
+            self.nDone += 1
+            print("{0}\t: Job {1} finished with status {2} after {3} attempt(s) in {4:.1f} s [{5}/{6}]".format(
+                "INFO" if entry['status'] == 0 else "ERROR", entry['jobId'], entry['status'], entry['attempts'], entry['wallTime'], self.nDone, self.nJobs))
+
+    def submit(self, jdl, doSubmit=False):
+        jobs = parseJdl(jdl)
+        if not doSubmit:
+            for job in jobs:
+                print("{0}\t{1}".format(job['jobId'], " ".join(self.getCommand(job))))
+            return []
+
+        self.nJobs = len(jobs)
+        self.nDone = 0
+        startTime = time.time()
+        pool = ThreadPool(processes=max(1, min(self.cfg['nParallelJobs'], len(jobs))))
+        try:
+            entries = pool.map(self.runJob, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [entry['jobId'] for entry in entries if entry['status'] != 0]
+        print("INFO\t: {0} job(s) with {1} in parallel finished in {2:.1f} s, see {3}".format(len(jobs), self.cfg['nParallelJobs'], time.time() - startTime, self.manifestFile))
+        if failed:
+            raise RuntimeError("Job(s) {0} failed, see {1}".format(failed, os.path.dirname(self.manifestFile)))
+        return entries
+
+executors = {
+    'condor': CondorExecutor,
+    'local': LocalExecutor,
+}
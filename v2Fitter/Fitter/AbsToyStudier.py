@@ -3,12 +3,25 @@
 # vim: set sw=4 ts=4 fdm=indent fdl=1 fdn=3 ft=python et:
 
 import os, pdb
+import glob
+import json
+import time
+import zlib
+import shutil
+import traceback
+import multiprocessing
 
 import abc
 import ROOT
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from v2Fitter.FlowControl.Path import Path
+from v2Fitter.FlowControl.Checkpoint import Checkpoint
 from BsToPhiMuMuFitter.anaSetup import q2bins
+import BsToPhiMuMuFitter.cpp
 
 class AbsToyStudier(Path):
     """
@@ -25,6 +38,7 @@ A mock of RooFit::RooMCStudy which is useful for low stat analysis.
         super(AbsToyStudier, self).reset()
         self.data = None
         self.fitter = None
+        self._residentSnapshot = None
 
     @classmethod
     def templateConfig(cls):
@@ -33,9 +47,25 @@ A mock of RooFit::RooMCStudy which is useful for low stat analysis.
             'data': None,
             'fitter': None,
             'nSetOfToys': 1,
+            'nWorkers': 1,  # Shard sets over forked workers, outputs merged in work_dir
+            'baseSeed': None,  # Seed each set from (baseSeed, binKey, setIndex), drawn from gRandom if None and nWorkers>1
+            'residentFitter': False,  # Book the NLL once and only swap data between sets, needs fitter.swapData
+            'checkpointEvery': 0,  # Save finished sets every N sets and resume from them after a restart, 0 to disable
         }
         return cfg
 
+    def seedForSet(self, setIndex):
+        """Deterministic non-zero seed of a set, independent of how sets are sharded"""
+        seed = zlib.crc32("{0}:{1}:{2}".format(self.cfg['baseSeed'], self.process.cfg.get('binKey'), setIndex)) & 0xffffffff
+        return seed if seed != 0 else 1  # TRandom3::SetSeed(0) means a random seed
+
+    def _seedSet(self, setIndex):
+        if self.cfg.get('baseSeed') is None:
+            return
+        seed = self.seedForSet(setIndex)
+        ROOT.gRandom.SetSeed(seed)
+        ROOT.RooRandom.randomGenerator().SetSeed(seed)
+
     @abc.abstractmethod
     def getSubData(self):
         """
@@ -66,39 +96,271 @@ Decide the number of entries of this subset.
         """ Run at the end of each loop (only before the fitter reset)"""
         raise NotImplementedError
 
-    def _runSetsLoop(self):
-        for iSet in range(self.cfg['nSetOfToys']):
+    def _runSetsLoop(self, setIndices=None):
+        if setIndices is None:
+            setIndices = range(self.cfg['nSetOfToys'])
+        for iSet in setIndices:
+            self._seedSet(iSet)
             self._preRunFitSteps(iSet)
-            self.fitter.hookProcess(self.process)
-            self.fitter.customize()
 
             self.currentSubDataEntries = self.getSubDataEntries(iSet)
 
-            self.fitter.pdf = self.process.sourcemanager.get(self.fitter.cfg['pdf'])
-            self.fitter.data = self.getSubData().next()
-            self.fitter.data = ROOT.RooDataSet(self.fitter.data.GetName(), self.fitter.data.GetTitle(),self.fitter.data,self.fitter.data.get(),"{0}".format(q2bins[self.fitter.process.cfg['binKey']]['cutString']))  #Added for applying Q2 cut, change line from getSubDataEntries() and from dataCollection.py
-            self.fitter._bookMinimizer()
-            self.fitter._preFitSteps()
+            subData = self.getSubData().next()
+            subData = ROOT.RooDataSet(subData.GetName(), subData.GetTitle(), subData, subData.get(), "{0}".format(q2bins[self.process.cfg['binKey']]['cutString']))  #Added for applying Q2 cut, change line from getSubDataEntries() and from dataCollection.py
+            self._bookFitter(subData)
             self.fitter._runFitSteps()
             self._postRunFitSteps(iSet)
 
+            if not self.cfg.get('residentFitter', False):
+                self.fitter.reset()
+        self._releaseFitter()
+
+    def _bookFitter(self, data):
+        """Book the fitter for a set. In resident mode, the NLL and minimizer booked
+    for the first set are reused, only data and the pre-fit parameters are swapped."""
+        if self._residentSnapshot is not None:
+            self.fitter.swapData(data)
+            self.fitter.restoreArgs(self._residentSnapshot)
+            return
+        self.fitter.hookProcess(self.process)
+        self.fitter.customize()
+        self.fitter.pdf = self.process.sourcemanager.get(self.fitter.cfg['pdf'])
+        self.fitter.data = data
+        self.fitter._bookMinimizer()
+        self.fitter._preFitSteps()
+        if self.cfg.get('residentFitter', False):
+            if hasattr(self.fitter, 'swapData'):
+                self._residentSnapshot = self.fitter.snapshotArgs()
+            else:
+                print("WARNING\t: {0} does not support resident mode, book per set.".format(self.fitter.name))
+                self.cfg['residentFitter'] = False
+
+    def _releaseFitter(self):
+        if self._residentSnapshot is not None:
             self.fitter.reset()
+            self._residentSnapshot = None
 
     @abc.abstractmethod
     def _postSetsLoop(self):
         raise NotImplementedError
 
+    def checkpointObjects(self):
+        """Map name to the objects holding results of finished sets, to be saved in checkpoints.
+    On resume, entries of a TTree are appended and a TH1 is added to the objects booked by _preSetsLoop."""
+        if getattr(self, 'otree', None) is not None:
+            return {'otree': self.otree}
+        return {}
+
+    def _checkpointName(self, ext):
+        return "{0}_{1}.checkpoint.{2}".format(self.name, q2bins[self.process.cfg['binKey']]['label'], ext)
+
+    def _fixBaseSeed(self):
+        """Sets after a restart must be the same sets, keep baseSeed with the checkpoint"""
+        checkpoint = Checkpoint(self._checkpointName("json"))
+        state = checkpoint.load()
+        if self.cfg.get('baseSeed') is None:
+            if 'baseSeed' in state:
+                self.cfg['baseSeed'] = state['baseSeed']
+            else:
+                self.cfg['baseSeed'] = ROOT.gRandom.Integer(2**31 - 1)
+        checkpoint.save({'baseSeed': self.cfg['baseSeed'], 'nSetOfToys': self.cfg['nSetOfToys']})
+        return checkpoint
+
+    def _saveSetsCheckpoint(self, doneSets):
+        """Results and indices of finished sets in one ROOT file, replaced atomically"""
+        fname = self._checkpointName("root")
+        tmpName = ".{0}".format(fname)
+        fout = ROOT.TFile(tmpName, 'RECREATE')
+        for key, obj in self.checkpointObjects().items():
+            fout.WriteTObject(obj, key, "Overwrite")
+        state = ROOT.TNamed("checkpointState", json.dumps({'baseSeed': self.cfg['baseSeed'], 'doneSets': doneSets}))
+        fout.WriteTObject(state, "checkpointState")
+        fout.Close()
+        os.rename(tmpName, fname)
+
+    def _loadSetsCheckpoint(self, setIndices):
+        """Restore results of finished sets, return their indices"""
+        fname = self._checkpointName("root")
+        if not os.path.exists(fname):
+            return []
+        fin = ROOT.TFile(fname)
+        try:
+            named = fin.Get("checkpointState")
+            state = json.loads(named.GetTitle()) if named != None else {}
+            if state.get('baseSeed') != self.cfg['baseSeed'] or not set(state.get('doneSets', [])) <= set(setIndices):
+                print("WARNING\t: {0} does not match the sets to run, start over.".format(fname))
+                return []
+            for key, obj in self.checkpointObjects().items():
+                saved = fin.Get(key)
+                if saved == None:
+                    raise RuntimeError("{0} not found in {1}".format(key, fname))
+                if obj.InheritsFrom("TTree"):
+                    obj.CopyEntries(saved)
+                elif obj.InheritsFrom("TH1"):
+                    obj.Add(saved)
+                else:
+                    raise RuntimeError("Unable to restore {0} of type {1}".format(key, obj.ClassName()))
+        finally:
+            fin.Close()
+        return state['doneSets']
+
+    def _runSets(self, setIndices=None):
+        """_preSetsLoop, _runSetsLoop and _postSetsLoop, with a checkpoint every cfg['checkpointEvery'] sets"""
+        if setIndices is None:
+            setIndices = range(self.cfg['nSetOfToys'])
+        self._preSetsLoop()
+        nEvery = self.cfg.get('checkpointEvery', 0)
+        if nEvery > 0:
+            doneSets = self._loadSetsCheckpoint(setIndices)
+            if doneSets:
+                print("INFO\t: {0} resumes with {1} of {2} sets done".format(self.name, len(doneSets), len(setIndices)))
+            remaining = [iSet for iSet in setIndices if iSet not in set(doneSets)]
+            for idx in range(0, len(remaining), nEvery):
+                self._runSetsLoop(remaining[idx:idx + nEvery])
+                doneSets = doneSets + remaining[idx:idx + nEvery]
+                self._saveSetsCheckpoint(doneSets)
+        else:
+            self._runSetsLoop(setIndices)
+        self._postSetsLoop()
+        if os.path.exists(self._checkpointName("root")):
+            os.remove(self._checkpointName("root"))
+
     def _runPath(self):
         """ Chain of pre-run-post steps"""
         self.fitter = self.cfg['fitter']
         self.data = self.process.sourcemanager.get(self.cfg['data'])
 
-        self._preSetsLoop()
-        self._runSetsLoop()
-        self._postSetsLoop()
+        checkpoint = self._fixBaseSeed() if self.cfg.get('checkpointEvery', 0) > 0 else None
+        nWorkers = min(self.cfg.get('nWorkers', 1), self.cfg['nSetOfToys'])
+        if nWorkers > 1 and multiprocessing.current_process().daemon:
+            print("WARNING\t: {0} runs inside a daemonic worker, sets are run sequentially.".format(self.name))
+            nWorkers = 1
+        if nWorkers > 1:
+            self._runSetsInPool(nWorkers)
+        else:
+            self._runSets()
+        if checkpoint is not None:
+            checkpoint.remove()
+
+    def _runSetsInPool(self, nWorkers):
+        """Run contiguous shards of sets in forked workers, each in its own sub-directory.
+    Workers inherit the workspace, data and fitter from the parent, a private copy each.
+    ROOT files written by _postSetsLoop are merged in the order of sets."""
+        if self.cfg.get('baseSeed') is None:
+            self.cfg['baseSeed'] = ROOT.gRandom.Integer(2**31 - 1)
+        print("INFO\t: {0} runs {1} sets with {2} workers, baseSeed={3}".format(self.name, self.cfg['nSetOfToys'], nWorkers, self.cfg['baseSeed']))
+
+        nSets = self.cfg['nSetOfToys']
+        shards = [range(nSets * iW // nWorkers, nSets * (iW + 1) // nWorkers) for iW in range(nWorkers)]
+        baseDir = os.getcwd()
+        _studierContext.update({
+            'studier': self,
+            'baseDir': baseDir,
+        })
+        startTime = time.time()
+        pool = multiprocessing.Pool(processes=nWorkers, maxtasksperchild=1)
+        try:
+            results = pool.map(_runShard, list(enumerate(shards)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _studierContext.clear()
+
+        failed = [result for result in results if result['status'] != 0]
+        for result in failed:
+            print("ERROR\t: {0} shard {1} failed, see {2}\n{3}".format(self.name, result['shard'], result['work_dir'], result['error']))
+        if failed:
+            raise RuntimeError("{0} of {1} shard(s) of {2} failed".format(len(failed), nWorkers, self.name))
+
+        # Merge outputs of the same name across shards
+        outputs = sorted(set(sum([result['outputs'] for result in results], [])))
+        for output in outputs:
+            if output.endswith(".root"):
+                merger = ROOT.TFileMerger(False)
+                merger.OutputFile(os.path.join(baseDir, output), "RECREATE")
+                for result in results:
+                    if output in result['outputs']:
+                        merger.AddFile(os.path.join(result['work_dir'], output))
+                if not merger.Merge():
+                    raise RuntimeError("Failed to merge {0}".format(output))
+            else:
+                print("WARNING\t: {0} is not merged, copies left in {1}_shard*".format(output, self.name))
+        if all(output.endswith(".root") for output in outputs):
+            for result in results:
+                shutil.rmtree(result['work_dir'], ignore_errors=True)
+        print("INFO\t: {0} finished {1} sets in {2:.1f} s".format(self.name, nSets, time.time() - startTime))
+
+# Workers are forked from the parent and find the studier here.
+_studierContext = {}
+
+def _runShard(shardAndIndices):
+    iShard, setIndices = shardAndIndices
+    studier = _studierContext['studier']
+    baseDir = _studierContext['baseDir']
+    workDir = os.path.join(baseDir, "{0}_shard{1}".format(studier.name, iShard))
+    result = {'shard': iShard, 'work_dir': workDir, 'status': 0, 'outputs': [], 'error': None}
+    try:
+        if not os.path.exists(workDir):
+            os.makedirs(workDir)
+        # Same input db as the parent. The directory is kept from a preempted run to resume from its checkpoint.
+        seeded = set()
+        for fpath in glob.glob(os.path.join(baseDir, "*.db")):
+            shutil.copy2(fpath, workDir)
+            seeded.add(os.path.basename(fpath))
+        os.chdir(workDir)
+        studier._runSets(setIndices)
+        result['outputs'] = sorted(f for f in os.listdir(workDir) if f not in seeded)
+    except Exception:
+        result['status'] = 1
+        result['error'] = traceback.format_exc()
+    return result
 
 def getSubData_random(self, checkCollision=True):
-    """ Pick random subset. Input dataset is asseumed to be large enough to avoid collision."""
+    """ Pick random subset. Input dataset is asseumed to be large enough to avoid collision.
+    Indices are drawn at once with numpy and the subset is copied in C++, see cpp/DataSubsetter.cc"""
+    if np is None:
+        for output in getSubData_random_legacy(self, checkCollision):
+            yield output
+        return
+    sumEntries = self.data.numEntries()
+    # The columnar snapshot is kept as long as the source dataset is the same.
+    if getattr(self, '_subsetterSource', None) is not self.data:
+        self._subsetter = ROOT.DataSubsetter(self.data)
+        self._subsetterSource = self.data
+    # Events picked by previous subsets stay used for the life of the generator, like evtBits in the legacy version
+    used = np.zeros(sumEntries, dtype=bool)
+    while True:
+        nEntries = self.currentSubDataEntries
+        # Seeded from gRandom to follow the seeding of the process and of each set
+        rng = np.random.RandomState(ROOT.gRandom.Integer(2**32 - 1))
+        if not checkCollision:
+            # Duplicated draws are merged, as outputBits does in the legacy version
+            indices = np.unique(rng.randint(0, sumEntries, size=nEntries))
+            used[indices] = True
+        else:
+            nFree = sumEntries - np.count_nonzero(used)
+            if nEntries > nFree:
+                self.logger.logERROR("Request {0} events out of {1} unused ones without replacement".format(nEntries, nFree))
+                raise RuntimeError
+            # Same as drawing one by one and redrawing on collision with events of this and previous subsets
+            picked = np.zeros(sumEntries, dtype=bool)
+            nUsed, nDrawn = 0, 0
+            while nUsed < nEntries:
+                draws = rng.randint(0, sumEntries, size=nEntries - nUsed)
+                nDrawn += draws.size
+                draws = np.unique(draws[~used[draws]])
+                used[draws] = True
+                picked[draws] = True
+                nUsed += draws.size
+            indices = np.flatnonzero(picked)
+            if (nDrawn - nEntries) * 5 > nEntries:
+                self.logger.logWARNING("Rate of random number collision is {0:.0%}, please consider use larger input".format(float(nDrawn - nEntries) / nEntries))
+        # Sequential reading is highly recommanded by ROOT author
+        indices = np.ascontiguousarray(indices, dtype=np.int32)
+        yield self._subsetter.Subset("{0}Subset".format(self.data.GetName()), indices, indices.size)
+
+def getSubData_random_legacy(self, checkCollision=True):
+    """ Pick random subset event by event, used without numpy"""
     sumEntries = int(self.data.sumEntries())
     evtBits = ROOT.TBits(int(sumEntries))
     while True:
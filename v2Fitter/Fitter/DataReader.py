@@ -7,8 +7,10 @@
 # Last Modified   : 20 Feb 2019 19:06 17:36
 
 from v2Fitter.FlowControl.Path import Path
+from v2Fitter.Fitter.PreloadCache import PreloadCache
 
-import os, pdb, tempfile
+import os, re, pdb, time, tempfile
+from contextlib import contextmanager
 import ROOT
 from ROOT import TChain
 from ROOT import TIter
@@ -26,9 +28,15 @@ class DataReader(Path):
 
     def reset(self):
         super(DataReader, self).reset()
+        if getattr(self, 'scratchFile', None) is not None:
+            scratchFileName = self.scratchFile.GetName()
+            self.scratchFile.Close()
+            os.remove(scratchFileName)
+        self.scratchFile = None
         self.ch = None
         self.friend = None
         self.dataset = {}
+        self.cache = None
 
     def __str__(self):
         list_of_files = self.ch.GetListOfFiles()
@@ -49,6 +57,10 @@ class DataReader(Path):
             'argset': [],
             'dataset': [],
             'preloadFile': None,
+            'preloadCache': None,  # Cache directory, supersedes preloadFile if set
+            'preloadCacheBudget': 20 * 1024**3,  # In bytes, None for no limit
+            'singlePass': True,  # Read the chain once for all datasets, then reduce in memory
+            'storage': "memory",  # "memory" for RooVectorDataStore, "tree" for RooTreeDataStore in a private scratch file
         }
         return cfg
 
@@ -56,29 +68,113 @@ class DataReader(Path):
         print("""Return named dataset, create if not exist""")
         if dname in self.dataset.keys():
             return self.dataset[dname]
-        tempfile_preload = ROOT.TFile(tempfile.gettempdir()+"/temp.root", 'RECREATE') #Pritam
-        data = RooDataSet(
-            dname,
-            "",
-            self.ch,
-            self.argset,
-            dcut)
-        data.Write(); tempfile_preload.Close() #Pritam
+        with self.storageBackend(dname):
+            data = RooDataSet(
+                dname,
+                "",
+                self.ch,
+                self.argset,
+                dcut)
         self.dataset[dname] = data
         print("ARGSET: ", self.argset, dcut)
         return data
 
+    @contextmanager
+    def storageBackend(self, dname):
+        """Datasets constructed within this context use the configured storage, report bytes written and time spent"""
+        startTime = time.time()
+        bytesWritten = 0
+        defaultStorageType = ROOT.RooAbsData.getDefaultStorageType()
+        if self.cfg['storage'] == "tree":
+            if self.scratchFile is None:
+                # Unique per process, concurrent jobs on one node never share it.
+                fd, scratchFileName = tempfile.mkstemp(prefix="{0}_".format(self.cfg['name']), suffix=".root")
+                os.close(fd)
+                self.scratchFile = ROOT.TFile(scratchFileName, 'RECREATE')
+            bytesWritten = -self.scratchFile.GetBytesWritten()
+            self.scratchFile.cd()
+            ROOT.RooAbsData.setDefaultStorageType(ROOT.RooAbsData.Tree)
+        elif self.cfg['storage'] != "memory":
+            self.logger.logERROR("Unknown storage {0}, use memory or tree.".format(self.cfg['storage']))
+            raise ValueError
+        try:
+            yield
+        finally:
+            if self.cfg['storage'] == "tree":
+                ROOT.RooAbsData.setDefaultStorageType(defaultStorageType)
+                self.scratchFile.Flush()
+                bytesWritten += self.scratchFile.GetBytesWritten()
+                ROOT.gROOT.cd()
+        self.logger.logINFO("Created {0} with {1} storage, {2} bytes written in {3:.1f} s.".format(dname, self.cfg['storage'], bytesWritten, time.time() - startTime))
+
+    # Functions allowed in a cut string to be evaluated on the argset alone
+    formulaFunctions = set(['abs', 'fabs', 'sqrt', 'pow', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'TMath', 'Abs', 'Sqrt', 'Power', 'Exp', 'Log', 'Pi'])
+
+    def isReducible(self, dcut):
+        """Check if dcut only depends on variables in argset, hence can be applied with RooAbsData.reduce"""
+        names = set()
+        iterator = self.argset.createIterator()
+        arg = iterator.Next()
+        while arg:
+            names.add(arg.GetName())
+            arg = iterator.Next()
+        identifiers = set(re.findall(r"(?<![\w.])[A-Za-z_]\w*", dcut))
+        return identifiers.issubset(names | DataReader.formulaFunctions)
+
+    def createDataSetsSinglePass(self, dataset):
+        """Read the chain once with the union of all cuts, then reduce to each named dataset"""
+        supersetCut = " || ".join(["({0})".format(dcut) for dname, dcut in dataset])
+        with self.storageBackend("{0}.superset".format(self.cfg['name'])):
+            superset = RooDataSet(
+                "{0}.superset".format(self.cfg['name']),
+                "",
+                self.ch,
+                self.argset,
+                supersetCut)
+        for dname, dcut in dataset:
+            with self.storageBackend(dname):
+                data = superset.reduce(ROOT.RooFit.Name(dname), ROOT.RooFit.Cut(dcut))
+            data.SetTitle("")
+            self.dataset[dname] = data
+        self.logger.logINFO("Created {0} datasets from one read of {1} events.".format(len(dataset), superset.numEntries()))
+        return [self.dataset[dname] for dname, dcut in dataset]
+
     def createDataSets(self, dataset):
         print("""Get named dataset""")
+        if self.cfg['preloadCache']:
+            self.cache = PreloadCache(self.cfg['preloadCache'], self.cfg['preloadCacheBudget'], self.logger)
+        toCreate = []
+        cacheKeys = {}
         for name, cut in dataset:
+            if self.cache is not None:
+                cacheKeys[name] = self.cache.makeKey(name, cut, self.argset, self.cfg['ifile'], self.cfg['ifriend'])
+                data = self.cache.get(cacheKeys[name], name)
+                if data is None:
+                    toCreate.append((name, cut))
+                else:
+                    self.dataset[name] = data
+                continue
             if self.cfg['preloadFile'] and os.path.exists(self.cfg['preloadFile']):
                 file_preload = ROOT.TFile(self.cfg['preloadFile'])
                 data = file_preload.Get(name)
                 if not data == None:
                     self.dataset[name] = data
                 file_preload.Close()
-            self.createDataSet(name, cut)
-        if self.process.cfg['seqKey']=="fitSigMBinned": self.createBHist(cut)
+            if name not in self.dataset.keys():
+                toCreate.append((name, cut))
+
+        if self.cfg['singlePass'] and len(toCreate) > 1:
+            if all(self.isReducible(cut) for name, cut in toCreate):
+                self.createDataSetsSinglePass(toCreate)
+            else:
+                self.logger.logWARNING("Cut depends on variables outside argset, read the chain once per dataset.")
+        for name, cut in toCreate:
+            data = self.createDataSet(name, cut)
+            if self.cache is not None:
+                self.cache.put(cacheKeys[name], data)
+        if self.cache is not None:
+            self.cache.logStats()
+        if self.process.cfg['seqKey']=="fitSigMBinned": self.createBHist(dataset[-1][1])
         return self.dataset
     
     def createBHist(self, cut):
@@ -105,7 +201,7 @@ class DataReader(Path):
     def _addSource(self):
         print("""Add dataset and arguments to source pool""")
         print("source: cfg", self.cfg['source'])
-        if self.cfg['preloadFile'] and not os.path.exists(self.cfg['preloadFile']):
+        if self.cache is None and self.cfg['preloadFile'] and not os.path.exists(self.cfg['preloadFile']):
             file_preload = ROOT.TFile(self.cfg['preloadFile'], 'RECREATE')
             for dname, d in self.dataset.items():
                 d.Write()
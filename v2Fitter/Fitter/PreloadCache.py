@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set sw=4 ts=4 fdm=indent fdl=1 fdn=3 ft=python et:
+
+# Description     : Content-addressed cache of RooDataSet created by DataReader
+
+import os, glob, json, time, fcntl, hashlib, tempfile
+from contextlib import contextmanager
+import ROOT
+
+class PreloadCache(object):
+    """Keep created datasets keyed by a hash of everything they depend on.
+
+    Each dataset is stored as <key>.root in cacheDir, index.json keeps size and
+    last access time of each entry. Entries are evicted from the least recently
+    used one once the total size exceeds budget (in bytes, None for no limit).
+    """
+    def __init__(self, cacheDir, budget=None, logger=None):
+        self.cacheDir = cacheDir
+        self.budget = budget
+        self.logger = logger
+        self.nHit = 0
+        self.nMiss = 0
+        self.nEvicted = 0
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                # Created by a concurrent job
+                pass
+
+    @staticmethod
+    def fingerprintFiles(ifiles):
+        """List (path, mtime, size) of the files behind TChain-style entries"""
+        fingerprint = []
+        for entry in ifiles:
+            # TChain.Add accepts 'file.root/treeName' and wildcards.
+            fname = entry[:entry.rfind(".root") + 5] if ".root" in entry else entry
+            matched = sorted(glob.glob(fname))
+            if not matched:
+                # e.g. remote files, keep the name only.
+                fingerprint.append((entry, None, None))
+            for f in matched:
+                fstat = os.stat(f)
+                fingerprint.append((entry, f, fstat.st_mtime, fstat.st_size))
+        return fingerprint
+
+    @staticmethod
+    def fingerprintArgs(argset):
+        """List (name, min, max) of the arguments, ranges act as cuts on import"""
+        fingerprint = []
+        iterator = argset.createIterator()
+        arg = iterator.Next()
+        while arg:
+            if arg.InheritsFrom("RooRealVar"):
+                fingerprint.append((arg.GetName(), arg.getMin(), arg.getMax()))
+            else:
+                fingerprint.append((arg.GetName(),))
+            arg = iterator.Next()
+        return sorted(fingerprint)
+
+    def makeKey(self, dname, dcut, argset, ifiles, ifriends=None):
+        content = {
+            'dname': dname,
+            'dcut': dcut,
+            'argset': PreloadCache.fingerprintArgs(argset),
+            'ifile': PreloadCache.fingerprintFiles(ifiles),
+            'ifriend': PreloadCache.fingerprintFiles(ifriends if ifriends else []),
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+    @contextmanager
+    def _lockedIndex(self):
+        """Yield the index, written back on exit. Safe against concurrent jobs."""
+        with open(os.path.join(self.cacheDir, "index.lock"), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                indexFile = os.path.join(self.cacheDir, "index.json")
+                index = {}
+                if os.path.exists(indexFile):
+                    with open(indexFile) as f:
+                        index = json.load(f)
+                yield index
+                with tempfile.NamedTemporaryFile('w', dir=self.cacheDir, delete=False) as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+                os.rename(f.name, indexFile)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _entryPath(self, key):
+        return os.path.join(self.cacheDir, "{0}.root".format(key))
+
+    def get(self, key, dname):
+        """Return cached dataset or None"""
+        data = None
+        with self._lockedIndex() as index:
+            if key in index and os.path.exists(self._entryPath(key)):
+                fin = ROOT.TFile(self._entryPath(key))
+                data = fin.Get(dname)
+                fin.Close()
+                if data == None:
+                    data = None
+                    del index[key]
+                else:
+                    index[key]['lastAccess'] = time.time()
+        if data is None:
+            self.nMiss += 1
+        else:
+            self.nHit += 1
+        return data
+
+    def put(self, key, data):
+        """Store dataset, then evict old entries beyond the budget"""
+        fd, tmpName = tempfile.mkstemp(suffix=".root", dir=self.cacheDir)
+        os.close(fd)
+        fout = ROOT.TFile(tmpName, 'RECREATE')
+        data.Write()
+        fout.Close()
+        os.rename(tmpName, self._entryPath(key))
+        with self._lockedIndex() as index:
+            index[key] = {
+                'dname': data.GetName(),
+                'size': os.path.getsize(self._entryPath(key)),
+                'lastAccess': time.time(),
+            }
+            self._evict(index, keep=key)
+
+    def _evict(self, index, keep=None):
+        if self.budget is None:
+            return
+        totalSize = sum(entry['size'] for entry in index.values())
+        for key in sorted(index.keys(), key=lambda k: index[k]['lastAccess']):
+            if totalSize <= self.budget:
+                break
+            if key == keep:
+                continue
+            if os.path.exists(self._entryPath(key)):
+                os.remove(self._entryPath(key))
+            totalSize -= index[key]['size']
+            del index[key]
+            self.nEvicted += 1
+
+    def logStats(self):
+        msg = "PreloadCache {0}: {1} hit(s), {2} miss(es), {3} eviction(s).".format(self.cacheDir, self.nHit, self.nMiss, self.nEvicted)
+        if self.logger is None:
+            print(msg)
+        else:
+            self.logger.logINFO(msg)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set sw=4 ts=4 fdm=indent fdl=2 ft=python et:
+
+# Description     : Run the bins of a Process in a pool of forked workers
+
+from __future__ import print_function
+
+import os
+import glob
+import time
+import shutil
+import traceback
+from multiprocessing import Pool
+
+# Workers are forked from the parent, hence inherit the process, its sequence
+# and all module level objects from here. Each worker runs exactly one bin
+# (maxtasksperchild=1), so nothing leaks from one bin to another.
+_poolContext = {}
+
+def _snapshotDir(dirname):
+    """Map relative path to (mtime, size) for every file under dirname."""
+    snapshot = {}
+    for root, dirs, files in os.walk(dirname):
+        for f in files:
+            fpath = os.path.join(root, f)
+            fstat = os.stat(fpath)
+            snapshot[os.path.relpath(fpath, dirname)] = (fstat.st_mtime, fstat.st_size)
+    return snapshot
+
+def _runOneBin(binKey):
+    """Run the full beginSeq/runSeq/endSeq cycle of one bin in its own work_dir."""
+    process = _poolContext['process']
+    baseWorkDir = _poolContext['baseWorkDir']
+    binWorkDir = os.path.join(baseWorkDir, "bin_{0}".format(binKey))
+    result = {
+        'binKey': binKey,
+        'work_dir': binWorkDir,
+        'status': 0,
+        'wallTime': 0.,
+        'outputs': [],
+        'error': None,
+    }
+    startTime = time.time()
+    try:
+        # Start from the same db copies a serial run would see.
+        if not os.path.exists(binWorkDir):
+            os.makedirs(binWorkDir)
+        for pattern in _poolContext['seedPatterns']:
+            for fpath in glob.glob(os.path.join(baseWorkDir, pattern)):
+                if os.path.isfile(fpath):
+                    shutil.copy2(fpath, binWorkDir)
+        seeded = _snapshotDir(binWorkDir)
+
+        process.cfg['binKey'] = binKey
+        process.work_dir = binWorkDir
+        process.setSequence(_poolContext['sequence'])
+        try:
+            process.beginSeq()
+            process.runSeq()
+        finally:
+            process.endSeq()
+            process.reset()
+            for obj in process._sequence:
+                obj.reset()
+
+        result['outputs'] = sorted(f for f, stat in _snapshotDir(binWorkDir).items() if seeded.get(f) != stat)
+    except Exception:
+        result['status'] = 1
+        result['error'] = traceback.format_exc()
+    result['wallTime'] = time.time() - startTime
+    return result
+
+def collectBinOutputs(result, baseWorkDir):
+    """Move new or modified files of a finished bin back to baseWorkDir."""
+    collected = []
+    for relPath in result['outputs']:
+        src = os.path.join(result['work_dir'], relPath)
+        if relPath == "runtime.log":
+            # Logger truncates runtime.log, keep one per bin instead.
+            relPath = "runtime_{0}.log".format(result['binKey'])
+        dst = os.path.join(baseWorkDir, relPath)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        shutil.move(src, dst)
+        collected.append(relPath)
+    if result['status'] == 0:
+        shutil.rmtree(result['work_dir'], ignore_errors=True)
+    result['outputs'] = collected
+    return collected
+
+def runBinsInPool(process, sequence, bins, nWorkers=1, seedPatterns=("*.db",)):
+    """Run sequence for each bin in an isolated worker, return per-bin results.
+
+    Every worker gets a private copy of the process (and hence of its
+    SourceManager, FileManager and FitDBPlayer), running in work_dir/bin_<binKey>.
+    Files matching seedPatterns in work_dir are copied in before the run,
+    new or modified files are moved back afterwards. Failed bins keep their
+    directory for inspection.
+    Paths writing to a shared file outside work_dir are not protected,
+    produce such files in a serial run beforehand.
+    """
+    baseWorkDir = os.path.abspath(process.work_dir)
+    if not os.path.exists(baseWorkDir):
+        os.makedirs(baseWorkDir)
+    _poolContext.update({
+        'process': process,
+        'sequence': sequence,
+        'baseWorkDir': baseWorkDir,
+        'seedPatterns': seedPatterns,
+    })
+
+    startTime = time.time()
+    pool = Pool(processes=min(nWorkers, len(bins)), maxtasksperchild=1)
+    try:
+        results = pool.map(_runOneBin, bins, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _poolContext.clear()
+
+    # Collect in the order of bins such that overlapping outputs resolve as a serial run.
+    for result in results:
+        collectBinOutputs(result, baseWorkDir)
+        if result['status'] == 0:
+            print("INFO\t: {0:<16} done in {1:8.1f} s, {2} output file(s)".format(result['binKey'], result['wallTime'], len(result['outputs'])))
+        else:
+            print("ERROR\t: {0:<16} failed after {1:8.1f} s, see {2}\n{3}".format(result['binKey'], result['wallTime'], result['work_dir'], result['error']))
+    print("INFO\t: {0} bin(s) with {1} worker(s) finished in {2:.1f} s".format(len(bins), nWorkers, time.time() - startTime))
+    return results
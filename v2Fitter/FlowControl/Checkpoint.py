@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set sw=4 ts=4 fdm=indent fdl=2 ft=python et:
+
+# Description     : Progress of a job kept on disk, to resume after preemption
+
+from __future__ import print_function
+
+import os
+import json
+import tempfile
+
+class Checkpoint(object):
+    """A json file holding a dict, replaced atomically on each save.
+
+    A job killed at any time leaves either the previous or the new state, never a partial one.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """Return the saved state, or an empty dict"""
+        if not self.exists():
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            print("WARNING\t: Corrupted checkpoint {0}, ignored".format(self.path))
+            return {}
+
+    def save(self, state):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with tempfile.NamedTemporaryFile('w', dir=dirname, prefix=".checkpoint_", delete=False) as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(f.name, self.path)
+
+    def update(self, **kwargs):
+        state = self.load()
+        state.update(kwargs)
+        self.save(state)
+        return state
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+class BinCheckpoint(Checkpoint):
+    """Bins of a job finished so far"""
+    def doneBins(self):
+        return self.load().get('doneBins', [])
+
+    def markDone(self, binKey):
+        state = self.load()
+        if binKey not in state.setdefault('doneBins', []):
+            state['doneBins'].append(binKey)
+        self.save(state)